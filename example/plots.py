@@ -2,135 +2,339 @@
 
 import argparse
 import csv
+import hashlib
+import importlib.util
+import json
+import os
 import sys
 
-from collections.abc import Iterator
-from contextlib import ExitStack
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime as dt
+
 from dateutil import parser as dup
 from typing import Any, TextIO
 
+import pandas as pd
 import plotly.express as px
+import plotly.graph_objects as go
+
+from plotly.offline import get_plotlyjs
+
+# Base names of the fields plotted by each kind of plot. A column is
+# related to a plot if its name is equal to one of these, or if it ends with
+# ":" followed by one of these (e.g. "AAA:tot_src")
+PLOT_FIELDS = {
+    'src': ('tot_src', 'tot_dst_as_src'),
+    'rate': ('latest_rate', 'avg_rate'),
+    'gain': ('tot_gain_src', 'tot_gain_net_src'),
+    'apy': ('global_apy',),
+}
 
 
-def load_data(file: TextIO) -> Iterator[dict[str, Any]]:
+def classify_columns(keys: list[str],
+                     plots: list[str]) -> dict[str, list[str]]:
     '''
-    Loads data from a CSV file
+    Determines, in a single pass over the column names, which columns are
+    needed by each of the specified plots
     '''
-    data = list(csv.DictReader(file))
+    field_to_plot = {field: plot for plot in plots
+                     for field in PLOT_FIELDS[plot]}
 
-    for x in data:
-        iterator = iter(x.items())
+    result = {plot: [] for plot in plots}
 
-        k, v = next(iterator)
-        if k != 'datetime':
-            raise ValueError('The first field is not "datetime"')
-        x[k] = dup.parse(v)
+    for k in keys:
+        plot = field_to_plot.get(k.rsplit(':', 1)[-1])
+        if plot is not None:
+            result[plot].append(k)
 
-        for k, v in iterator:
-            x[k] = None if v == '' else float(v)
+    return result
 
-        yield x
 
+def load_data(file: TextIO, plots: list[str]) -> tuple[dict[str, list[Any]],
+                                                      dict[str, list[str]]]:
+    '''
+    Loads data from a CSV file into a columnar structure, keeping only the
+    columns needed by the specified plots
+    '''
+    reader = csv.reader(file)
 
-def main(argv: list[str] | None = None) -> int:
-    if argv is None:
-        argv = sys.argv
+    header = next(reader)
+    if header[0] != 'datetime':
+        raise ValueError('The first field is not "datetime"')
 
-    parser = argparse.ArgumentParser(
-        description='Generate plots based on data computed with investats, or '
-        'aggregated with investats_aggr'
-    )
+    classes = classify_columns(header, plots)
 
-    parser.add_argument('file_in', metavar='FILE_IN', type=str,
-                        nargs='?', default='-',
-                        help='Input file. If set to "-" then stdin is used '
-                        '(default: %(default)s)')
+    wanted = {'datetime', 'tot_days'} | \
+        {k for cols in classes.values() for k in cols}
+    indexes = [(i, k) for i, k in enumerate(header) if k in wanted]
 
-    parser.add_argument('-s', '--plot-src', action='store_true',
-                        help='Generate plot based on SRC values')
-    parser.add_argument('-r', '--plot-rate', action='store_true',
-                        help='Generate plot based on rate values')
-    parser.add_argument('-g', '--plot-gain', action='store_true',
-                        help='Generate plot based on gain values')
-    parser.add_argument('-a', '--plot-apy', action='store_true',
-                        help='Generate plot based on APY values')
+    columns = {k: [] for _, k in indexes}
 
-    args = parser.parse_args(argv[1:])
+    for row in reader:
+        for i, k in indexes:
+            v = row[i]
+            columns[k].append(dup.parse(v) if i == 0
+                              else None if v == '' else float(v))
 
-    ############################################################################
+    return columns, classes
+
+
+def load_data_cached(path: str, plots: list[str],
+                     cache_dir: str = '') -> tuple[dict[str, list[Any]],
+                                                   dict[str, list[str]]]:
+    '''
+    Like load_data, but takes a file path and, if cache_dir is specified,
+    reuses the parsed data from a previous invocation as long as the file
+    modification time and size have not changed. The data is cached as JSON
+    (with the datetimes in ISO-8601 format), so that loading it cannot run
+    any code
+    '''
+    if cache_dir == '':
+        with open(path, 'r') as f:
+            return load_data(f, plots)
+
+    st = os.stat(path)
+    stamp = (st.st_mtime_ns, st.st_size)
+
+    key = hashlib.sha256(
+        repr((os.path.abspath(path), sorted(plots))).encode()).hexdigest()
+    cache_file = os.path.join(cache_dir, f'{key}.json')
+
+    try:
+        with open(cache_file, 'r') as f:
+            cached = json.load(f)
+        if tuple(cached['stamp']) == stamp:
+            columns = cached['columns']
+            columns['datetime'] = [dt.fromisoformat(x)
+                                   for x in columns['datetime']]
+            return columns, cached['classes']
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    with open(path, 'r') as f:
+        columns, classes = load_data(f, plots)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_file = f'{cache_file}.{os.getpid()}.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump({
+            'stamp': stamp,
+            'columns': columns | {'datetime': [x.isoformat() for x
+                                               in columns['datetime']]},
+            'classes': classes,
+        }, f)
+    os.replace(tmp_file, cache_file)
+
+    return columns, classes
 
-    with ExitStack() as stack:
-        file_in = (sys.stdin if args.file_in == '-'
-                   else stack.enter_context(open(args.file_in, 'r')))
-        data = list(load_data(file_in))
 
-    if args.plot_src:
-        fig = px.line(
-            data,
+def build_figures(columns: dict[str, list[Any]], classes: dict[str, list[str]],
+                  title_suffix: str) -> dict[str, go.Figure]:
+    '''
+    Builds the figures for all the plots listed in classes, using data loaded
+    with load_data
+    '''
+    # The DataFrame is built only once and shared by all the figures
+    df = pd.DataFrame(columns)
+
+    figs = {}
+
+    if 'src' in classes:
+        figs['src'] = px.line(
+            df,
             x='datetime',
-            y=[k for k in data[0].keys()
-               if k in ('tot_src', 'tot_dst_as_src')
-               or k.endswith((':tot_src', ':tot_dst_as_src'))],
+            y=classes['src'],
             template='plotly_dark',
-            title=f'SRC values: {args.file_in}',
+            title=f'SRC values: {title_suffix}',
 
             hover_name='datetime',
             hover_data=['tot_days'],
             markers=True,
         )
-        fig.show()
 
-    if args.plot_rate:
-        fig = px.line(
-            data,
+    if 'rate' in classes:
+        figs['rate'] = px.line(
+            df,
             x='datetime',
-            y=[k for k in data[0].keys()
-               if k in ('latest_rate', 'avg_rate')
-               or k.endswith((':latest_rate', ':avg_rate'))],
+            y=classes['rate'],
             template='plotly_dark',
-            title=f'Rate values: {args.file_in}',
+            title=f'Rate values: {title_suffix}',
 
             hover_name='datetime',
             hover_data=['tot_days'],
             markers=True,
         )
-        for k in data[0].keys():
-            if k == 'avg_rate' or k.endswith(':avg_rate'):
-                fig.add_hline(annotation_text=k, y=data[-1][k],
-                              line_color='#0c0')
-        fig.show()
-
-    if args.plot_gain:
-        fig = px.line(
-            data,
+        for k in classes['rate']:
+            if k.rsplit(':', 1)[-1] == 'avg_rate':
+                figs['rate'].add_hline(annotation_text=k, y=columns[k][-1],
+                                       line_color='#0c0')
+
+    if 'gain' in classes:
+        figs['gain'] = px.line(
+            df,
             x='datetime',
-            y=[k for k in data[0].keys()
-               if k in ('tot_gain_src', 'tot_gain_net_src')
-               or k.endswith((':tot_gain_src', ':tot_gain_net_src'))],
+            y=classes['gain'],
             template='plotly_dark',
-            title=f'Gain values: {args.file_in}',
+            title=f'Gain values: {title_suffix}',
 
             hover_name='datetime',
             hover_data=['tot_days'],
             markers=True,
         )
-        fig.show()
 
-    if args.plot_apy:
-        fig = px.line(
+    if 'apy' in classes:
+        figs['apy'] = px.line(
             # The first entry is skipped, as APY is always zero there
-            data[1:],
+            df.iloc[1:],
             x='datetime',
-            y=[k for k in data[0].keys()
-               if k == 'global_apy' or k.endswith(':global_apy')],
+            y=classes['apy'],
             template='plotly_dark',
-            title=f'APY values: {args.file_in}',
+            title=f'APY values: {title_suffix}',
 
             hover_name='datetime',
             hover_data=['tot_days'],
             markers=True,
         )
-        fig.show()
+
+    return figs
+
+
+def get_stems(paths: list[str]) -> list[str]:
+    '''
+    Returns the names to be used as prefixes of the files rendered for some
+    input files, i.e. their base names without the extension. The names that
+    would collide are prefixed with the name of the parent directory, and
+    then suffixed with the position of the file in the list if needed
+    '''
+    stems = [os.path.splitext(os.path.basename(path))[0] for path in paths]
+
+    stems = [os.path.basename(os.path.dirname(os.path.abspath(path))) +
+             '-' + stem if stems.count(stem) > 1 else stem
+             for path, stem in zip(paths, stems)]
+
+    return [f'{stem}-{i}' if stems.count(stem) > 1 else stem
+            for i, stem in enumerate(stems)]
+
+
+def export_figures(path: str, plots: list[str], dir_out: str,
+                   fmt: str = 'html', cache_dir: str = '',
+                   stem: str = '') -> list[str]:
+    '''
+    Renders the figures related to an input file to static files in the
+    dir_out directory, named after stem (default: the base name of the file
+    without the extension), and returns the paths of the generated files.
+    HTML files reference a shared plotly.min.js bundle, which is expected to
+    be in the same directory
+    '''
+    columns, classes = load_data_cached(path, plots, cache_dir)
+    figs = build_figures(columns, classes, path)
+
+    if stem == '':
+        stem = get_stems([path])[0]
+    paths_out = []
+
+    for plot, fig in figs.items():
+        path_out = os.path.join(dir_out, f'{stem}-{plot}.{fmt}')
+        if fmt == 'html':
+            fig.write_html(path_out, include_plotlyjs='directory')
+        else:
+            fig.write_image(path_out)
+        paths_out.append(path_out)
+
+    return paths_out
+
+
+def main(argv: list[str] | None = None) -> int:
+    if argv is None:
+        argv = sys.argv
+
+    parser = argparse.ArgumentParser(
+        description='Generate plots based on data computed with investats, or '
+        'aggregated with investats_aggr'
+    )
+
+    parser.add_argument('files_in', metavar='FILE_IN', type=str,
+                        nargs='*', default=['-'],
+                        help='Input files. If set to "-" then stdin is used '
+                        '(default: -). Multiple files are supported only '
+                        'together with --dir-out')
+
+    parser.add_argument('-s', '--plot-src', action='store_true',
+                        help='Generate plot based on SRC values')
+    parser.add_argument('-r', '--plot-rate', action='store_true',
+                        help='Generate plot based on rate values')
+    parser.add_argument('-g', '--plot-gain', action='store_true',
+                        help='Generate plot based on gain values')
+    parser.add_argument('-a', '--plot-apy', action='store_true',
+                        help='Generate plot based on APY values')
+
+    parser.add_argument('--cache-dir', type=str, default='',
+                        help='If specified, caches the parsed input data in '
+                        'this directory, to avoid parsing it again if the '
+                        'file has not changed')
+
+    parser.add_argument('-o', '--dir-out', type=str, default='',
+                        help='If specified, the plots are not shown, but '
+                        'rendered to files in this directory instead')
+    parser.add_argument('-f', '--format', type=str, choices=('html', 'png'),
+                        default='html',
+                        help='Format of the files rendered with --dir-out. '
+                        'The "png" format requires the kaleido package '
+                        '(default: %(default)s)')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='Number of processes used to render the files '
+                        'with --dir-out (default: number of CPUs)')
+
+    args = parser.parse_args(argv[1:])
+
+    ############################################################################
+
+    plots = [plot for plot, flag in (('src', args.plot_src),
+                                     ('rate', args.plot_rate),
+                                     ('gain', args.plot_gain),
+                                     ('apy', args.plot_apy)) if flag]
+
+    if args.dir_out == '':
+        if len(args.files_in) != 1:
+            raise ValueError('Multiple input files are supported only '
+                             'together with --dir-out')
+
+        if args.files_in[0] == '-':
+            columns, classes = load_data(sys.stdin, plots)
+        else:
+            columns, classes = load_data_cached(args.files_in[0], plots,
+                                                args.cache_dir)
+
+        for fig in build_figures(columns, classes,
+                                 args.files_in[0]).values():
+            fig.show()
+
+        return 0
+
+    if '-' in args.files_in:
+        raise ValueError('Stdin input is not supported together '
+                         'with --dir-out')
+    if args.format == 'png' and importlib.util.find_spec('kaleido') is None:
+        raise ValueError('The "png" format requires the kaleido package')
+
+    os.makedirs(args.dir_out, exist_ok=True)
+
+    if args.format == 'html':
+        # A single copy of the plotly.js bundle is shared by all the HTML
+        # files. It is written here, before starting the workers, so they
+        # don't race to write it
+        with open(os.path.join(args.dir_out, 'plotly.min.js'), 'w',
+                  encoding='utf-8') as f:
+            f.write(get_plotlyjs())
+
+    with ProcessPoolExecutor(args.jobs) as executor:
+        futures = [executor.submit(export_figures, path, plots, args.dir_out,
+                                   args.format, args.cache_dir, stem)
+                   for path, stem in zip(args.files_in,
+                                         get_stems(args.files_in))]
+        for future in futures:
+            for path_out in future.result():
+                print(path_out)
 
     return 0
 
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+
+import hashlib
+import os
+import time
+
+from contextlib import suppress
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import argparse
+
+# Suffix of the cache entry files
+ENTRY_SUFFIX = '.bin'
+# Prefix of the temporary files, which are renamed to entry files when
+# complete
+TMP_PREFIX = '.tmp-'
+# Temporary files older than this (in seconds) are considered leftovers of
+# crashed processes, and deleted during the eviction
+TMP_MAX_AGE = 60 * 60
+
+
+def get_version() -> str:
+    '''
+    Returns a fingerprint of the code of the investats packages, to be used as
+    part of the cache keys. It changes with the version, and even with local
+    modifications of the code. It is much faster than looking up the
+    installed package metadata
+    '''
+    import glob
+
+    h = hashlib.sha256()
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    for file in sorted(glob.glob(os.path.join(root, 'investats*', '*.py'))):
+        with open(file, 'rb') as f:
+            h.update(f.read())
+
+    return h.hexdigest()
+
+
+def get_local_zone() -> str:
+    '''
+    Returns a fingerprint of the local timezone of the process, which is used
+    to interpret the naive datetimes, to be used as part of the cache keys
+    '''
+    return repr((os.environ.get('TZ'), time.tzname, time.timezone,
+                 time.altzone))
+
+
+def make_key(*parts: bytes | str) -> str:
+    '''
+    Returns the SHA-256 hex digest of some parts. Each part is prefixed with
+    its length, so that different sequences of parts cannot collide
+    '''
+    h = hashlib.sha256()
+
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode('utf-8')
+        h.update(len(part).to_bytes(8, 'little'))
+        h.update(part)
+
+    return h.hexdigest()
+
+
+class Cache:
+    '''
+    Content-addressed on-disk cache, which can be used by multiple processes
+    concurrently: the entries are written to temporary files and then
+    atomically renamed, and the modification time of each entry records its
+    last access, for the LRU (Least Recently Used) eviction
+    '''
+
+    def __init__(self, path: str, max_size: int) -> None:
+        os.makedirs(path, exist_ok=True)
+
+        self.path = path
+        # Max total size (in bytes) of the entries
+        self.max_size = max_size
+
+    def get_file(self, key: str) -> str:
+        '''
+        Returns the path of the file of an entry
+        '''
+        return os.path.join(self.path, key + ENTRY_SUFFIX)
+
+    def get(self, key: str) -> bytes | None:
+        '''
+        Returns the data of an entry, or None if it is missing
+        '''
+        file = self.get_file(key)
+
+        # The entry can be evicted by another process at any time
+        try:
+            with open(file, 'rb') as f:
+                data = f.read()
+            os.utime(file)
+        except FileNotFoundError:
+            return None
+
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        '''
+        Stores the data of an entry, and then evicts the least recently used
+        entries if needed
+        '''
+        import tempfile
+
+        fd, tmp = tempfile.mkstemp(dir=self.path, prefix=TMP_PREFIX)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, self.get_file(key))
+        except BaseException:
+            with suppress(FileNotFoundError):
+                os.unlink(tmp)
+            raise
+
+        self.evict()
+
+    def evict(self) -> None:
+        '''
+        Deletes the least recently used entries until their total size is
+        within the limit, and the stale temporary files
+        '''
+        entries = []
+        tmp_min_mtime = time.time() - TMP_MAX_AGE
+
+        with os.scandir(self.path) as it:
+            for e in it:
+                # Other processes can delete the files at any time
+                try:
+                    st = e.stat()
+                except FileNotFoundError:
+                    continue
+
+                if e.name.endswith(ENTRY_SUFFIX):
+                    entries.append((st.st_mtime_ns, st.st_size, e.path))
+                elif e.name.startswith(TMP_PREFIX) \
+                        and st.st_mtime < tmp_min_mtime:
+                    with suppress(FileNotFoundError):
+                        os.unlink(e.path)
+
+        total = sum(size for _, size, _ in entries)
+
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            with suppress(FileNotFoundError):
+                os.unlink(path)
+            total -= size
+
+
+def add_arguments(parser: 'argparse.ArgumentParser') -> None:
+    '''
+    Adds the cache-related arguments to an argument parser
+    '''
+    parser.add_argument('--cache-dir', type=str, default='',
+                        help='If specified, caches the results in this '
+                        'directory, keyed on the content of the input files, '
+                        'the options and the version of investats')
+    parser.add_argument('--cache-size', type=int, default=256,
+                        help='Max total size (in MiB) of the cache entries '
+                        '(default: %(default)s)')
+
+
+def from_args(args: 'argparse.Namespace') -> Cache | None:
+    '''
+    Returns the cache requested with the arguments added by add_arguments, or
+    None if caching is disabled
+    '''
+    if args.cache_dir == '':
+        return None
+
+    return Cache(args.cache_dir, args.cache_size * 1024 * 1024)
+
+
+def args_key(args: 'argparse.Namespace', exclude: tuple[str, ...]) -> str:
+    '''
+    Returns a string representation of the arguments that can affect the
+    results, i.e. all of them except the excluded ones and the ones added by
+    add_arguments and investats.timings.add_arguments
+    '''
+    exclude += ('cache_dir', 'cache_size', 'timings', 'timings_fmt',
+                'profile')
+
+    return repr(sorted((k, v) for k, v in vars(args).items()
+                       if k not in exclude))
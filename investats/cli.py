@@ -1,15 +1,18 @@
 #!/usr/bin/env python3
 
-import argparse
 import sys
 
-from collections.abc import Iterator
+from array import array
+from collections import deque
+from collections.abc import Iterable, Iterator
 from contextlib import ExitStack
 from datetime import date
 from datetime import datetime as dt
-from typing import Any, TextIO
+from itertools import chain
+from typing import TYPE_CHECKING, Any, TextIO
 
-import yaml
+if TYPE_CHECKING:
+    from investats_gen import Freq
 
 
 # Src: https://github.com/dmotte/misc/tree/main/snippets
@@ -33,17 +36,28 @@ def load_data(file: TextIO) -> list[dict]:
     '''
     Loads data from a YAML file
     '''
-    data = yaml.safe_load(file)
-
-    if data[0]['type'] != 'invest':
-        raise ValueError('The first entry must be of type "invest"')
+    import yaml
 
     # YAML supports parsing dates out of the box if they are in the correct
     # format (ISO-8601). See
     # https://symfony.com/doc/current/components/yaml/yaml_format.html#dates
 
+    return validate_data(yaml.safe_load(file))
+
+
+def validate_data(data: list[dict], from_start: bool = True) -> list[dict]:
+    '''
+    Validates the entries of a ledger, converting their datetimes to
+    timezone-aware datetime objects in place. If from_start is false, the
+    entries are allowed to be a slice of a ledger not starting from the first
+    entry
+    '''
+    if from_start and data[0]['type'] != 'invest':
+        raise ValueError('The first entry must be of type "invest"')
+
     for entry in data:
-        if not entry['type'] in ('invest', 'chkpt'):
+        if not entry['type'] in ('invest', 'sell', 'fee', 'dividend',
+                                 'chkpt'):
             raise ValueError('Invalid entry type: ' + str(entry['type']))
 
         if not isinstance(entry['datetime'], dt):
@@ -56,7 +70,7 @@ def load_data(file: TextIO) -> list[dict]:
         if not is_aware(entry['datetime']):
             entry['datetime'] = entry['datetime'].astimezone()
 
-        if entry['type'] == 'invest' and not any((
+        if entry['type'] in ('invest', 'sell') and not any((
             'inv_src' not in entry and 'inv_dst' in entry and 'rate' in entry,
             'inv_src' in entry and 'inv_dst' not in entry and 'rate' in entry,
             'inv_src' in entry and 'inv_dst' in entry and 'rate' not in entry,
@@ -64,12 +78,17 @@ def load_data(file: TextIO) -> list[dict]:
             raise ValueError('Invalid entry ' + str(entry) + ': exactly two '
                              'values among "inv_src", "inv_dst" and "rate" '
                              'must be provided for each entry of '
-                             'type "invest"')
+                             'type "invest" or "sell"')
+
+        if entry['type'] in ('fee', 'dividend') and 'amount_src' not in entry:
+            raise ValueError('Invalid entry ' + str(entry) + ': the '
+                             '"amount_src" value must be provided for each '
+                             'entry of type "fee" or "dividend"')
 
     for i in range(1, len(data)):
         prev, curr = data[i - 1], data[i]
 
-        if prev['type'] == 'invest':
+        if prev['type'] != 'chkpt':
             if prev['datetime'] > curr['datetime']:
                 raise ValueError('Invalid entry order: ' +
                                  str(prev['datetime']) + ' > ' +
@@ -83,6 +102,97 @@ def load_data(file: TextIO) -> list[dict]:
     return data
 
 
+def generate_checkpoints(spec: str, dt_first: dt) -> Iterator[dt]:
+    '''
+    Lazily generates the datetimes of a schedule of checkpoints after
+    dt_first. The spec can be a calendar period (see the investats_gen.Freq
+    class), meaning a checkpoint at the start of each period (i.e. at the end
+    of the previous one), or a comma-separated list of dates in YYYY-MM-DD
+    format. The datetimes are considered local, like the ones of the entries
+    '''
+    from investats_gen import Freq
+
+    if spec in tuple(Freq):
+        freq = Freq(spec)
+        d = freq.floor(dt_first.date())
+        while True:
+            d = freq.next(d)
+            yield dt.combine(d, dt.min.time()).astimezone()
+
+    prev = None
+    for x in spec.split(','):
+        try:
+            curr = dt.combine(date.fromisoformat(x), dt.min.time())
+        except ValueError:
+            raise ValueError('Invalid checkpoints: ' + spec) from None
+        curr = curr.astimezone()
+
+        if prev is not None and prev >= curr:
+            raise ValueError('Invalid checkpoint order: ' + str(prev) +
+                             ' >= ' + str(curr))
+        prev = curr
+
+        if curr >= dt_first:
+            yield curr
+
+
+def merge_checkpoints(data: Iterable[dict],
+                      spec: str) -> Iterator[dict]:
+    '''
+    Merges virtual checkpoints, with the schedule given by spec (see
+    generate_checkpoints), into a stream of validated entries, in a single
+    pass. Each virtual checkpoint is placed after all the entries with the
+    same datetime, unless there is already a checkpoint there, and the ones
+    after the last entry are not emitted
+    '''
+    schedule, next_chkpt = None, None
+
+    for entry in data:
+        if schedule is None:
+            schedule = generate_checkpoints(spec, entry['datetime'])
+            next_chkpt = next(schedule, None)
+
+        while next_chkpt is not None and next_chkpt <= entry['datetime']:
+            if next_chkpt < entry['datetime']:
+                yield {'datetime': next_chkpt, 'type': 'chkpt'}
+            elif entry['type'] != 'chkpt':
+                break
+            next_chkpt = next(schedule, None)
+
+        yield entry
+
+
+def load_prices(file: TextIO) -> Iterator[tuple[dt, float]]:
+    '''
+    Lazily loads a series of DST/SRC rates (e.g. market prices) from a CSV
+    file, with the "datetime" and "rate" fields, as (datetime, rate) pairs.
+    Naive datetimes are considered local
+    '''
+    import csv
+
+    from dateutil import parser as dup
+
+    reader = csv.DictReader(file)
+
+    if reader.fieldnames is None or 'datetime' not in reader.fieldnames \
+            or 'rate' not in reader.fieldnames:
+        raise ValueError('The prices file must have the "datetime" and '
+                         '"rate" fields')
+
+    prev = None
+    for x in reader:
+        d = dup.parse(x['datetime'])
+        if not is_aware(d):
+            d = d.astimezone()
+
+        if prev is not None and prev >= d:
+            raise ValueError('Invalid price order: ' + str(prev) + ' >= ' +
+                             str(d))
+        prev = d
+
+        yield d, float(x['rate'])
+
+
 def save_data(data: list[dict], file: TextIO, fmt_days: str = '',
               fmt_src: str = '', fmt_dst: str = '', fmt_rate: str = '',
               fmt_yield: str = '') -> None:
@@ -124,161 +234,749 @@ def save_data(data: list[dict], file: TextIO, fmt_days: str = '',
         'tot_gain_net_src': func_src,
     }
 
+    # Optional fields, which are saved only if present in the data
+    fields_opt = {
+        'diff_realized_src': func_src,
+        'tot_realized_src': func_src,
+
+        'tot_fees_src': func_src,
+        'tot_dividends_src': func_src,
+
+        'xirr': func_yield,
+
+        'twr': func_yield,
+        'max_tot_dst_as_src': func_src,
+        'drawdown': func_yield,
+        'max_drawdown': func_yield,
+        'drawdown_days': func_days,
+        'max_drawdown_days': func_days,
+    }
+
+    data = iter(data)
+    first = next(data, None)
+    if first is not None:
+        fields |= {k: f for k, f in fields_opt.items() if k in first}
+        # Fields added by rolling_stats
+        fields |= {k: func_src if k.endswith('_src') else func_yield
+                   for k in first.keys() if k.startswith('roll_')}
+        data = chain((first,), data)
+
     print(','.join(fields.keys()), file=file)
     for x in data:
-        print(','.join(f(normlz_num(x[k])) for k, f in fields.items()),
-              file=file)
+        print(','.join('' if x[k] is None else f(normlz_num(x[k]))
+                       for k, f in fields.items()), file=file)
+
+
+def complete_invest_values(entry: dict) -> tuple[float, float, float]:
+    '''
+    Returns the inv_src, inv_dst and rate values of an entry of type "invest"
+    (or "sell"), calculating the missing one from the others. Unlike
+    complete_invest_entry, the entry is not copied
+    '''
+    if 'inv_src' not in entry:
+        inv_dst, rate = entry['inv_dst'], entry['rate']
+        return inv_dst * rate, inv_dst, rate
+    if 'inv_dst' not in entry:
+        inv_src, rate = entry['inv_src'], entry['rate']
+        return inv_src, 0 if rate == 0 else inv_src / rate, rate
+    if 'rate' not in entry:
+        inv_src, inv_dst = entry['inv_src'], entry['inv_dst']
+        return inv_src, inv_dst, 0 if inv_dst == 0 else inv_src / inv_dst
+    return entry['inv_src'], entry['inv_dst'], entry['rate']
 
 
 def complete_invest_entry(entry_in: dict) -> dict:
     '''
-    Complete an entry of type "invest" with the missing fields that can be
-    calculated from the others
+    Complete an entry of type "invest" (or "sell") with the missing fields
+    that can be calculated from the others
     '''
     entry_out = entry_in.copy()
 
-    if 'inv_src' not in entry_out:
-        entry_out['inv_src'] = entry_out['inv_dst'] * entry_out['rate']
-    elif 'inv_dst' not in entry_out:
-        entry_out['inv_dst'] = 0 if entry_out['rate'] == 0 else \
-            entry_out['inv_src'] / entry_out['rate']
-    elif 'rate' not in entry_out:
-        entry_out['rate'] = 0 if entry_out['inv_dst'] == 0 else \
-            entry_out['inv_src'] / entry_out['inv_dst']
+    entry_out['inv_src'], entry_out['inv_dst'], entry_out['rate'] = \
+        complete_invest_values(entry_in)
 
     return entry_out
 
 
-def compute_stats(data: list[dict]) -> Iterator[dict[str, Any]]:
+def solve_xirr(times: list[float], amounts: list[float], guess: float = 0.1,
+               tol: float = 1e-12, max_iter: int = 50) -> float | None:
+    '''
+    Computes the XIRR (i.e. the annual rate for which the net present value
+    is zero) of some cash flows, where amounts[i] happens at times[i] (in
+    years). Uses the Newton-Raphson method starting from guess, with
+    bisection as a fallback. Returns None if there is no solution
+    '''
+    if len(times) < 2 or min(times) == max(times):
+        return None
+
+    def npv(rate: float) -> tuple[float, float]:
+        '''
+        Computes the NPV and its derivative w.r.t. rate, in a single pass
+        '''
+        base = 1 + rate
+        f, df = 0, 0
+        for t, a in zip(times, amounts):
+            v = a * base ** -t
+            f += v
+            df -= t * v / base
+        return f, df
+
+    try:
+        rate = guess
+        for _ in range(max_iter):
+            f, df = npv(rate)
+            if f == 0:
+                return rate
+            if df == 0:
+                break
+
+            rate_next = rate - f / df
+            if rate_next <= -1:
+                # Keep the rate in the valid domain
+                rate_next = (rate - 1) / 2
+
+            if abs(rate_next - rate) < tol:
+                return rate_next
+            rate = rate_next
+    except (OverflowError, ZeroDivisionError):
+        pass
+
+    try:
+        lo, hi = -0.9999, 1
+        f_lo, f_hi = npv(lo)[0], npv(hi)[0]
+        while f_lo * f_hi > 0 and hi < 1e6:
+            hi *= 10
+            f_hi = npv(hi)[0]
+        if f_lo * f_hi > 0:
+            return None
+
+        while hi - lo > tol:
+            mid = (lo + hi) / 2
+            f_mid = npv(mid)[0]
+            if f_lo * f_mid <= 0:
+                hi = mid
+            else:
+                lo, f_lo = mid, f_mid
+        return (lo + hi) / 2
+    except (OverflowError, ZeroDivisionError):
+        return None
+
+
+class LotQueue:
+    '''
+    Lots of DST held, used to compute the cost basis of the DST sold according
+    to a lot method: "fifo", "lifo" or "avg" (average cost). Each lot is
+    added and removed at most once, so the cost is linear in the number of
+    operations, even with many partial sells
+    '''
+
+    __slots__ = ('method', 'lots_dst', 'lots_src', 'head', 'tot_dst',
+                 'tot_src')
+
+    METHODS = ('fifo', 'lifo', 'avg')
+
+    def __init__(self, method: str = 'fifo') -> None:
+        if method not in self.METHODS:
+            raise ValueError('Invalid lot method: ' + str(method))
+
+        self.method = method
+
+        # DST and SRC values of the lots, stored as two parallel arrays of
+        # floats (much more compact than one object per lot), so that they can
+        # be partially sold in place. Not used with the "avg" method
+        self.lots_dst, self.lots_src = array('d'), array('d')
+        # Index of the first lot not sold yet (always zero with the "lifo"
+        # method)
+        self.head = 0
+
+        self.tot_dst, self.tot_src = 0, 0
+
+    def buy(self, dst: float, src: float) -> None:
+        '''
+        Adds a lot of dst DST, bought for src SRC
+        '''
+        if self.method != 'avg':
+            self.lots_dst.append(dst)
+            self.lots_src.append(src)
+        self.tot_dst += dst
+        self.tot_src += src
+
+    def sell(self, dst: float) -> float:
+        '''
+        Removes dst DST from the lots, and returns their cost basis in SRC
+        '''
+        # A small tolerance is needed because of the rounding errors
+        if dst - self.tot_dst > 1e-9 * max(1, abs(self.tot_dst)):
+            raise ValueError('Cannot sell more DST than held: ' + str(dst) +
+                             ' > ' + str(self.tot_dst))
+
+        lots_dst, lots_src = self.lots_dst, self.lots_src
+        cost, left = 0, dst
+
+        if self.method == 'avg':
+            cost = 0 if self.tot_dst == 0 \
+                else dst * self.tot_src / self.tot_dst
+        elif self.method == 'fifo':
+            i, n = self.head, len(lots_dst)
+            while left > 0 and i < n:
+                if lots_dst[i] <= left:
+                    left -= lots_dst[i]
+                    cost += lots_src[i]
+                    i += 1
+                else:
+                    part = lots_src[i] * left / lots_dst[i]
+                    lots_dst[i] -= left
+                    lots_src[i] -= part
+                    cost += part
+                    left = 0
+
+            # The sold lots are deleted once they are at least half of the
+            # arrays, so that the memory stays proportional to the lots held
+            # and the total cost stays linear
+            if i * 2 >= n:
+                del lots_dst[:i], lots_src[:i]
+                i = 0
+            self.head = i
+        else:
+            while left > 0 and lots_dst:
+                if lots_dst[-1] <= left:
+                    left -= lots_dst.pop()
+                    cost += lots_src.pop()
+                else:
+                    part = lots_src[-1] * left / lots_dst[-1]
+                    lots_dst[-1] -= left
+                    lots_src[-1] -= part
+                    cost += part
+                    left = 0
+
+        self.tot_dst -= dst
+        self.tot_src -= cost
+
+        return cost
+
+
+def compute_twr_fields(entry_out: dict, prev_out: dict | None) -> None:
+    '''
+    Adds the time-weighted return and drawdown fields to an output entry,
+    incrementally w.r.t. the previous output entry. Works with the output of
+    both compute_stats and investats_aggr.aggregate_series
+    '''
+    # - entry_out['twr']: cumulative time-weighted return, obtained by
+    #   chaining the chkpt_yield values
+    # - entry_out['max_tot_dst_as_src']: running maximum of tot_dst_as_src
+    # - entry_out['drawdown']: relative decline of tot_dst_as_src w.r.t.
+    #   max_tot_dst_as_src
+    # - entry_out['max_drawdown']: largest drawdown (i.e. the minimum value)
+    #   so far
+    # - entry_out['drawdown_days']: days passed since max_tot_dst_as_src was
+    #   last reached
+    # - entry_out['max_drawdown_days']: longest drawdown duration so far
+
+    if prev_out is None:
+        entry_out['twr'] = entry_out['chkpt_yield']
+        entry_out['max_tot_dst_as_src'] = entry_out['tot_dst_as_src']
+        entry_out['drawdown_days'] = 0
+    else:
+        entry_out['twr'] = \
+            (1 + prev_out['twr']) * (1 + entry_out['chkpt_yield']) - 1
+
+        if entry_out['tot_dst_as_src'] >= prev_out['max_tot_dst_as_src']:
+            entry_out['max_tot_dst_as_src'] = entry_out['tot_dst_as_src']
+            entry_out['drawdown_days'] = 0
+        else:
+            entry_out['max_tot_dst_as_src'] = prev_out['max_tot_dst_as_src']
+            entry_out['drawdown_days'] = \
+                prev_out['drawdown_days'] + entry_out['diff_days']
+
+    entry_out['drawdown'] = 0 if entry_out['max_tot_dst_as_src'] == 0 \
+        else entry_out['tot_dst_as_src'] / entry_out['max_tot_dst_as_src'] - 1
+
+    if prev_out is None:
+        entry_out['max_drawdown'] = entry_out['drawdown']
+        entry_out['max_drawdown_days'] = entry_out['drawdown_days']
+    else:
+        entry_out['max_drawdown'] = \
+            min(prev_out['max_drawdown'], entry_out['drawdown'])
+        entry_out['max_drawdown_days'] = \
+            max(prev_out['max_drawdown_days'], entry_out['drawdown_days'])
+
+
+class ChkptTotals:
     '''
-    Computes the statistics
+    Totals of the last checkpoint, which the statistics of the next one are
+    computed from. Used by compute_stats to keep its state compact, instead
+    of reading it back from the previous output entry
     '''
-    prev_out = None
 
-    diff_src, diff_dst, latest_rate = 0, 0, 0
+    __slots__ = ('datetime', 'tot_days', 'tot_src', 'tot_dst', 'latest_rate',
+                 'tot_dst_as_src', 'latest_cgt')
+
+    def __init__(self, entry: dict | None = None) -> None:
+        for k in self.__slots__:
+            setattr(self, k, None if entry is None else entry[k])
+
+
+def compute_stats(data: list[dict], prev_out: dict | None = None,
+                  xirr: bool = False, twr: bool = False,
+                  lot_method: str = 'fifo', realized: bool = False,
+                  fees_dividends: bool = False,
+                  prices: Iterable[tuple[dt, float]] | None = None
+                  ) -> Iterator[dict[str, Any]]:
+    '''
+    Computes the statistics. If prev_out is specified, the computation is
+    resumed right after it, so it must be the last output entry computed from
+    the input entries preceding data. If xirr is true, the XIRR is computed
+    too, at every checkpoint over all the cash flows so far: its cost is
+    O(flows * checkpoints), i.e. quadratic for ledgers with a checkpoint per
+    operation, so it should be enabled only when needed. If twr is true, the time-weighted return and drawdown fields are
+    computed too (see compute_twr_fields). The cost basis of the DST sold
+    is computed according to lot_method (see LotQueue). If realized is true,
+    the realized gain fields are computed too. If fees_dividends is true, the
+    total fees and dividends fields are computed too. If prices is specified,
+    as (datetime, rate) pairs sorted by datetime, the DST is valued at each
+    checkpoint using the latest of them at or before it, unless there is a
+    more recent operation. The prices are consumed together with the entries
+    (as-of join), so they are read only once
+    '''
+    if xirr and prev_out is not None:
+        raise ValueError('The computation of the XIRR cannot be resumed')
+
+    # Totals of the last checkpoint, if any
+    prev = None if prev_out is None else ChkptTotals(prev_out)
+
+    diff_src, diff_dst = 0, 0
+    latest_rate = 0 if prev_out is None else prev_out['latest_rate']
+    # Datetime of the operation or price which latest_rate comes from
+    dt_rate = None if prev_out is None else prev_out['datetime']
+
+    # Cursor of the prices: the next price not yet consumed
+    if prices is not None:
+        prices = iter(prices)
+        next_price = next(prices, None)
+
+    # Change of tot_src (i.e. invested SRC minus the cost basis of the DST
+    # sold), realized gain, fees and dividends since the last checkpoint
+    diff_cost_src, diff_realized_src = 0, 0
+    diff_fees_src, diff_dividends_src = 0, 0
+
+    # The lots bought before prev_out are unknown, but with the average cost
+    # method the totals are enough
+    lots, untracked_dst = LotQueue(lot_method), 0
+    if prev_out is None:
+        tot_realized_src, tot_fees_src, tot_dividends_src = 0, 0, 0
+    else:
+        if lot_method == 'avg':
+            lots.buy(prev_out['tot_dst'], prev_out['tot_src'])
+        else:
+            untracked_dst = prev_out['tot_dst']
+        # The totals missing from prev_out are included in tot_realized_src,
+        # so that tot_gain_src stays correct anyway
+        tot_fees_src = prev_out.get('tot_fees_src', 0)
+        tot_dividends_src = prev_out.get('tot_dividends_src', 0)
+        tot_realized_src = prev_out['tot_gain_src'] - \
+            (prev_out['tot_dst_as_src'] - prev_out['tot_src']) - \
+            tot_dividends_src + tot_fees_src
+
+    # Cash flows for the XIRR computation: times (in years since the first
+    # investment) and amounts (negative for investments)
+    flows_t, flows_a, dt_first = [], [], None
+    # Starting point of the XIRR computation, i.e. the last solution found
+    xirr_guess = 0.1
 
     for entry_in in data:
         # - entry_in['datetime']: date and time of the entry (timezone-aware)
-        # - entry_in['type']: can be "invest" or "chkpt" (checkpoint)
+        # - entry_in['type']: can be "invest", "sell", "fee", "dividend" or
+        #   "chkpt" (checkpoint)
         # - entry_in['notes']: notes (optional)
 
-        if entry_in['type'] == 'invest':
-            entry_in = complete_invest_entry(entry_in)
+        entry_type = entry_in['type']
+
+        if entry_type == 'invest':
+            # The missing value is calculated without copying the entry, to
+            # avoid allocations on the hot path
+            inv_src, inv_dst, latest_rate = complete_invest_values(entry_in)
+            dt_rate = entry_in['datetime']
 
             # - entry_in['inv_src']: invested SRC
             # - entry_in['inv_dst']: invested DST
             # - entry_in['rate']: current SRC/DST rate
 
-            diff_src += entry_in['inv_src']
-            diff_dst += entry_in['inv_dst']
-            latest_rate = entry_in['rate']
-        elif entry_in['type'] == 'chkpt':
-            entry_out = {}
+            diff_src += inv_src
+            diff_dst += inv_dst
+            diff_cost_src += inv_src
+
+            # Investments of negative amounts are not tracked as lots
+            if inv_dst > 0:
+                lots.buy(inv_dst, inv_src)
+
+            if xirr:
+                if dt_first is None:
+                    dt_first = entry_in['datetime']
+                flows_t.append((entry_in['datetime'] - dt_first)
+                               .total_seconds() / 60 / 60 / 24 / 365)
+                flows_a.append(-inv_src)
+        elif entry_type == 'sell':
+            inv_src, inv_dst, latest_rate = complete_invest_values(entry_in)
+            dt_rate = entry_in['datetime']
+
+            # - entry_in['inv_src']: obtained SRC (for entries of type "sell")
+            # - entry_in['inv_dst']: sold DST (for entries of type "sell")
+
+            if untracked_dst > 0 and (lot_method == 'fifo'
+                                      or lots.tot_dst < inv_dst):
+                raise ValueError('The computation of the ' + lot_method +
+                                 ' lots cannot be resumed')
+
+            cost_src = lots.sell(inv_dst)
+
+            diff_src -= inv_src
+            diff_dst -= inv_dst
+            diff_cost_src -= cost_src
+            diff_realized_src += inv_src - cost_src
+
+            if xirr:
+                flows_t.append((entry_in['datetime'] - dt_first)
+                               .total_seconds() / 60 / 60 / 24 / 365)
+                flows_a.append(inv_src)
+        elif entry_type in ('fee', 'dividend'):
+            # - entry_in['amount_src']: paid SRC (for entries of type "fee")
+            #   or received SRC (for entries of type "dividend")
+
+            amount_src = entry_in['amount_src']
+
+            if entry_type == 'fee':
+                diff_fees_src += amount_src
+            else:
+                diff_dividends_src += amount_src
+
+            if xirr:
+                flows_t.append((entry_in['datetime'] - dt_first)
+                               .total_seconds() / 60 / 60 / 24 / 365)
+                flows_a.append(-amount_src if entry_type == 'fee'
+                               else amount_src)
+        elif entry_type == 'chkpt':
+            if prices is not None:
+                # The prices up to the checkpoint are consumed, and the
+                # latest of them replaces latest_rate if it is more recent
+                price = None
+                while next_price is not None and \
+                        next_price[0] <= entry_in['datetime']:
+                    price, next_price = next_price, next(prices, None)
+
+                if price is not None and (dt_rate is None
+                                          or price[0] >= dt_rate):
+                    dt_rate, latest_rate = price
+
+            dt_chkpt = entry_in['datetime']
+
+            # The fields are computed into local variables, and the output
+            # entry is built only once at the end, since it's the public view
+            # of the statistics
 
             # - entry_out['datetime']: same date and time of the checkpoint
 
-            entry_out['datetime'] = entry_in['datetime']
-
             # - entry_out['diff_days']: days passed since the last checkpoint
             # - entry_out['tot_days']: days passed since the first checkpoint
 
-            if prev_out is None:
-                entry_out['diff_days'] = 0
-                entry_out['tot_days'] = 0
+            if prev is None:
+                diff_days, tot_days = 0, 0
             else:
-                entry_out['diff_days'] = (
-                    entry_out['datetime'] - prev_out['datetime']
-                ).total_seconds() / 60 / 60 / 24
-                entry_out['tot_days'] = prev_out['tot_days'] + \
-                    entry_out['diff_days']
+                diff_days = (dt_chkpt - prev.datetime) \
+                    .total_seconds() / 60 / 60 / 24
+                tot_days = prev.tot_days + diff_days
 
             # - entry_out['diff_src']: invested SRC since the last checkpoint
+            #   (net of the SRC obtained by selling)
             # - entry_out['diff_dst']: invested DST since the last checkpoint
+            #   (net of the DST sold)
             # - entry_out['latest_rate']: latest SRC/DST rate (at the latest
-            #   operation)
-
-            entry_out['diff_src'], entry_out['diff_dst'] = diff_src, diff_dst
-            entry_out['latest_rate'] = latest_rate
+            #   operation, or price if more recent)
 
-            # - entry_out['tot_src']: total invested SRC
-            # - entry_out['tot_dst']: total invested DST
+            # - entry_out['tot_src']: total invested SRC (net of the cost
+            #   basis of the DST sold)
+            # - entry_out['tot_dst']: total invested DST (net of the DST sold)
             # - entry_out['avg_rate']: ratio between tot_src and tot_dst
 
-            if prev_out is None:
-                entry_out['tot_src'] = diff_src
-                entry_out['tot_dst'] = diff_dst
+            if prev is None:
+                tot_src, tot_dst = diff_cost_src, diff_dst
             else:
-                entry_out['tot_src'] = prev_out['tot_src'] + diff_src
-                entry_out['tot_dst'] = prev_out['tot_dst'] + diff_dst
+                tot_src = prev.tot_src + diff_cost_src
+                tot_dst = prev.tot_dst + diff_dst
 
-            entry_out['avg_rate'] = 0 if entry_out['tot_dst'] == 0 \
-                else entry_out['tot_src'] / entry_out['tot_dst']
+            avg_rate = 0 if tot_dst == 0 else tot_src / tot_dst
 
             # - entry_out['tot_dst_as_src']: how many SRC would be obtained by
             #   converting tot_dst using latest_rate
 
-            entry_out['tot_dst_as_src'] = entry_out['tot_dst'] * latest_rate
+            tot_dst_as_src = tot_dst * latest_rate
 
             # - entry_out['chkpt_yield']: yield w.r.t. the last checkpoint
             # - entry_out['chkpt_apy']: APY w.r.t. the last checkpoint
 
-            entry_out['chkpt_yield'] = 0 if prev_out is None \
-                or prev_out['latest_rate'] == 0 \
-                else latest_rate / prev_out['latest_rate'] - 1
+            chkpt_yield = 0 if prev is None or prev.latest_rate == 0 \
+                else latest_rate / prev.latest_rate - 1
 
-            entry_out['chkpt_apy'] = 0 if entry_out['chkpt_yield'] == 0 \
-                or entry_out['diff_days'] == 0 \
-                else (1 + entry_out['chkpt_yield']) ** \
-                (365 / entry_out['diff_days']) - 1
+            chkpt_apy = 0 if chkpt_yield == 0 or diff_days == 0 \
+                else (1 + chkpt_yield) ** (365 / diff_days) - 1
 
             # - entry_out['global_yield']: yield w.r.t. avg_rate
             # - entry_out['global_apy']: APY w.r.t. avg_rate
 
-            entry_out['global_yield'] = 0 if entry_out['avg_rate'] == 0 \
-                else latest_rate / entry_out['avg_rate'] - 1
+            global_yield = 0 if avg_rate == 0 else latest_rate / avg_rate - 1
 
-            entry_out['global_apy'] = 0 if entry_out['global_yield'] == 0 \
-                or entry_out['tot_days'] == 0 \
-                else (1 + entry_out['global_yield']) ** \
-                (365 / entry_out['tot_days']) - 1
+            global_apy = 0 if global_yield == 0 or tot_days == 0 \
+                else (1 + global_yield) ** (365 / tot_days) - 1
 
             # - entry_in['cgt']: Capital Gains Tax
             # - entry_out['latest_cgt']: latest CGT (Capital Gains Tax)
 
-            entry_out['latest_cgt'] = entry_in['cgt'] if 'cgt' in entry_in \
-                else prev_out['latest_cgt'] if prev_out is not None \
+            latest_cgt = entry_in['cgt'] if 'cgt' in entry_in \
+                else prev.latest_cgt if prev is not None \
                 else 0
 
-            # - entry_out['chkpt_gain_src']: gain w.r.t. the last chkpt
+            # - entry_out['chkpt_gain_src']: gain w.r.t. the last chkpt,
+            #   including the dividends and net of the fees
             # - entry_out['chkpt_gain_net_src']: net gain w.r.t. the last chkpt
 
-            if prev_out is None:
-                entry_out['chkpt_gain_src'] = 0
-                entry_out['chkpt_gain_net_src'] = 0
+            if prev is None:
+                chkpt_gain_src, chkpt_gain_net_src = 0, 0
             else:
-                entry_out['chkpt_gain_src'] = entry_out['tot_dst_as_src'] - \
-                    (prev_out['tot_dst_as_src'] + entry_out['diff_src'])
-                entry_out['chkpt_gain_net_src'] = \
-                    entry_out['chkpt_gain_src'] * (1 - entry_out['latest_cgt'])
+                chkpt_gain_src = tot_dst_as_src - \
+                    (prev.tot_dst_as_src + diff_src) + \
+                    diff_dividends_src - diff_fees_src
+                chkpt_gain_net_src = chkpt_gain_src * (1 - latest_cgt)
 
-            # - entry_out['tot_gain_src']: gain w.r.t. tot_src
+            # - entry_out['tot_gain_src']: gain w.r.t. tot_src, including the
+            #   realized gain and the dividends, and net of the fees
             # - entry_out['tot_gain_net_src']: net gain w.r.t. tot_src
 
-            entry_out['tot_gain_src'] = \
-                entry_out['tot_dst_as_src'] - entry_out['tot_src']
-            entry_out['tot_gain_net_src'] = \
-                entry_out['tot_gain_src'] * (1 - entry_out['latest_cgt'])
+            tot_realized_src += diff_realized_src
+            tot_fees_src += diff_fees_src
+            tot_dividends_src += diff_dividends_src
+
+            tot_gain_src = tot_dst_as_src - tot_src + tot_realized_src + \
+                tot_dividends_src - tot_fees_src
+
+            entry_out = {
+                'datetime': dt_chkpt,
+                'diff_days': diff_days,
+                'tot_days': tot_days,
+                'diff_src': diff_src,
+                'diff_dst': diff_dst,
+                'latest_rate': latest_rate,
+                'tot_src': tot_src,
+                'tot_dst': tot_dst,
+                'avg_rate': avg_rate,
+                'tot_dst_as_src': tot_dst_as_src,
+                'chkpt_yield': chkpt_yield,
+                'chkpt_apy': chkpt_apy,
+                'global_yield': global_yield,
+                'global_apy': global_apy,
+                'latest_cgt': latest_cgt,
+                'chkpt_gain_src': chkpt_gain_src,
+                'chkpt_gain_net_src': chkpt_gain_net_src,
+                'tot_gain_src': tot_gain_src,
+                'tot_gain_net_src': tot_gain_src * (1 - latest_cgt),
+            }
+
+            # - entry_out['diff_realized_src']: gain realized by selling
+            #   since the last checkpoint. Only if realized is true
+            # - entry_out['tot_realized_src']: total gain realized by selling.
+            #   Only if realized is true
+
+            if realized:
+                entry_out['diff_realized_src'] = diff_realized_src
+                entry_out['tot_realized_src'] = tot_realized_src
+
+            # - entry_out['tot_fees_src']: total fees paid. Only if
+            #   fees_dividends is true
+            # - entry_out['tot_dividends_src']: total dividends received. Only
+            #   if fees_dividends is true
+
+            if fees_dividends:
+                entry_out['tot_fees_src'] = tot_fees_src
+                entry_out['tot_dividends_src'] = tot_dividends_src
+
+            # - entry_out['xirr']: money-weighted annual return (XIRR) of the
+            #   investments, considering tot_dst_as_src as the final value.
+            #   None if it's not defined (e.g. at the first checkpoint, or
+            #   if the cash flows don't change sign). Only if xirr is true
+
+            if xirr:
+                # The terminal cash flow is added only temporarily, and the
+                # last solution is used as starting point
+                flows_t.append((dt_chkpt - dt_first)
+                               .total_seconds() / 60 / 60 / 24 / 365)
+                flows_a.append(tot_dst_as_src)
+                entry_out['xirr'] = solve_xirr(flows_t, flows_a, xirr_guess)
+                flows_t.pop()
+                flows_a.pop()
+
+                if entry_out['xirr'] is not None:
+                    xirr_guess = entry_out['xirr']
+
+            if twr:
+                compute_twr_fields(entry_out, prev_out)
+                prev_out = entry_out
 
             diff_src, diff_dst = 0, 0
+            diff_cost_src, diff_realized_src = 0, 0
+            diff_fees_src, diff_dividends_src = 0, 0
 
-            prev_out = entry_out
+            if prev is None:
+                prev = ChkptTotals()
+            prev.datetime, prev.tot_days = dt_chkpt, tot_days
+            prev.tot_src, prev.tot_dst = tot_src, tot_dst
+            prev.latest_rate, prev.tot_dst_as_src = latest_rate, tot_dst_as_src
+            prev.latest_cgt = latest_cgt
 
             yield entry_out
         else:
-            raise ValueError('Invalid entry type: ' + str(entry_in['type']))
+            raise ValueError('Invalid entry type: ' + str(entry_type))
+
+
+def resample_stats(data: Iterable[dict],
+                   freq: 'Freq') -> Iterator[dict[str, Any]]:
+    '''
+    Resamples the statistics to coarser calendar periods (see the
+    investats_gen.Freq class), emitting one output entry for each period, in a
+    single pass
+    '''
+    # Fields whose values must be summed within each period (if present, as
+    # some of them are computed only with specific options)
+    KEYS_SUM = ('diff_src', 'diff_dst', 'chkpt_gain_src', 'chkpt_gain_net_src',
+                'diff_realized_src')
+
+    # Reference entry for the computation of the per-period fields. For the
+    # first period it is the first input entry, then it is the last emitted one
+    ref = None
+
+    period, last, sums = None, None, None
+
+    def flush() -> dict[str, Any]:
+        entry_out = last | sums
+
+        # We compute these fields using the same formulas as compute_stats
+
+        # If the period contains only the first input entry, there is nothing
+        # to compare it with
+        is_first = last is ref
+
+        entry_out['diff_days'] = 0 if is_first else (
+            entry_out['datetime'] - ref['datetime']
+        ).total_seconds() / 60 / 60 / 24
+
+        entry_out['chkpt_yield'] = 0 if is_first or ref['latest_rate'] == 0 \
+            else entry_out['latest_rate'] / ref['latest_rate'] - 1
+
+        entry_out['chkpt_apy'] = 0 if entry_out['chkpt_yield'] == 0 \
+            or entry_out['diff_days'] == 0 \
+            else (1 + entry_out['chkpt_yield']) ** \
+            (365 / entry_out['diff_days']) - 1
+
+        return entry_out
+
+    for entry_in in data:
+        if ref is None:
+            ref = entry_in
+
+        entry_period = freq.floor(entry_in['datetime'].date())
+
+        if entry_period != period:
+            if last is not None:
+                ref = flush()
+                yield ref
+
+            period = entry_period
+            sums = {k: 0 for k in KEYS_SUM if k in entry_in}
+
+        for k in sums:
+            sums[k] += entry_in[k]
+        last = entry_in
+
+    if last is not None:
+        yield flush()
+
+
+def rolling_stats(data: Iterable[dict],
+                  windows: list[str]) -> Iterator[dict[str, Any]]:
+    '''
+    Adds rolling-window statistics to the output entries of compute_stats or
+    investats_aggr.aggregate_series, in a single pass. Each window can be
+    expressed in days (e.g. "30d", based on tot_days) or in number of
+    checkpoints (e.g. "12c")
+    '''
+    # For each window: (spec, size, unit, queue of previous entries' states)
+    states = []
+    for spec in windows:
+        size, unit = spec[:-1], spec[-1:]
+        if not size.isdigit() or int(size) == 0 or unit not in ('d', 'c'):
+            raise ValueError('Invalid window: ' + spec)
+        states.append((spec, int(size), unit, deque()))
+
+    # Cumulative values, which allow computing the values related to any
+    # window with a subtraction (or a division), in O(1)
+    cum_index, cum_gain, cum_gain_net = 1, 0, 0
+
+    for entry_in in data:
+        entry_out = entry_in.copy()
+
+        cum_index *= 1 + entry_in['chkpt_yield']
+        cum_gain += entry_in['chkpt_gain_src']
+        cum_gain_net += entry_in['chkpt_gain_net_src']
+
+        curr = (entry_in['tot_days'], cum_index, cum_gain, cum_gain_net)
+
+        for spec, size, unit, queue in states:
+            # - entry_out[f'roll_{spec}_yield']: yield (time-weighted) over
+            #   the window
+            # - entry_out[f'roll_{spec}_apy']: APY over the window
+            # - entry_out[f'roll_{spec}_gain_src']: gain over the window
+            # - entry_out[f'roll_{spec}_gain_net_src']: net gain over the
+            #   window
+            #
+            # Each window starts from a reference entry, which is the latest
+            # one at least "size" days (or checkpoints) before the current one.
+            # If there is no such entry yet, the values are None
+
+            queue.append(curr)
+
+            if unit == 'd':
+                while len(queue) > 1 and \
+                        queue[1][0] <= entry_in['tot_days'] - size:
+                    queue.popleft()
+                ref = queue[0] if queue[0][0] <= entry_in['tot_days'] - size \
+                    else None
+            else:
+                if len(queue) > size + 1:
+                    queue.popleft()
+                ref = queue[0] if len(queue) == size + 1 else None
+
+            if ref is None or ref[1] == 0:
+                entry_out |= {f'roll_{spec}_yield': None,
+                              f'roll_{spec}_apy': None,
+                              f'roll_{spec}_gain_src': None,
+                              f'roll_{spec}_gain_net_src': None}
+                continue
+
+            days = entry_in['tot_days'] - ref[0]
+            yld = cum_index / ref[1] - 1
+
+            entry_out[f'roll_{spec}_yield'] = yld
+            entry_out[f'roll_{spec}_apy'] = 0 if yld == 0 or days == 0 \
+                else (1 + yld) ** (365 / days) - 1
+            entry_out[f'roll_{spec}_gain_src'] = cum_gain - ref[2]
+            entry_out[f'roll_{spec}_gain_net_src'] = cum_gain_net - ref[3]
+
+        yield entry_out
 
 
 def main(argv: list[str] | None = None) -> int:
+    import argparse
+
+    from . import cache as cache_mod
+    from . import compress, timings
+
     if argv is None:
         argv = sys.argv
 
@@ -288,12 +986,14 @@ def main(argv: list[str] | None = None) -> int:
 
     parser.add_argument('file_in', metavar='FILE_IN', type=str,
                         nargs='?', default='-',
-                        help='Input file. If set to "-" then stdin is used '
-                        '(default: %(default)s)')
+                        help='Input file. If set to "-" then stdin is used. '
+                        'Compressed files (gzip, xz or zstd) are detected '
+                        'automatically (default: %(default)s)')
     parser.add_argument('file_out', metavar='FILE_OUT', type=str,
                         nargs='?', default='-',
-                        help='Output file. If set to "-" then stdout is used '
-                        '(default: %(default)s)')
+                        help='Output file. If set to "-" then stdout is used. '
+                        'It is compressed if its name ends with ".gz", ".xz" '
+                        'or ".zst" (default: %(default)s)')
 
     parser.add_argument('--fmt-days', type=str, default='',
                         help='If specified, formats the days values with this '
@@ -311,19 +1011,186 @@ def main(argv: list[str] | None = None) -> int:
                         help='If specified, formats the yield values with this '
                         'format string (e.g. "{:.4f}")')
 
+    parser.add_argument('--xirr', action='store_true',
+                        help='If specified, computes the XIRR (money-weighted '
+                        'return) at each checkpoint. Slow with many '
+                        'checkpoints, because every checkpoint considers all '
+                        'the cash flows so far')
+
+    parser.add_argument('--twr', action='store_true',
+                        help='If specified, computes the time-weighted return '
+                        'and drawdown fields at each checkpoint')
+
+    parser.add_argument('--lot-method', type=str, default='fifo',
+                        choices=LotQueue.METHODS,
+                        help='Method used to compute the cost basis of the '
+                        'DST sold: "fifo", "lifo" or "avg" (average cost) '
+                        '(default: %(default)s)')
+    parser.add_argument('--realized', action='store_true',
+                        help='If specified, computes the realized gain fields '
+                        'at each checkpoint')
+
+    parser.add_argument('--fees-dividends', action='store_true',
+                        help='If specified, computes the total fees and '
+                        'dividends fields at each checkpoint')
+
+    parser.add_argument('--checkpoints', type=str, default='',
+                        help='If specified, adds virtual checkpoints to the '
+                        'entries, at the start of each calendar period '
+                        '("daily", "weekly", "monthly" or "yearly") or at the '
+                        'comma-separated dates in YYYY-MM-DD format')
+
+    parser.add_argument('--prices', type=str, default='',
+                        help='If specified, values the DST at each checkpoint '
+                        'using the latest rate at or before it from this CSV '
+                        'file (with the "datetime" and "rate" fields), unless '
+                        'there is a more recent operation')
+
+    parser.add_argument('--resample', type=str, default='',
+                        choices=('', 'daily', 'weekly', 'monthly', 'yearly'),
+                        help='If specified, resamples the statistics to '
+                        'these calendar periods, emitting one output entry '
+                        'for each period')
+
+    parser.add_argument('--rolling', type=str, default='',
+                        help='If specified, computes rolling-window '
+                        'statistics for these comma-separated windows, in '
+                        'days or checkpoints (e.g. "30d,90d,365d,12c")')
+
+    parser.add_argument('--index', type=str, default='',
+                        help='If specified, builds an index of the output '
+                        'file in this file, to be used with investats_query')
+
+    parser.add_argument('--db', type=str, default='',
+                        help='If specified, reads the entries of the asset '
+                        'specified with --asset from this SQLite database '
+                        'instead of FILE_IN, and updates its stats rows in '
+                        'the database incrementally before outputting them')
+    parser.add_argument('--asset', type=str, default='',
+                        help='Asset name, to be used with --db')
+
+    cache_mod.add_arguments(parser)
+    timings.add_arguments(parser)
+
     args = parser.parse_args(argv[1:])
 
+    if args.index != '' and args.file_out == '-':
+        raise ValueError('The --index option requires an output file')
+    if args.index != '' and compress.is_compressed(args.file_out):
+        raise ValueError('The --index option cannot be used together with '
+                         'a compressed output file')
+
+    cache = cache_mod.from_args(args)
+
+    if args.db != '':
+        if args.asset == '':
+            raise ValueError('The --db option requires the --asset option')
+        if args.file_in != '-':
+            raise ValueError('The --db option cannot be used together with '
+                             'an input file')
+        if cache is not None:
+            raise ValueError('The --db option cannot be used together with '
+                             'the --cache-dir option')
+        if args.checkpoints != '':
+            raise ValueError('The --db option cannot be used together with '
+                             'the --checkpoints option')
+        if args.prices != '':
+            raise ValueError('The --db option cannot be used together with '
+                             'the --prices option')
+
+    kwargs_stats = {'xirr': args.xirr, 'twr': args.twr,
+                    'lot_method': args.lot_method, 'realized': args.realized,
+                    'fees_dividends': args.fees_dividends}
+
     ############################################################################
 
-    with ExitStack() as stack:
+    with timings.instrument(args) as tmg, ExitStack() as stack:
         file_in = (sys.stdin if args.file_in == '-'
-                   else stack.enter_context(open(args.file_in, 'r')))
+                   else stack.enter_context(
+                       compress.open_file(args.file_in, 'r')))
         file_out = (sys.stdout if args.file_out == '-'
-                    else stack.enter_context(open(args.file_out, 'w')))
+                    else stack.enter_context(
+                        compress.open_file(args.file_out, 'w')))
+
+        conn = None
+        if args.db != '':
+            from . import db
+
+            conn = db.connect(args.db)
+            stack.callback(conn.close)
+
+        # The output is cached as a whole, keyed on the input file content
+        # and the options
+        cache_key, text_out = None, None
+        if cache is not None:
+            import io
+
+            with tmg.stage('cache'):
+                raw_in = file_in.buffer.read()
+                raw_prices = b''
+                if args.prices != '':
+                    with compress.open_file(args.prices, 'rb') as f:
+                        raw_prices = f.read()
+                cache_key = cache_mod.make_key(
+                    'investats', cache_mod.get_version(),
+                    cache_mod.get_local_zone(), raw_in, raw_prices,
+                    cache_mod.args_key(args, ('file_in', 'file_out', 'index',
+                                              'prices')))
+                data_cached = cache.get(cache_key)
+
+            if data_cached is not None:
+                text_out = data_cached.decode('utf-8')
+            else:
+                file_in = io.TextIOWrapper(io.BytesIO(raw_in))
 
-        data_in = load_data(file_in)
-        data_out = compute_stats(data_in)
-        save_data(data_out, file_out, args.fmt_days, args.fmt_src, args.fmt_dst,
-                  args.fmt_rate, args.fmt_yield)
+        if text_out is None:
+            if conn is None:
+                with tmg.stage('load') as rec:
+                    data_in = load_data(file_in)
+                    rec['rows'] = len(data_in)
+            else:
+                with tmg.stage('update') as rec:
+                    rec['rows'] = db.update_stats(conn, args.asset,
+                                                  **kwargs_stats)
+
+            with tmg.stage('compute') as rec:
+                if conn is None and args.checkpoints != '':
+                    data_in = merge_checkpoints(data_in, args.checkpoints)
+                prices = None if args.prices == '' \
+                    else load_prices(stack.enter_context(
+                        compress.open_file(args.prices, 'r')))
+                data_out = compute_stats(data_in, **kwargs_stats,
+                                         prices=prices) \
+                    if conn is None else db.load_stats(conn, args.asset)
+                if args.resample != '':
+                    from investats_gen import Freq
+
+                    data_out = resample_stats(data_out, Freq(args.resample))
+                if args.rolling != '':
+                    data_out = rolling_stats(data_out,
+                                             args.rolling.split(','))
+                data_out = tmg.collect(data_out, rec)
+
+        with tmg.stage('save') as rec:
+            if text_out is not None:
+                file_out.write(text_out)
+            elif cache_key is None:
+                save_data(data_out, file_out, args.fmt_days, args.fmt_src,
+                          args.fmt_dst, args.fmt_rate, args.fmt_yield)
+            else:
+                buf = io.StringIO()
+                save_data(data_out, buf, args.fmt_days, args.fmt_src,
+                          args.fmt_dst, args.fmt_rate, args.fmt_yield)
+                file_out.write(buf.getvalue())
+                cache.put(cache_key, buf.getvalue().encode('utf-8'))
+
+        if args.index != '':
+            import investats_query
+
+            file_out.close()
+            with tmg.stage('index') as rec, \
+                    open(args.file_out, 'rb') as f_csv, \
+                    open(args.index, 'wb') as f_idx:
+                rec['rows'] = investats_query.build_index(f_csv, f_idx)
 
     return 0
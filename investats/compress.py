@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import queue
+import threading
+
+from collections.abc import Callable
+from typing import IO, BinaryIO
+
+# Size of the chunks passed between the codec threads and the main thread
+CHUNK_SIZE = 64 * 1024
+# Max number of chunks waiting in each queue. This bounds the memory used,
+# while letting the codec work overlap with the parsing and computation
+QUEUE_SIZE = 16
+
+# For each supported codec: file extension and magic bytes
+CODECS = {
+    'gzip': ('.gz', b'\x1f\x8b'),
+    'xz': ('.xz', b'\xfd7zXZ\x00'),
+    'zstd': ('.zst', b'\x28\xb5\x2f\xfd'),
+}
+
+
+def detect_codec(path: str, head: bytes = b'') -> str | None:
+    '''
+    Detects the codec of a file from the first bytes of its content (if
+    specified) or from its extension. Returns None if the file is not
+    compressed
+    '''
+    for codec, (ext, magic) in CODECS.items():
+        if head.startswith(magic):
+            return codec
+
+    if head == b'':
+        for codec, (ext, magic) in CODECS.items():
+            if path.endswith(ext):
+                return codec
+
+    return None
+
+
+def open_codec(codec: str, file: BinaryIO, mode: str) -> BinaryIO:
+    '''
+    Wraps a binary file object with a codec stream, for reading (mode "rb")
+    or writing (mode "wb")
+    '''
+    if codec == 'gzip':
+        import gzip
+
+        return gzip.GzipFile(fileobj=file, mode=mode)
+
+    if codec == 'xz':
+        import lzma
+
+        return lzma.LZMAFile(file, mode)
+
+    if codec == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError('The zstandard package is required to handle '
+                             'zstd-compressed files') from None
+
+        ctx = zstandard.ZstdDecompressor() if mode == 'rb' \
+            else zstandard.ZstdCompressor()
+        return ctx.stream_reader(file) if mode == 'rb' \
+            else ctx.stream_writer(file)
+
+    raise ValueError('Invalid codec: ' + codec)
+
+
+class ThreadedReader(io.RawIOBase):
+    '''
+    Raw binary stream whose content is read from a source stream by a
+    background thread, through a bounded queue
+    '''
+
+    def __init__(self, source: BinaryIO,
+                 on_close: Callable[[], None] | None = None) -> None:
+        super().__init__()
+
+        self.source = source
+        self.on_close = on_close
+
+        self.queue = queue.Queue(QUEUE_SIZE)
+        self.stop = threading.Event()
+        self.chunk, self.pos, self.eof = b'', 0, False
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self) -> None:
+        '''
+        Body of the background thread. Exceptions are passed to the main
+        thread through the queue
+        '''
+        try:
+            while True:
+                chunk = self.source.read(CHUNK_SIZE)
+                if not self.put(chunk) or chunk == b'':
+                    return
+        except Exception as e:
+            self.put(e)
+
+    def put(self, item: bytes | Exception) -> bool:
+        '''
+        Puts an item into the queue, unless the stream is closed in the
+        meantime. Returns false if it is
+        '''
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buf: bytearray | memoryview) -> int:
+        while self.pos >= len(self.chunk):
+            if self.eof:
+                return 0
+
+            item = self.queue.get()
+            if isinstance(item, Exception):
+                self.eof = True
+                raise item
+            if item == b'':
+                self.eof = True
+                return 0
+
+            self.chunk, self.pos = item, 0
+
+        n = min(len(buf), len(self.chunk) - self.pos)
+        buf[:n] = self.chunk[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+    def close(self) -> None:
+        if self.closed:
+            return
+
+        self.stop.set()
+        self.thread.join()
+        self.source.close()
+        if self.on_close is not None:
+            self.on_close()
+
+        super().close()
+
+
+class ThreadedWriter(io.RawIOBase):
+    '''
+    Raw binary stream whose content is written to a target stream by a
+    background thread, through a bounded queue
+    '''
+
+    def __init__(self, target: BinaryIO,
+                 on_close: Callable[[], None] | None = None) -> None:
+        super().__init__()
+
+        self.target = target
+        self.on_close = on_close
+
+        self.queue = queue.Queue(QUEUE_SIZE)
+        self.error = None
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self) -> None:
+        '''
+        Body of the background thread. The first exception is stored, to be
+        raised by the main thread, and the following chunks are discarded
+        '''
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                return
+            if self.error is not None:
+                continue
+
+            try:
+                self.target.write(chunk)
+            except Exception as e:
+                self.error = e
+
+    def check(self) -> None:
+        '''
+        Raises the exception occurred in the background thread, if any
+        '''
+        if self.error is not None:
+            raise self.error
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, buf: bytes | bytearray | memoryview) -> int:
+        self.check()
+        self.queue.put(bytes(buf))
+        return len(buf)
+
+    def close(self) -> None:
+        if self.closed:
+            return
+
+        self.queue.put(None)
+        self.thread.join()
+
+        try:
+            self.check()
+            self.target.close()
+        finally:
+            if self.on_close is not None:
+                self.on_close()
+            super().close()
+
+
+def open_file(path: str, mode: str = 'r') -> IO:
+    '''
+    Opens a file like the built-in open function (only the "r", "rb", "w"
+    and "wb" modes are supported), transparently handling compressed files.
+    When reading, the codec is detected from the magic bytes of the file.
+    When writing, it is detected from the extension. The codec work is done
+    in a background thread
+    '''
+    if mode not in ('r', 'rb', 'w', 'wb'):
+        raise ValueError('Invalid mode: ' + mode)
+
+    is_read = mode.startswith('r')
+
+    raw = open(path, 'rb' if is_read else 'wb')
+    try:
+        codec = detect_codec(path, raw.peek(8)[:8] if is_read else b'')
+        if codec is None:
+            raw.close()
+            return open(path, mode)
+
+        if is_read:
+            stream = io.BufferedReader(ThreadedReader(
+                open_codec(codec, raw, 'rb'), raw.close), CHUNK_SIZE)
+        else:
+            stream = io.BufferedWriter(ThreadedWriter(
+                open_codec(codec, raw, 'wb'), raw.close), CHUNK_SIZE)
+    except BaseException:
+        raw.close()
+        raise
+
+    return stream if mode.endswith('b') else io.TextIOWrapper(stream)
+
+
+def is_compressed(path: str) -> bool:
+    '''
+    Returns true if a file would be compressed by open_file in write mode
+    '''
+    return detect_codec(os.path.basename(path)) is not None
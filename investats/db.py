@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+
+import json
+import sqlite3
+
+from collections.abc import Iterable, Iterator
+from datetime import datetime as dt
+from typing import Any
+
+from .cli import compute_stats, is_aware, validate_data
+
+# The entries and the stats rows are stored with their datetime both as a
+# timestamp (for the indexed range queries and the ordering) and as an
+# ISO-8601 string (to preserve the timezone). The other fields are stored as
+# JSON objects. Identical entries (e.g. two equal investments on the same day)
+# are told apart by their occurrence number, i.e. how many identical entries
+# precede them in the same import batch
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS entries (
+    id INTEGER PRIMARY KEY,
+    asset TEXT NOT NULL,
+    ts REAL NOT NULL,
+    datetime TEXT NOT NULL,
+    type TEXT NOT NULL,
+    fields TEXT NOT NULL,
+    occurrence INTEGER NOT NULL,
+    UNIQUE (asset, ts, type, fields, occurrence)
+);
+
+CREATE TABLE IF NOT EXISTS stats (
+    asset TEXT NOT NULL,
+    ts REAL NOT NULL,
+    datetime TEXT NOT NULL,
+    fields TEXT NOT NULL,
+    PRIMARY KEY (asset, ts)
+);
+
+CREATE TABLE IF NOT EXISTS stats_state (
+    asset TEXT PRIMARY KEY,
+    last_entry_id INTEGER NOT NULL,
+    options TEXT NOT NULL
+);
+'''
+
+# Ledger order of the entries: chronological, with the checkpoints after the
+# other entries with the same timestamp (even if they were inserted before
+# them), and then in insertion order
+ORDER_ENTRIES = "ts, CASE type WHEN 'chkpt' THEN 1 ELSE 0 END, id"
+
+
+def connect(path: str) -> sqlite3.Connection:
+    '''
+    Opens a database, creating the tables if needed
+    '''
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def get_assets(conn: sqlite3.Connection) -> list[str]:
+    '''
+    Returns the names of the assets that have some entries
+    '''
+    return [asset for asset, in conn.execute(
+        'SELECT DISTINCT asset FROM entries ORDER BY asset')]
+
+
+def insert_entries(conn: sqlite3.Connection, asset: str,
+                   entries: Iterable[dict]) -> int:
+    '''
+    Inserts some ledger entries of an asset, in the same format as the output
+    of investats.load_data (naive datetimes are considered local). The
+    entries already inserted by a previous batch are ignored, so that the same
+    entries (or a superset of them) can be inserted more than once, while the
+    identical entries within the same batch are all kept. Returns the number
+    of inserted entries
+    '''
+    def rows() -> Iterator[tuple]:
+        # Number of identical entries seen so far in this batch
+        counts = {}
+
+        for entry in entries:
+            d = entry['datetime']
+            if not is_aware(d):
+                d = d.astimezone()
+
+            key = d.timestamp(), entry['type'], \
+                json.dumps({k: v for k, v in entry.items()
+                            if k not in ('datetime', 'type')},
+                           sort_keys=True)
+            occurrence = counts.get(key, 0)
+            counts[key] = occurrence + 1
+
+            yield asset, key[0], d.isoformat(), key[1], key[2], occurrence
+
+    with conn:
+        cur = conn.executemany('INSERT OR IGNORE INTO entries '
+                               '(asset, ts, datetime, type, fields, '
+                               'occurrence) VALUES (?, ?, ?, ?, ?, ?)',
+                               rows())
+        return cur.rowcount
+
+
+def load_entries(conn: sqlite3.Connection, asset: str,
+                 ts_after: float | None = None) -> list[dict]:
+    '''
+    Loads the entries of an asset, in ledger order. If ts_after is specified,
+    only the entries after that timestamp are loaded
+    '''
+    if ts_after is None:
+        cur = conn.execute('SELECT datetime, type, fields FROM entries '
+                           'WHERE asset = ? ORDER BY ' + ORDER_ENTRIES,
+                           (asset,))
+    else:
+        cur = conn.execute('SELECT datetime, type, fields FROM entries '
+                           'WHERE asset = ? AND ts > ? ORDER BY ' +
+                           ORDER_ENTRIES, (asset, ts_after))
+
+    return [{'datetime': dt.fromisoformat(d), 'type': t} | json.loads(f)
+            for d, t, f in cur]
+
+
+def load_stats(conn: sqlite3.Connection,
+               asset: str) -> Iterator[dict[str, Any]]:
+    '''
+    Loads the stats rows of an asset, in chronological order, streaming them
+    from the database
+    '''
+    for d, f in conn.execute('SELECT datetime, fields FROM stats '
+                             'WHERE asset = ? ORDER BY ts', (asset,)):
+        yield {'datetime': dt.fromisoformat(d)} | json.loads(f)
+
+
+def update_stats(conn: sqlite3.Connection, asset: str,
+                 **kwargs: Any) -> int:
+    '''
+    Updates the stats rows of an asset, computed with investats.compute_stats
+    and kwargs as options. Only the checkpoints after the earliest entry
+    inserted since the last update are recomputed, unless the options have
+    changed. Returns the number of (re)computed rows
+    '''
+    options = json.dumps(kwargs, sort_keys=True)
+
+    last_entry_id, = conn.execute('SELECT MAX(id) FROM entries '
+                                  'WHERE asset = ?', (asset,)).fetchone()
+    if last_entry_id is None:
+        raise ValueError('Unknown asset: ' + asset)
+
+    state = conn.execute('SELECT last_entry_id, options FROM stats_state '
+                         'WHERE asset = ?', (asset,)).fetchone()
+
+    # Timestamp and content of the last stats row that is still valid
+    prev_ts, prev_out = None, None
+
+    if state is not None and state[1] == options:
+        earliest_ts, = conn.execute('SELECT MIN(ts) FROM entries '
+                                    'WHERE asset = ? AND id > ?',
+                                    (asset, state[0])).fetchone()
+        if earliest_ts is None:
+            return 0
+
+        row = conn.execute('SELECT ts, datetime, fields FROM stats '
+                           'WHERE asset = ? AND ts < ? '
+                           'ORDER BY ts DESC LIMIT 1',
+                           (asset, earliest_ts)).fetchone()
+        if row is not None:
+            prev_ts = row[0]
+            prev_out = {'datetime': dt.fromisoformat(row[1])} | \
+                json.loads(row[2])
+
+    entries = validate_data(load_entries(conn, asset, prev_ts),
+                            prev_out is None)
+    try:
+        stats = list(compute_stats(entries, prev_out, **kwargs))
+    except ValueError:
+        if prev_out is None:
+            raise
+        # Some computations (e.g. the XIRR) cannot be resumed
+        prev_ts, prev_out = None, None
+        entries = validate_data(load_entries(conn, asset))
+        stats = list(compute_stats(entries, **kwargs))
+
+    with conn:
+        if prev_ts is None:
+            conn.execute('DELETE FROM stats WHERE asset = ?', (asset,))
+        else:
+            conn.execute('DELETE FROM stats WHERE asset = ? AND ts > ?',
+                         (asset, prev_ts))
+
+        conn.executemany('INSERT INTO stats (asset, ts, datetime, fields) '
+                         'VALUES (?, ?, ?, ?)',
+                         ((asset, x['datetime'].timestamp(),
+                           x['datetime'].isoformat(),
+                           json.dumps({k: v for k, v in x.items()
+                                       if k != 'datetime'}))
+                          for x in stats))
+
+        conn.execute('INSERT OR REPLACE INTO stats_state '
+                     '(asset, last_entry_id, options) VALUES (?, ?, ?)',
+                     (asset, last_entry_id, options))
+
+    return len(stats)
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+import sys
+import time
+
+from collections.abc import Iterable, Iterator
+from contextlib import contextmanager, nullcontext
+from typing import TYPE_CHECKING, Any, TextIO
+
+if TYPE_CHECKING:
+    import argparse
+
+
+def get_peak_rss() -> int | None:
+    '''
+    Returns the peak Resident Set Size of the current process in bytes, or
+    None if it cannot be determined on the current platform
+    '''
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # On macOS the value is expressed in bytes, while on Linux in kibibytes
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+class NullTimings:
+    '''
+    Timings collector that does nothing. Used when timings are disabled, so
+    that the instrumentation adds practically no overhead
+    '''
+    enabled = False
+
+    def __init__(self) -> None:
+        self._ctx = nullcontext({})
+
+    def stage(self, name: str) -> nullcontext:
+        '''
+        Returns a context manager that does nothing
+        '''
+        return self._ctx
+
+    def collect(self, data: Iterable, rec: dict[str, Any]) -> Iterable:
+        '''
+        Returns data unchanged, so that lazy iterables stay lazy
+        '''
+        return data
+
+
+class Timings(NullTimings):
+    '''
+    Collects per-stage timing statistics and writes them to a file, either as
+    human-readable text or as JSON lines
+    '''
+    enabled = True
+
+    def __init__(self, file: TextIO, fmt: str = 'text') -> None:
+        super().__init__()
+
+        if fmt not in ('text', 'json'):
+            raise ValueError('Invalid timings format: ' + fmt)
+
+        self.file = file
+        self.fmt = fmt
+
+    def emit(self, rec: dict[str, Any]) -> None:
+        '''
+        Writes a single stage record
+        '''
+        if self.fmt == 'json':
+            import json
+
+            print(json.dumps(rec), file=self.file)
+            return
+
+        line = f'timings: stage={rec["stage"]} ' \
+            f'wall={rec["wall_s"]:.6f}s cpu={rec["cpu_s"]:.6f}s'
+        if rec['rows'] is not None:
+            line += f' rows={rec["rows"]}'
+        if rec['rows_per_s'] is not None:
+            line += f' rows/s={rec["rows_per_s"]:.1f}'
+        if rec['peak_rss'] is not None:
+            line += f' peak_rss={rec["peak_rss"] / 1024 / 1024:.1f}MiB'
+        print(line, file=self.file)
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[dict[str, Any]]:
+        '''
+        Measures the stage executed inside the context. The number of
+        processed rows can be set by the caller via the "rows" key of the
+        yielded dict
+        '''
+        rec = {'stage': name, 'rows': None}
+
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        yield rec
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+
+        rec['wall_s'], rec['cpu_s'] = wall, cpu
+        rec['rows_per_s'] = None if rec['rows'] is None or wall == 0 \
+            else rec['rows'] / wall
+        rec['peak_rss'] = get_peak_rss()
+
+        self.emit(rec)
+
+    def collect(self, data: Iterable, rec: dict[str, Any]) -> list:
+        '''
+        Consumes data into a list, so that its computation is accounted to
+        the current stage, and records the number of rows
+        '''
+        data = list(data)
+        rec['rows'] = len(data)
+        return data
+
+
+def add_arguments(parser: 'argparse.ArgumentParser') -> None:
+    '''
+    Adds the instrumentation-related arguments to an argument parser
+    '''
+    parser.add_argument('--timings', action='store_true',
+                        help='If specified, prints per-stage wall time, CPU '
+                        'time, rows per second and peak RSS to stderr')
+    parser.add_argument('--timings-fmt', type=str, choices=('text', 'json'),
+                        default='text',
+                        help='Format of the timings. If set to "json", they '
+                        'are written as JSON lines (default: %(default)s)')
+    parser.add_argument('--profile', type=str, default='',
+                        help='If specified, dumps cProfile stats of the run '
+                        'to this file')
+
+
+@contextmanager
+def instrument(args: 'argparse.Namespace') -> Iterator[NullTimings]:
+    '''
+    Sets up the instrumentation requested with the arguments added by
+    add_arguments, and yields the timings collector to be used for the stages
+    '''
+    timings = Timings(sys.stderr, args.timings_fmt) if args.timings \
+        else NullTimings()
+
+    if args.profile == '':
+        with timings.stage('total'):
+            yield timings
+        return
+
+    import cProfile
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        with timings.stage('total'):
+            yield timings
+    finally:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
@@ -1,12 +1,25 @@
 #!/usr/bin/env python3
 
-import argparse
-import csv
 import sys
 
-from collections.abc import Callable, Iterator
-from dateutil import parser as dup
-from typing import Any, TextIO
+from bisect import bisect_left, bisect_right
+from collections.abc import Callable, Iterable, Iterator
+from contextlib import ExitStack, closing
+from datetime import datetime as dt
+from typing import TYPE_CHECKING, Any, TextIO
+
+import investats
+
+if TYPE_CHECKING:
+    from concurrent.futures import Executor, Future
+
+    from investats.cache import Cache
+
+# Number of lines of each chunk of a CSV file parsed by prefetch_series
+PARSE_CHUNK_LINES = 10_000
+# Size (in bytes) of the digest of each series entry stored in the state of
+# an aggregation, to detect the changed entries
+DIGEST_SIZE = 8
 
 
 # Src: https://github.com/dmotte/misc/tree/main/snippets
@@ -17,17 +30,19 @@ def normlz_num(x: int | float) -> int | float:
     return int(x) if isinstance(x, float) and x.is_integer() else x
 
 
-def pair_items_to_dict(items: list[str]) -> dict[str, str]:
+def pair_items_to_dict(items: list[str],
+                       min_pairs: int = 2) -> dict[str, str]:
     '''
     Converts a list of (asset name, input file) pairs, specified as a simple
-    array of items, to a Python dictionary
+    array of items, to a Python dictionary. There must be at least min_pairs
+    pairs
     '''
     len_items = len(items)
 
     if len_items % 2 != 0:
         raise ValueError('The length of pair items must be an even number')
-    if len_items < 4:
-        raise ValueError('The number of pairs must be >= 2')
+    if len_items < min_pairs * 2:
+        raise ValueError('The number of pairs must be >= ' + str(min_pairs))
 
     return {items[i]: items[i + 1] for i in range(0, len_items, 2)}
 
@@ -36,20 +51,246 @@ def load_data(file: TextIO) -> Iterator[dict[str, Any]]:
     '''
     Loads data from a CSV file
     '''
+    import csv
+
+    from dateutil import parser as dup
+
+    def parse_dt(x: str) -> dt:
+        '''
+        Parses a datetime, with the same result as decode_series for the
+        ISO-8601 ones (such as the ones written by save_data)
+        '''
+        try:
+            return dt.fromisoformat(x)
+        except ValueError:
+            return dup.parse(x)
+
     data = list(csv.DictReader(file))
 
     float_keys = [k for k in data[0].keys() if k != 'datetime']
 
     for x in data:
-        yield {'datetime': dup.parse(x['datetime'])} | \
-            {k: float(x[k]) for k in float_keys}
+        yield {'datetime': parse_dt(x['datetime'])} | \
+            {k: None if x[k] == '' else float(x[k]) for k in float_keys}
+
+
+class FxSeries:
+    '''
+    Time series of the exchange rate of a currency, to be queried "as of" a
+    datetime (i.e. using the latest rate at or before it). Sequential queries
+    with non-decreasing datetimes are answered by moving a cursor forward, so
+    they cost O(1) amortized; the others fall back to a binary search
+    '''
+
+    __slots__ = ('datetimes', 'rates', 'cursor')
+
+    def __init__(self, datetimes: list[dt], rates: list[float]) -> None:
+        for i in range(1, len(datetimes)):
+            if datetimes[i - 1] >= datetimes[i]:
+                raise ValueError('Invalid FX rate order: ' +
+                                 str(datetimes[i - 1]) + ' >= ' +
+                                 str(datetimes[i]))
+
+        self.datetimes = datetimes
+        self.rates = rates
+
+        # Index of the rate returned by the last query
+        self.cursor = 0
+
+    def rate_at(self, d: dt) -> float:
+        '''
+        Returns the latest rate at or before the datetime d
+        '''
+        datetimes, i = self.datetimes, self.cursor
+
+        if i < len(datetimes) and datetimes[i] <= d:
+            while i + 1 < len(datetimes) and datetimes[i + 1] <= d:
+                i += 1
+        else:
+            i = bisect_right(datetimes, d) - 1
+            if i < 0:
+                raise ValueError('No FX rate available at ' + str(d))
+
+        self.cursor = i
+        return self.rates[i]
+
+
+def load_fx(file: TextIO) -> dict[str, FxSeries]:
+    '''
+    Loads the exchange rates from a CSV file, with a "datetime" field and one
+    field for each currency, containing the value of one unit of it in the
+    aggregation currency. Empty values are skipped, and naive datetimes are
+    considered local
+    '''
+    import csv
+
+    from dateutil import parser as dup
+
+    reader = csv.DictReader(file)
+
+    if reader.fieldnames is None or reader.fieldnames[0] != 'datetime':
+        raise ValueError('The first field is not "datetime"')
+
+    columns = {cur: ([], []) for cur in reader.fieldnames[1:]}
+
+    for x in reader:
+        d = dup.parse(x['datetime'])
+        if not investats.is_aware(d):
+            d = d.astimezone()
+        for cur, (datetimes, rates) in columns.items():
+            if x[cur] != '':
+                datetimes.append(d)
+                rates.append(float(x[cur]))
+
+    return {cur: FxSeries(datetimes, rates)
+            for cur, (datetimes, rates) in columns.items()}
+
+
+def load_series(path: str, cache: 'Cache | None' = None) -> list[dict]:
+    '''
+    Loads a data series from a CSV file. If cache is specified, the parsed
+    series is cached, keyed on the (decompressed) content of the file
+    '''
+    from investats.compress import open_file
+
+    if cache is None:
+        with open_file(path, 'r') as f:
+            return list(load_data(f))
+
+    import io
+
+    with open_file(path, 'rb') as f:
+        raw = f.read()
+
+    key = get_series_key(raw)
+
+    data_cached = cache.get(key)
+    if data_cached is not None:
+        return decode_series(data_cached)
+
+    series = list(load_data(io.TextIOWrapper(io.BytesIO(raw))))
+    cache.put(key, encode_series(series))
+    return series
+
+
+def encode_series(series: list[dict]) -> bytes:
+    '''
+    Encodes a parsed series to be stored in the cache, as JSON (with the
+    datetimes in ISO-8601 format), so that reading the cache cannot run any
+    code
+    '''
+    import json
+
+    return json.dumps([x | {'datetime': x['datetime'].isoformat()}
+                       for x in series]).encode('utf-8')
+
+
+def decode_series(data: bytes) -> list[dict]:
+    '''
+    Decodes a parsed series encoded with encode_series
+    '''
+    import json
+
+    series = json.loads(data)
+    for x in series:
+        x['datetime'] = dt.fromisoformat(x['datetime'])
+    return series
+
+
+def get_series_key(raw: bytes) -> str:
+    '''
+    Returns the cache key of the series parsed from the content of a CSV file
+    '''
+    from investats import cache as cache_mod
+
+    return cache_mod.make_key('investats_aggr.load_data',
+                              cache_mod.get_version(), raw)
+
+
+def parse_chunk(header: bytes, chunk: bytes) -> list[dict]:
+    '''
+    Parses a chunk of the lines of a CSV file, given its header line. Meant to
+    be run in a process pool
+    '''
+    import io
+
+    return list(load_data(io.TextIOWrapper(io.BytesIO(header + chunk))))
+
+
+def read_series(path: str, pool_cpu: 'Executor',
+                cache: 'Cache | None' = None
+                ) -> tuple[str | None, list['Future[list[dict]]']]:
+    '''
+    Reads a CSV file and submits the parsing of its chunks to pool_cpu. Meant
+    to be run in a thread pool. Returns the cache key to store the series
+    with (None if it must not be stored) and the futures of the chunks
+    '''
+    from concurrent.futures import Future
+
+    from investats.compress import open_file
+
+    with open_file(path, 'rb') as f:
+        raw = f.read()
+
+    key = None
+    if cache is not None:
+        key = get_series_key(raw)
+
+        data_cached = cache.get(key)
+        if data_cached is not None:
+            future = Future()
+            future.set_result(decode_series(data_cached))
+            return None, [future]
+
+    lines = raw.splitlines(keepends=True)
+    if len(lines) == 0:
+        raise ValueError('Empty input file: ' + path)
+
+    return key, [pool_cpu.submit(parse_chunk, lines[0],
+                                 b''.join(lines[i:i + PARSE_CHUNK_LINES]))
+                 for i in range(1, len(lines), PARSE_CHUNK_LINES)]
+
+
+def iter_series(future: 'Future[tuple[str | None, list[Future]]]',
+                cache: 'Cache | None' = None) -> Iterator[dict[str, Any]]:
+    '''
+    Yields the entries of a series read with read_series, as soon as each
+    chunk is parsed. When it is complete, the series is cached if needed
+    '''
+    key, futures = future.result()
+
+    series = []
+    for f in futures:
+        rows = f.result()
+        if key is not None:
+            series += rows
+        yield from rows
+
+    if key is not None:
+        cache.put(key, encode_series(series))
+
+
+def prefetch_series(files: dict[str, str], pool_io: 'Executor',
+                    pool_cpu: 'Executor', cache: 'Cache | None' = None
+                    ) -> dict[str, Iterator[dict[str, Any]]]:
+    '''
+    Starts loading multiple data series from CSV files concurrently: the
+    files are read in pool_io (a thread pool) and parsed in chunks in
+    pool_cpu (a process pool). Returns an iterator for each series, which
+    blocks only until the next chunk of it is parsed. The pools must not be
+    shut down before the iterators are consumed
+    '''
+    return {name: iter_series(pool_io.submit(read_series, path, pool_cpu,
+                                             cache), cache)
+            for name, path in files.items()}
 
 
 def save_data(data: list[dict], file: TextIO, fmt_days: str = '',
               fmt_src: str = '', fmt_dst: str = '', fmt_rate: str = '',
-              fmt_yield: str = '') -> None:
+              fmt_yield: str = '', header: bool = True) -> None:
     '''
-    Saves data into a CSV file
+    Saves data into a CSV file. If header is false, the header line is not
+    written (e.g. to append the data to an existing file)
     '''
     func_days = str if fmt_days == '' else lambda x: fmt_days.format(x)
     func_src = str if fmt_src == '' else lambda x: fmt_src.format(x)
@@ -64,16 +305,26 @@ def save_data(data: list[dict], file: TextIO, fmt_days: str = '',
         if key == 'datetime' or key.endswith(':latest_cgt'):
             return str
 
-        if key in ('diff_days', 'tot_days') \
-                or key.endswith((':diff_days', ':tot_days')):
+        # Fields added by investats.rolling_stats
+        if key.rsplit(':', 1)[-1].startswith('roll_'):
+            return func_src if key.endswith('_src') else func_yield
+
+        if key in ('diff_days', 'tot_days',
+                   'drawdown_days', 'max_drawdown_days') \
+                or key.endswith((':diff_days', ':tot_days',
+                                 ':drawdown_days', ':max_drawdown_days')):
             return func_days
 
         if key in ('diff_src', 'tot_src', 'tot_dst_as_src',
                    'chkpt_gain_src', 'chkpt_gain_net_src',
-                   'tot_gain_src', 'tot_gain_net_src') \
+                   'tot_gain_src', 'tot_gain_net_src',
+                   'max_tot_dst_as_src') \
             or key.endswith((':diff_src', ':tot_src', ':tot_dst_as_src',
                              ':chkpt_gain_src', ':chkpt_gain_net_src',
-                             ':tot_gain_src', ':tot_gain_net_src')):
+                             ':tot_gain_src', ':tot_gain_net_src',
+                             ':max_tot_dst_as_src', ':diff_realized_src',
+                             ':tot_realized_src', ':tot_fees_src',
+                             ':tot_dividends_src')):
             return func_src
 
         if key.endswith((':diff_dst', ':tot_dst')):
@@ -83,26 +334,80 @@ def save_data(data: list[dict], file: TextIO, fmt_days: str = '',
             return func_rate
 
         if key in ('chkpt_yield', 'chkpt_apy',
-                   'global_yield', 'global_apy') \
+                   'global_yield', 'global_apy',
+                   'twr', 'drawdown', 'max_drawdown') \
             or key.endswith((':chkpt_yield', ':chkpt_apy',
-                            ':global_yield', ':global_apy')):
+                            ':global_yield', ':global_apy', ':xirr',
+                            ':twr', ':drawdown', ':max_drawdown')):
             return func_yield
 
         raise ValueError(f'Unsupported key: {key}')
 
     fields = {k: get_fmt(k) for k in data[0].keys()}
 
-    print(','.join(fields.keys()), file=file)
+    if header:
+        print(','.join(fields.keys()), file=file)
     for x in data:
         print(','.join('' if x[k] is None else f(normlz_num(x[k]))
                        for k, f in fields.items()), file=file)
 
 
-def aggregate_series(
-        named_series: dict[str, list[dict]]) -> Iterator[dict[str, Any]]:
+def parse_bucket(spec: str) -> Callable[[dt], Any]:
+    '''
+    Returns a function that computes the bucket of a datetime, to be used
+    with aggregate_series. The spec can be a duration in days or hours (e.g.
+    "1d" or "6h", with buckets aligned to the Unix epoch) or a calendar period
+    (see the investats_gen.Freq class, e.g. "monthly"). The calendar periods
+    are computed in UTC, so that the datetimes in different timezones are
+    bucketed consistently
+    '''
+    from datetime import timezone as tz
+
+    from investats_gen import Freq
+
+    if spec in tuple(Freq):
+        freq = Freq(spec)
+        return lambda d: freq.floor(d.astimezone(tz.utc).date())
+
+    size, unit = spec[:-1], spec[-1:]
+    if not size.isdigit() or int(size) == 0 or unit not in ('d', 'h'):
+        raise ValueError('Invalid bucket: ' + spec)
+
+    seconds = int(size) * (24 * 60 * 60 if unit == 'd' else 60 * 60)
+    return lambda d: d.timestamp() // seconds
+
+
+def aggregate_series(named_series: dict[str, Iterable[dict]],
+                     twr: bool = False,
+                     fx: dict[str, FxSeries] | None = None,
+                     prev_out: dict[str, Any] | None = None,
+                     prev_entries: dict[str, dict] | None = None,
+                     bucket: Callable[[dt], Any] | None = None
+                     ) -> Iterator[dict[str, Any]]:
     '''
-    Aggregates multiple investats data series into a single one
+    Aggregates multiple investats data series into a single one. If twr is
+    true, the time-weighted return and drawdown fields are computed too (see
+    investats.compute_twr_fields). If fx is specified, the SRC values of the
+    series whose names are in it are converted to the aggregation currency
+    before summing them, using the exchange rate as of each aggregated
+    datetime. The per-series fields are not converted. The series can be any
+    iterables (e.g. generators), and are consumed lazily.
+
+    To resume a previous aggregation, prev_out must be its last output entry,
+    prev_entries the last entry of each series at or before it, and the series
+    must contain only the entries after it.
+
+    If bucket is specified (see parse_bucket), it must return the bucket of a
+    datetime: all the entries in the same bucket are aggregated into a single
+    output entry, with the datetime of the latest one. For each series, the
+    entries in the same bucket are merged into the last one, summing their
+    diff and checkpoint gain fields
     '''
+    if fx is None:
+        fx = {}
+    if prev_entries is None:
+        prev_entries = {}
+
     if len(named_series) < 2:
         raise ValueError('The number of series must be >= 2')
 
@@ -121,9 +426,11 @@ def aggregate_series(
     # not started yet)
     keys_sum_def_prev = [k for k in KEYS_SUM_ORDERED
                          if k not in KEYS_SUM_DEF_ZERO]
-
-    keys_specific = [k for k in next(iter(named_series.values()))[0].keys()
-                     if k != 'datetime']
+    # Keys of the input fields for which the values of the entries of a series
+    # in the same bucket must be summed when merging them
+    KEYS_SUM_BUCKET = ('diff_days', 'diff_src', 'diff_dst',
+                       'chkpt_gain_src', 'chkpt_gain_net_src',
+                       'diff_realized_src')
 
     ############################################################################
 
@@ -132,7 +439,7 @@ def aggregate_series(
     # Entries preceding the ones in curr_entries.
     # If an entry is missing in this dict, it basically means the related
     # series has not started yet
-    prev_entries = {}
+    prev_entries = prev_entries.copy()
     # This dict always contains the entries related to the iterators positions.
     # If an entry is missing in this dict, it basically means the related
     # series has ended
@@ -143,7 +450,47 @@ def aggregate_series(
         except StopIteration:
             pass
 
-    prev_aggr = None
+    # The per-series fields are the ones of the first entry of the first
+    # non-empty series
+    keys_specific = [k for k in next(iter((curr_entries | prev_entries)
+                                          .values()), {}).keys()
+                     if k != 'datetime']
+
+    def merge_bucket(name: str, key: Any) -> dict[str, Any]:
+        '''
+        Merges the entries of a series in a bucket, starting from the current
+        one, and moves its iterator past them. The checkpoint yields are
+        compounded, and the checkpoint APY is recomputed over the whole bucket
+        '''
+        merged, count = curr_entries.pop(name), 1
+
+        for entry in iterators[name]:
+            if merged['datetime'] >= entry['datetime']:
+                raise ValueError('Invalid entry order: ' +
+                                 str(merged['datetime']) + ' >= ' +
+                                 str(entry['datetime']))
+
+            if bucket(entry['datetime']) != key:
+                curr_entries[name] = entry
+                break
+
+            merged = entry | {k: merged[k] + entry[k]
+                              for k in KEYS_SUM_BUCKET if k in entry} | \
+                ({'chkpt_yield': (1 + merged['chkpt_yield']) *
+                  (1 + entry['chkpt_yield']) - 1}
+                 if 'chkpt_yield' in entry else {})
+            count += 1
+
+        if count > 1 and 'chkpt_apy' in merged:
+            # We compute this field using the same formula as compute_stats
+            merged['chkpt_apy'] = 0 if merged['chkpt_yield'] == 0 \
+                or merged['diff_days'] == 0 \
+                else (1 + merged['chkpt_yield']) ** \
+                (365 / merged['diff_days']) - 1
+
+        return merged
+
+    prev_aggr = prev_out
 
     while len(curr_entries) > 0:
         min_dt = min(e['datetime'] for e in curr_entries.values())
@@ -152,12 +499,24 @@ def aggregate_series(
             raise ValueError('Invalid entry order: ' +
                              str(prev_aggr['datetime']) + ' >= ' + str(min_dt))
 
-        # This dict contains only the entries related to the
-        # current datetime (min_dt)
-        named_entries = {name: entry for name, entry in curr_entries.items()
-                         if entry['datetime'] == min_dt}
+        if bucket is None:
+            # This dict contains only the entries related to the
+            # current datetime (min_dt)
+            named_entries = {name: entry
+                             for name, entry in curr_entries.items()
+                             if entry['datetime'] == min_dt}
+            aggr_dt = min_dt
+        else:
+            # This dict contains the merged entries of the series in the
+            # same bucket as the current datetime (min_dt)
+            key = bucket(min_dt)
+            named_entries = {name: merge_bucket(name, key)
+                             for name in [name for name, entry
+                                          in curr_entries.items()
+                                          if bucket(entry['datetime']) == key]}
+            aggr_dt = max(e['datetime'] for e in named_entries.values())
 
-        aggr = {'datetime': min_dt}  # Aggregated (output) entry
+        aggr = {'datetime': aggr_dt}  # Aggregated (output) entry
 
         ########################################################################
 
@@ -168,18 +527,23 @@ def aggregate_series(
             aggr['tot_days'] = 0
         else:
             aggr['diff_days'] = (
-                min_dt - prev_aggr['datetime']
+                aggr_dt - prev_aggr['datetime']
             ).total_seconds() / 60 / 60 / 24
             aggr['tot_days'] = prev_aggr['tot_days'] + aggr['diff_days']
 
         ########################################################################
 
-        aggr |= {k: sum(named_entries[name][k] if name in named_entries
-                        else prev_entries[name][k] if name in prev_entries
-                        else 0
+        # Exchange rates of the SRC of each series, as of aggr_dt
+        fx_rates = {name: fx[name].rate_at(aggr_dt) if name in fx else 1
+                    for name in named_series.keys()}
+
+        aggr |= {k: sum((named_entries[name][k] if name in named_entries
+                         else prev_entries[name][k] if name in prev_entries
+                         else 0) * fx_rates[name]
                         for name in named_series.keys())
                  if k in keys_sum_def_prev
-                 else sum(e[k] for e in named_entries.values())
+                 else sum(e[k] * fx_rates[name]
+                          for name, e in named_entries.items())
                  for k in KEYS_SUM_ORDERED} | \
                 {f'{name}:{k}': named_entries[name][k] if name in named_entries
                  else None
@@ -205,6 +569,9 @@ def aggregate_series(
             or aggr['tot_days'] == 0 \
             else (1 + aggr['global_yield']) ** (365 / aggr['tot_days']) - 1
 
+        if twr:
+            investats.compute_twr_fields(aggr, prev_aggr)
+
         ########################################################################
 
         yield aggr
@@ -213,13 +580,185 @@ def aggregate_series(
 
         for name, entry in named_entries.items():
             prev_entries[name] = entry
+            # The iterators of the merged series have already been moved
+            if bucket is not None:
+                continue
             try:
                 curr_entries[name] = next(iterators[name])
             except StopIteration:
                 del curr_entries[name]
 
 
+def get_series_digests(series: list[dict]) -> bytes:
+    '''
+    Returns the concatenated digests (DIGEST_SIZE bytes each) of the entries
+    of a series, to detect which ones have changed
+    '''
+    import hashlib
+
+    return b''.join(hashlib.blake2b(repr(list(x.items())).encode('utf-8'),
+                                    digest_size=DIGEST_SIZE).digest()
+                    for x in series)
+
+
+def find_changed_datetime(series: list[dict], digests: bytes,
+                          datetimes_old: list[dt],
+                          digests_old: bytes) -> dt | None:
+    '''
+    Returns the datetime of the earliest entry of a series that has been
+    added, removed or changed, compared to a previous version of it. Returns
+    None if the series has not changed
+    '''
+    n = min(len(series), len(datetimes_old))
+
+    for i in range(n):
+        a, b = i * DIGEST_SIZE, (i + 1) * DIGEST_SIZE
+        if digests[a:b] != digests_old[a:b]:
+            return min(series[i]['datetime'], datetimes_old[i])
+
+    if len(series) > n:
+        return series[n]['datetime']
+    if len(datetimes_old) > n:
+        return datetimes_old[n]
+
+    return None
+
+
+def resume_aggregation(named_series: dict[str, list[dict]],
+                       named_digests: dict[str, bytes], state: dict,
+                       bucket: Callable[[dt], Any] | None = None
+                       ) -> tuple[int, dict[str, list[dict]],
+                                  dict[str, Any] | None, dict[str, dict]]:
+    '''
+    Determines how much of a previous aggregation, whose state was saved with
+    make_state, is still valid. Returns the number of output entries that
+    can be kept, and the arguments (named_series, prev_out and prev_entries)
+    to resume it with aggregate_series. The bucket function must be the same
+    passed to aggregate_series, if any
+    '''
+    changed = [find_changed_datetime(series, named_digests[name],
+                                     *state['series'][name])
+               for name, series in named_series.items()]
+    changed = [d for d in changed if d is not None]
+
+    rows = state['rows']
+    n_kept = len(rows)
+
+    if len(changed) > 0:
+        d = min(changed)
+        n_kept = bisect_left(rows, d, key=lambda x: x['datetime'])
+
+        # The output entry of the bucket containing the changed entry must be
+        # recomputed too
+        if bucket is not None and n_kept > 0 \
+                and bucket(rows[n_kept - 1]['datetime']) == bucket(d):
+            n_kept -= 1
+
+    if n_kept == 0:
+        return 0, named_series, None, {}
+
+    prev_out = rows[n_kept - 1]
+
+    tails, prev_entries = {}, {}
+    for name, series in named_series.items():
+        i = bisect_right(series, prev_out['datetime'],
+                         key=lambda x: x['datetime'])
+        if i > 0:
+            prev_entries[name] = series[i - 1]
+        tails[name] = series[i:]
+
+    return n_kept, tails, prev_out, prev_entries
+
+
+def make_state(key: str, named_series: dict[str, list[dict]],
+               named_digests: dict[str, bytes], rows: list[dict],
+               file_out: str, fields: list[str], offsets: list[int]) -> dict:
+    '''
+    Returns the state of an aggregation, to be saved and then used to resume
+    it with resume_aggregation. The fields are the columns of the output file,
+    and the offsets are the ones of the end of the header line and of each
+    entry in it
+    '''
+    return {
+        'key': key,
+        'series': {name: ([x['datetime'] for x in series],
+                          named_digests[name])
+                   for name, series in named_series.items()},
+        'rows': rows,
+        'file_out': file_out,
+        'fields': fields,
+        'offsets': offsets,
+    }
+
+
+def load_state(path: str, key: str) -> dict | None:
+    '''
+    Loads the state of an aggregation, saved with save_state. Returns None if
+    it is missing or invalid (e.g. corrupt), or if it was saved with a
+    different key
+    '''
+    import json
+
+    try:
+        with open(path, 'rb') as f:
+            state = json.load(f)
+
+        if state['key'] != key:
+            return None
+
+        return state | {
+            'series': {name: ([dt.fromisoformat(d) for d in datetimes],
+                              bytes.fromhex(digests))
+                       for name, (datetimes, digests)
+                       in state['series'].items()},
+            'rows': [x | {'datetime': dt.fromisoformat(x['datetime'])}
+                     for x in state['rows']],
+        }
+    except FileNotFoundError:
+        return None
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        print(f'Invalid state file {path}, ignoring it: {e}',
+              file=sys.stderr)
+        return None
+
+
+def save_state(path: str, state: dict) -> None:
+    '''
+    Saves the state of an aggregation atomically, so that an interrupted
+    write cannot leave a truncated file. It is saved as JSON (with the
+    datetimes in ISO-8601 format and the digests in hex), so that loading it
+    cannot run any code
+    '''
+    import json
+    import os
+    import tempfile
+
+    data = state | {
+        'series': {name: ([d.isoformat() for d in datetimes], digests.hex())
+                   for name, (datetimes, digests)
+                   in state['series'].items()},
+        'rows': [x | {'datetime': x['datetime'].isoformat()}
+                 for x in state['rows']],
+    }
+
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                               prefix=os.path.basename(path) + '.tmp-')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
 def main(argv: list[str] | None = None) -> int:
+    import argparse
+
+    import investats.cache as cache_mod
+    import investats.compress as compress
+    import investats.timings as timings
+
     if argv is None:
         argv = sys.argv
 
@@ -230,7 +769,9 @@ def main(argv: list[str] | None = None) -> int:
     parser.add_argument('pairs', metavar='PAIRS', type=str, nargs='+',
                         help='List of (asset name, input file) pairs, as '
                         'array of items (e.g. AAA stats-aaa.csv '
-                        'BBB stats-bbb.csv)')
+                        'BBB stats-bbb.csv). Compressed input files (gzip, xz '
+                        'or zstd) are detected automatically. If --db is '
+                        'specified, list of asset names')
 
     parser.add_argument('--fmt-days', type=str, default='',
                         help='If specified, formats the days values with this '
@@ -248,17 +789,227 @@ def main(argv: list[str] | None = None) -> int:
                         help='If specified, formats the yield values with this '
                         'format string (e.g. "{:.4f}")')
 
+    parser.add_argument('--rolling', type=str, default='',
+                        help='If specified, computes rolling-window '
+                        'statistics of the aggregated series for these '
+                        'comma-separated windows, in days or checkpoints '
+                        '(e.g. "30d,90d,365d,12c")')
+
+    parser.add_argument('--twr', action='store_true',
+                        help='If specified, computes the time-weighted return '
+                        'and drawdown fields of the aggregated series')
+
+    parser.add_argument('--bucket', type=str, default='',
+                        help='If specified, aggregates all the entries in the '
+                        'same bucket into a single output entry. It can be a '
+                        'duration in days or hours (e.g. "1d" or "6h") or a '
+                        'calendar period ("daily", "weekly", "monthly" or '
+                        '"yearly", computed in UTC)')
+
+    parser.add_argument('-c', '--currency', type=str, action='append',
+                        default=[],
+                        help='SRC currency of an asset, as NAME=CURRENCY '
+                        '(e.g. AAA=USD). Can be specified multiple times. '
+                        'The SRC values of the assets without a currency are '
+                        'not converted')
+    parser.add_argument('--fx', type=str, default='',
+                        help='CSV file with the exchange rates of the '
+                        'currencies specified with --currency (one field for '
+                        'each currency, containing the value of one unit of '
+                        'it in the aggregation currency)')
+
+    parser.add_argument('--db', type=str, default='',
+                        help='If specified, reads the stats rows of the assets '
+                        'from this SQLite database (see the --db option of '
+                        'investats) instead of CSV files')
+
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Max number of input files read and parsed '
+                        'concurrently. If greater than 1, the files are read '
+                        'by a thread pool and parsed by a process pool, and '
+                        'the aggregation starts as soon as the first rows of '
+                        'all of them are available (default: %(default)s)')
+
+    parser.add_argument('-o', '--file-out', type=str, default='-',
+                        help='Output file. If set to "-" then stdout is used. '
+                        'It is compressed if its name ends with ".gz", ".xz" '
+                        'or ".zst" (default: %(default)s)')
+    parser.add_argument('--state', type=str, default='',
+                        help='If specified, saves the state of the '
+                        'aggregation to this file, and uses it on the next '
+                        'runs to resume the aggregation just before the '
+                        'earliest changed input entry. If --file-out is '
+                        'specified too, only the tail of it after that point '
+                        'is rewritten')
+
+    cache_mod.add_arguments(parser)
+    timings.add_arguments(parser)
+
     args = parser.parse_args(argv[1:])
 
-    ############################################################################
+    if args.jobs < 1:
+        raise ValueError('Invalid number of jobs: ' + str(args.jobs))
+    if args.state != '' and compress.is_compressed(args.file_out):
+        raise ValueError('The --state option cannot be used together with '
+                         'a compressed output file')
 
-    named_series = {}
+    bucket = None if args.bucket == '' else parse_bucket(args.bucket)
 
-    for name, file in pair_items_to_dict(args.pairs).items():
-        with open(file, 'r') as f:
-            named_series[name] = list(load_data(f))
+    ############################################################################
 
-    save_data(list(aggregate_series(named_series)), sys.stdout, args.fmt_days,
-              args.fmt_src, args.fmt_dst, args.fmt_rate, args.fmt_yield)
+    currencies = {}
+    for item in args.currency:
+        name, sep, cur = item.partition('=')
+        if sep == '' or name == '' or cur == '':
+            raise ValueError('Invalid currency: ' + item)
+        currencies[name] = cur
+
+    if currencies and args.fx == '':
+        raise ValueError('The --currency option requires the --fx option')
+
+    cache = cache_mod.from_args(args)
+
+    with timings.instrument(args) as tmg, ExitStack() as stack:
+        named_series, fx = {}, {}
+
+        if currencies:
+            with tmg.stage('load_fx'), compress.open_file(args.fx, 'r') \
+                    as f:
+                fx_by_cur = load_fx(f)
+            for name, cur in currencies.items():
+                if cur not in fx_by_cur:
+                    raise ValueError('Unknown currency: ' + cur)
+                fx[name] = fx_by_cur[cur]
+
+        with tmg.stage('load') as rec:
+            if args.db != '':
+                from investats import db
+
+                # The stats rows are streamed from the database during the
+                # aggregation
+                conn = stack.enter_context(closing(db.connect(args.db)))
+                for name in args.pairs:
+                    named_series[name] = db.load_stats(conn, name)
+            elif args.jobs == 1:
+                for name, file in pair_items_to_dict(args.pairs).items():
+                    named_series[name] = load_series(file, cache)
+                rec['rows'] = sum(len(s) for s in named_series.values())
+            else:
+                import multiprocessing as mp
+
+                from concurrent.futures import ProcessPoolExecutor, \
+                    ThreadPoolExecutor
+
+                # The worker processes must not be forked from this process,
+                # because other threads are running when they are started
+                mp_ctx = mp.get_context(
+                    'forkserver' if 'forkserver' in mp.get_all_start_methods()
+                    else 'spawn')
+
+                # The process pool is entered first, so that it is shut down
+                # after the thread pool, which submits tasks to it
+                pool_cpu = stack.enter_context(
+                    ProcessPoolExecutor(args.jobs, mp_ctx))
+                pool_io = stack.enter_context(ThreadPoolExecutor(args.jobs))
+
+                named_series = prefetch_series(pair_items_to_dict(args.pairs),
+                                               pool_io, pool_cpu, cache)
+        state_key, state, n_kept = '', None, 0
+        if args.state != '':
+            raw_fx = b''
+            if args.fx != '':
+                with compress.open_file(args.fx, 'rb') as f:
+                    raw_fx = f.read()
+
+            # The state is valid only for the same series, options, exchange
+            # rates and version of investats
+            state_key = cache_mod.make_key(
+                'investats_aggr.state', cache_mod.get_version(),
+                repr(list(named_series.keys())), raw_fx,
+                cache_mod.args_key(args, ('pairs', 'file_out', 'state',
+                                          'jobs')))
+
+        with tmg.stage('aggregate') as rec:
+            if args.state == '':
+                data_out = aggregate_series(named_series, args.twr, fx,
+                                            bucket=bucket)
+            else:
+                named_series = {name: list(series)
+                                for name, series in named_series.items()}
+                named_digests = {name: get_series_digests(series)
+                                 for name, series in named_series.items()}
+
+                state = load_state(args.state, state_key)
+                tails, prev_out, prev_entries = named_series, None, {}
+                if state is not None:
+                    n_kept, tails, prev_out, prev_entries = \
+                        resume_aggregation(named_series, named_digests, state,
+                                           bucket)
+
+                # The aggregated entries are stored in the state before
+                # adding the rolling-window statistics, which are recomputed
+                # every time because they depend on the previous entries
+                rows = [] if state is None else state['rows'][:n_kept]
+                rows += aggregate_series(tails, args.twr, fx, prev_out,
+                                         prev_entries, bucket)
+                data_out = rows
+
+            if args.rolling != '':
+                data_out = investats.rolling_stats(data_out,
+                                                   args.rolling.split(','))
+            data_out = list(data_out)
+            rec['rows'] = len(data_out) - n_kept
+        with tmg.stage('save') as rec:
+            fmts = (args.fmt_days, args.fmt_src, args.fmt_dst, args.fmt_rate,
+                    args.fmt_yield)
+
+            if args.state == '':
+                file_out = (sys.stdout if args.file_out == '-'
+                            else stack.enter_context(
+                                compress.open_file(args.file_out, 'w')))
+                save_data(data_out, file_out, *fmts)
+            else:
+                import io
+                import os
+
+                file_out = args.file_out if args.file_out == '-' \
+                    else os.path.abspath(args.file_out)
+
+                fields = [] if len(data_out) == 0 else list(data_out[0].keys())
+
+                # Only the tail of the output file is rewritten, if some rows
+                # are kept, the columns are the same and the file has not
+                # been modified since the previous run
+                is_tail = state is not None and n_kept > 0 \
+                    and file_out != '-' and state['file_out'] == file_out \
+                    and state.get('fields') == fields \
+                    and os.path.isfile(file_out) \
+                    and os.path.getsize(file_out) == state['offsets'][-1]
+
+                data_write = data_out[n_kept:] if is_tail else data_out
+                buf = io.StringIO()
+                if len(data_write) > 0:
+                    save_data(data_write, buf, *fmts, header=not is_tail)
+                raw_out = buf.getvalue().encode('utf-8')
+                rec['rows'] = len(data_write)
+
+                offsets = state['offsets'][:n_kept + 1] if is_tail else []
+                pos = offsets[-1] if is_tail else 0
+                start = pos
+                for line in raw_out.splitlines(keepends=True):
+                    pos += len(line)
+                    offsets.append(pos)
+
+                if file_out == '-':
+                    sys.stdout.write(buf.getvalue())
+                else:
+                    with open(file_out, 'r+b' if is_tail else 'wb') as f:
+                        f.seek(start)
+                        f.truncate()
+                        f.write(raw_out)
+
+                save_state(args.state, make_state(
+                    state_key, named_series, named_digests, rows, file_out,
+                    fields, offsets))
 
     return 0
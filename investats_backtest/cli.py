@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+
+import sys
+
+from bisect import bisect_right
+from collections.abc import Callable, Sequence
+from contextlib import ExitStack
+from datetime import date
+from datetime import datetime as dt
+from itertools import product
+from typing import TYPE_CHECKING, Any, TextIO
+
+import investats
+
+from investats_gen import Freq, build_entries, generate_dates
+
+if TYPE_CHECKING:
+    from multiprocessing.shared_memory import SharedMemory
+
+# Strategies supported by run_backtest
+STRATEGIES = ('dca', 'lump')
+# Final stats in the output of run_backtest
+KEYS_STATS = ('tot_src', 'tot_dst_as_src', 'tot_gain_src', 'tot_gain_net_src',
+              'global_yield', 'global_apy', 'xirr')
+
+# Rate history attached by each worker process (see init_worker)
+_history: 'RateHistory | None' = None
+
+
+class RateHistory:
+    '''
+    History of the DST/SRC rate, to be queried "as of" a datetime (i.e. using
+    the latest rate at or before it). The timestamps and the rates are stored
+    in a single buffer of doubles, which can be a shared memory block, so
+    that the worker processes can use it without copying it
+    '''
+
+    __slots__ = ('timestamps', 'rates', 'shm')
+
+    def __init__(self, buf: memoryview, n: int,
+                 shm: 'SharedMemory | None' = None) -> None:
+        values = buf.cast('d') if buf.format != 'd' else buf
+
+        self.timestamps = values[:n]
+        self.rates = values[n:n * 2]
+        # Reference to the shared memory block, if any, to keep it open
+        self.shm = shm
+
+    @classmethod
+    def from_lists(cls, timestamps: list[float],
+                   rates: list[float]) -> 'RateHistory':
+        '''
+        Creates a history stored in the memory of this process
+        '''
+        from array import array
+
+        for i in range(1, len(timestamps)):
+            if timestamps[i - 1] >= timestamps[i]:
+                raise ValueError('Invalid rate order: ' +
+                                 str(dt.fromtimestamp(timestamps[i - 1])) +
+                                 ' >= ' + str(dt.fromtimestamp(timestamps[i])))
+
+        return cls(memoryview(array('d', timestamps + rates)),
+                   len(timestamps))
+
+    def to_shared(self) -> 'RateHistory':
+        '''
+        Returns a copy of the history stored in a new shared memory block. The
+        block must be released with the unlink method
+        '''
+        from multiprocessing.shared_memory import SharedMemory
+
+        n = len(self.timestamps)
+        shm = SharedMemory(create=True, size=max(n * 2 * 8, 1))
+
+        values = shm.buf.cast('d')
+        values[:n] = self.timestamps
+        values[n:n * 2] = self.rates
+        values.release()
+
+        return RateHistory(shm.buf, n, shm)
+
+    @classmethod
+    def attach(cls, name: str, n: int) -> 'RateHistory':
+        '''
+        Attaches to a history stored in a shared memory block by another
+        process. The block is released by the process that created it, which
+        must be an ancestor of this one, so that they share the same resource
+        tracker
+        '''
+        from multiprocessing.shared_memory import SharedMemory
+
+        shm = SharedMemory(name)
+
+        return cls(shm.buf, n, shm)
+
+    def unlink(self) -> None:
+        '''
+        Releases the shared memory block of the history
+        '''
+        self.timestamps.release()
+        self.rates.release()
+        self.shm.close()
+        self.shm.unlink()
+
+    def rate_at(self, d: dt) -> float:
+        '''
+        Returns the latest rate at or before the datetime d
+        '''
+        i = bisect_right(self.timestamps, d.timestamp()) - 1
+        if i < 0:
+            raise ValueError('No rate available at ' + str(d))
+        return self.rates[i]
+
+
+def load_history(file: TextIO) -> RateHistory:
+    '''
+    Loads a rate history from a CSV file, with the "datetime" and "rate"
+    fields. Naive datetimes are considered local
+    '''
+    import csv
+
+    from dateutil import parser as dup
+
+    reader = csv.DictReader(file)
+
+    if reader.fieldnames is None or 'datetime' not in reader.fieldnames \
+            or 'rate' not in reader.fieldnames:
+        raise ValueError('The input file must have the "datetime" and "rate" '
+                         'fields')
+
+    timestamps, rates = [], []
+    for x in reader:
+        timestamps.append(dup.parse(x['datetime']).timestamp())
+        rates.append(float(x['rate']))
+
+    return RateHistory.from_lists(timestamps, rates)
+
+
+def init_worker(name: str, n: int) -> None:
+    '''
+    Attaches each worker process to the shared rate history
+    '''
+    global _history
+    _history = RateHistory.attach(name, n)
+
+
+def run_backtest(params: dict[str, Any],
+                 history: RateHistory | None = None) -> dict[str, Any]:
+    '''
+    Runs investats.compute_stats on the entries of a plan with the given
+    parameters (date_start, freq, inv_src, count, strategy and cgt), built
+    with investats_gen.build_entries using the rates from the history (by
+    default, the one of the worker process). Returns the parameters and the
+    final stats
+    '''
+    if history is None:
+        history = _history
+
+    if params['strategy'] not in STRATEGIES:
+        raise ValueError('Invalid strategy: ' + params['strategy'])
+
+    dates = [dt.combine(d, dt.min.time()).astimezone() for d in
+             generate_dates(params['date_start'], params['freq'],
+                            params['count'])]
+
+    entries = build_entries(dates, [history.rate_at(d) for d in dates],
+                            params['inv_src'], params['cgt'],
+                            params['strategy'] == 'lump')
+
+    for last in investats.compute_stats(entries, xirr=True):
+        pass
+
+    return params | {'datetime': last['datetime']} | \
+        {k: last[k] for k in KEYS_STATS}
+
+
+def make_grid(date_start: date, freqs: Sequence[Freq],
+              inv_srcs: Sequence[float], counts: Sequence[int],
+              strategies: Sequence[str],
+              cgt: float = 0) -> list[dict[str, Any]]:
+    '''
+    Returns the parameters of all the combinations of the given values
+    '''
+    return [{'date_start': date_start, 'freq': freq, 'inv_src': inv_src,
+             'count': count, 'strategy': strategy, 'cgt': cgt}
+            for freq, inv_src, count, strategy
+            in product(freqs, inv_srcs, counts, strategies)]
+
+
+def save_data(data: list[dict], file: TextIO, fmt_src: str = '',
+              fmt_yield: str = '') -> None:
+    '''
+    Saves data into a CSV file
+    '''
+    func_src = str if fmt_src == '' else lambda x: fmt_src.format(x)
+    func_yield = str if fmt_yield == '' else lambda x: fmt_yield.format(x)
+
+    def get_fmt(key: str) -> Callable[[Any], str]:
+        '''
+        Determines the format function for a specific field key
+        '''
+        if key.endswith('_src'):
+            return func_src
+        if key in ('global_yield', 'global_apy', 'xirr'):
+            return func_yield
+        return str
+
+    fields = {k: get_fmt(k) for k in data[0].keys()}
+
+    print(','.join(fields.keys()), file=file)
+    for x in data:
+        print(','.join('' if x[k] is None else f(x[k])
+                       for k, f in fields.items()), file=file)
+
+
+def main(argv: list[str] | None = None) -> int:
+    import argparse
+
+    import investats.compress as compress
+    import investats.timings as timings
+
+    if argv is None:
+        argv = sys.argv
+
+    parser = argparse.ArgumentParser(
+        description='Backtest investment plans on a history of rates'
+    )
+
+    parser.add_argument('file_in', metavar='FILE_IN', type=str,
+                        help='Input CSV file, with the "datetime" and "rate" '
+                        'fields. If set to "-" then stdin is used')
+    parser.add_argument('file_out', metavar='FILE_OUT', type=str,
+                        nargs='?', default='-',
+                        help='Output file. If set to "-" then stdout is used '
+                        '(default: %(default)s)')
+
+    parser.add_argument('-d', '--date-start',
+                        type=lambda x: dt.strptime(x, '%Y-%m-%d').date(),
+                        required=True,
+                        help='Start date, in YYYY-MM-DD format')
+    parser.add_argument('-s', '--inv-src', type=str, default='1000',
+                        help='Comma-separated values of how much SRC to '
+                        'invest each time (default: %(default)s)')
+    parser.add_argument('-f', '--freq', type=str, default='monthly',
+                        help='Comma-separated values of how often the '
+                        'investment is made (default: %(default)s)')
+    parser.add_argument('-c', '--count', type=str, default='12',
+                        help='Comma-separated values of the number of periods '
+                        '(default: %(default)s)')
+    parser.add_argument('--strategy', type=str, default='dca',
+                        help='Comma-separated strategies: "dca" (invests at '
+                        'each period) and/or "lump" (invests the same total '
+                        'at the first period) (default: %(default)s)')
+
+    parser.add_argument('-t', '--cgt', type=float, default=0,
+                        help='Capital Gains Tax (default: %(default)s)')
+
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of processes used to run the backtests '
+                        '(default: %(default)s)')
+
+    parser.add_argument('--fmt-src', type=str, default='',
+                        help='If specified, formats the SRC values with this '
+                        'format string (e.g. "{:.2f}")')
+    parser.add_argument('--fmt-yield', type=str, default='',
+                        help='If specified, formats the yield values with this '
+                        'format string (e.g. "{:.4f}")')
+
+    timings.add_arguments(parser)
+
+    args = parser.parse_args(argv[1:])
+
+    if args.jobs < 1:
+        raise ValueError('Invalid number of jobs: ' + str(args.jobs))
+
+    grid = make_grid(args.date_start,
+                     [Freq(x) for x in args.freq.split(',')],
+                     [float(x) for x in args.inv_src.split(',')],
+                     [int(x) for x in args.count.split(',')],
+                     args.strategy.split(','), args.cgt)
+
+    ############################################################################
+
+    with timings.instrument(args) as tmg, ExitStack() as stack:
+        file_in = (sys.stdin if args.file_in == '-'
+                   else stack.enter_context(
+                       compress.open_file(args.file_in, 'r')))
+
+        with tmg.stage('load') as rec:
+            history = load_history(file_in)
+            rec['rows'] = len(history.timestamps)
+
+        with tmg.stage('backtest') as rec:
+            if args.jobs == 1:
+                data_out = [run_backtest(x, history) for x in grid]
+            else:
+                from concurrent.futures import ProcessPoolExecutor
+
+                history = history.to_shared()
+                stack.callback(history.unlink)
+
+                executor = stack.enter_context(ProcessPoolExecutor(
+                    args.jobs, initializer=init_worker,
+                    initargs=(history.shm.name, len(history.timestamps))))
+                data_out = list(executor.map(run_backtest, grid))
+            rec['rows'] = len(data_out)
+
+        file_out = (sys.stdout if args.file_out == '-'
+                    else stack.enter_context(
+                        compress.open_file(args.file_out, 'w')))
+
+        with tmg.stage('save') as rec:
+            save_data(data_out, file_out, args.fmt_src, args.fmt_yield)
+            rec['rows'] = len(data_out)
+
+    return 0
@@ -1,8 +1,8 @@
 #!/usr/bin/env python3
 
-import argparse
 import sys
 
+from collections.abc import Iterable, Iterator
 from contextlib import ExitStack
 from datetime import datetime as dt
 from datetime import date
@@ -50,6 +50,62 @@ class Freq(StrEnum):
             case Freq.YEARLY:
                 return d.replace(year=d.year + 1)
 
+    def floor(self, d: date) -> date:
+        '''
+        Calculates the start date of the calendar period containing d. Weeks
+        start on Monday
+        '''
+        match self:
+            case Freq.DAILY:
+                return d
+            case Freq.WEEKLY:
+                return d - timedelta(days=d.weekday())
+            case Freq.MONTHLY:
+                return d.replace(day=1)
+            case Freq.YEARLY:
+                return d.replace(month=1, day=1)
+
+
+def generate_dates(date_start: date, freq: Freq, count: int) -> Iterator[date]:
+    '''
+    Generates the dates of the investments of a plan
+    '''
+    if count < 2:
+        raise ValueError('Count must be >= 2')
+
+    d = date_start
+    for _ in range(count):
+        yield d
+        d = freq.next(d)
+
+
+def build_entries(dates: Iterable[date], rates: Iterable[float],
+                  inv_src: float, cgt: float = 0,
+                  lump_sum: bool = False) -> list[dict]:
+    '''
+    Builds the entries of a plan with the same structure as the ones written
+    by generate_entries, but with the given rates (e.g. from a history of
+    real rates), as a list in the format returned by investats.load_data. If
+    lump_sum is true, all the SRC is invested at the first date, and the
+    following entries of type "invest" only update the rate
+    '''
+    dates, rates = list(dates), list(rates)
+    if len(dates) != len(rates):
+        raise ValueError('The number of dates and rates must be equal')
+
+    entries = []
+
+    for i, (d, rate) in enumerate(zip(dates, rates)):
+        inv = inv_src * len(dates) if lump_sum and i == 0 \
+            else 0 if lump_sum else inv_src
+
+        entries.append({'datetime': d, 'type': 'invest', 'inv_src': inv,
+                        'rate': rate})
+        entries.append({'datetime': d, 'type': 'chkpt'}
+                       | ({'cgt': cgt} if i == 0 and cgt != 0 else {}))
+
+    return entries
+
 
 def generate_entries(file: TextIO, date_start: date, inv_src: str,
                      init_rate: float, apy: float, freq: Freq, count: int,
@@ -57,12 +113,11 @@ def generate_entries(file: TextIO, date_start: date, inv_src: str,
     '''
     Generates entries based on some parameters
     '''
-    if count < 2:
-        raise ValueError('Count must be >= 2')
+    dates = generate_dates(date_start, freq, count)
 
     zero_cgt = cgt == '' or float(cgt) == 0
 
-    d = date_start
+    d = next(dates)
     rate = init_rate
     str_rate = str(rate) if fmt_rate == '' else fmt_rate.format(rate)
 
@@ -73,8 +128,7 @@ def generate_entries(file: TextIO, date_start: date, inv_src: str,
           (d.strftime('%Y-%m-%d'), '' if zero_cgt else f', cgt: {cgt}'),
           file=file)
 
-    for _ in range(1, count):
-        d = freq.next(d)
+    for d in dates:
         days = (d - date_start).total_seconds() / 60 / 60 / 24
         rate = init_rate * (1 + apy) ** (days / 365)
         str_rate = str(rate) if fmt_rate == '' else fmt_rate.format(rate)
@@ -86,6 +140,10 @@ def generate_entries(file: TextIO, date_start: date, inv_src: str,
 
 
 def main(argv: list[str] | None = None) -> int:
+    import argparse
+
+    import investats.timings as timings
+
     if argv is None:
         argv = sys.argv
 
@@ -127,16 +185,20 @@ def main(argv: list[str] | None = None) -> int:
                         help='If specified, formats the rate values with this '
                         'format string (e.g. "{:.6f}")')
 
+    timings.add_arguments(parser)
+
     args = parser.parse_args(argv[1:])
 
     ############################################################################
 
-    with ExitStack() as stack:
+    with timings.instrument(args) as tmg, ExitStack() as stack:
         file_out = (sys.stdout if args.file_out == '-'
                     else stack.enter_context(open(args.file_out, 'w')))
 
-        generate_entries(file_out, args.date_start, args.inv_src,
-                         args.init_rate, args.apy, args.freq, args.count,
-                         args.cgt, args.fmt_rate)
+        with tmg.stage('generate') as rec:
+            generate_entries(file_out, args.date_start, args.inv_src,
+                             args.init_rate, args.apy, args.freq, args.count,
+                             args.cgt, args.fmt_rate)
+            rec['rows'] = args.count * 2
 
     return 0
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+
+import os
+import struct
+import sys
+
+from collections.abc import Iterator
+from contextlib import ExitStack
+from datetime import datetime as dt
+from typing import BinaryIO
+
+# Magic bytes at the beginning of each index file
+INDEX_MAGIC = b'IVSIDX2\n'
+# The magic bytes are followed by the size (in bytes) and the modification
+# time (in nanoseconds) of the CSV file when it was indexed, to detect stale
+# indexes
+INDEX_HEADER = struct.Struct('<qq')
+# Each index record contains the timestamp of a row (in seconds since the
+# epoch) and the offset (in bytes) of the row in the CSV file
+INDEX_RECORD = struct.Struct('<dq')
+
+
+def parse_datetime(x: str) -> dt:
+    '''
+    Parses a datetime string. Naive datetimes are considered local
+    '''
+    from dateutil import parser as dup
+
+    return dup.parse(x)
+
+
+def get_stamp(file_csv: BinaryIO) -> tuple[int, int]:
+    '''
+    Returns the size and the modification time (in nanoseconds) of a file
+    '''
+    st = os.fstat(file_csv.fileno())
+    return st.st_size, st.st_mtime_ns
+
+
+def build_index(file_csv: BinaryIO, file_idx: BinaryIO,
+                stamp: tuple[int, int] | None = None) -> int:
+    '''
+    Builds the index of a CSV file produced by investats, and returns the
+    number of indexed rows. The stamp of the CSV file is stored in the index
+    (default: the one returned by get_stamp)
+    '''
+    if stamp is None:
+        stamp = get_stamp(file_csv)
+
+    header = file_csv.readline()
+    if not header.startswith(b'datetime,'):
+        raise ValueError('The first field is not "datetime"')
+
+    file_idx.write(INDEX_MAGIC)
+    file_idx.write(INDEX_HEADER.pack(*stamp))
+
+    count = 0
+    prev_ts = None
+    offset = file_csv.tell()
+
+    for line in file_csv:
+        ts = parse_datetime(
+            line.split(b',', 1)[0].decode('utf-8')).timestamp()
+
+        if prev_ts is not None and prev_ts > ts:
+            raise ValueError('Invalid row order at offset ' + str(offset))
+
+        file_idx.write(INDEX_RECORD.pack(ts, offset))
+
+        count += 1
+        prev_ts = ts
+        offset += len(line)
+
+    return count
+
+
+class Index:
+    '''
+    Read-only view of an index file, which is searched without loading it
+    entirely into memory. If stamp is specified, it must be the same as the
+    one of the CSV file when it was indexed, otherwise the index is stale
+    '''
+
+    # Offset of the first record
+    OFFSET = len(INDEX_MAGIC) + INDEX_HEADER.size
+
+    def __init__(self, file_idx: BinaryIO,
+                 stamp: tuple[int, int] | None = None) -> None:
+        header = file_idx.read(self.OFFSET)
+        if len(header) != self.OFFSET \
+                or header[:len(INDEX_MAGIC)] != INDEX_MAGIC:
+            raise ValueError('Invalid index file')
+
+        self.stamp = INDEX_HEADER.unpack(header[len(INDEX_MAGIC):])
+        if stamp is not None and tuple(stamp) != self.stamp:
+            raise ValueError('Stale index file: the CSV file has changed '
+                             'since it was indexed')
+
+        self.file = file_idx
+        self.len = (file_idx.seek(0, 2) - self.OFFSET) // INDEX_RECORD.size
+
+    def __len__(self) -> int:
+        return self.len
+
+    def __getitem__(self, i: int) -> tuple[float, int]:
+        '''
+        Returns the (timestamp, offset) record at position i
+        '''
+        if not 0 <= i < self.len:
+            raise IndexError('Index record out of range')
+
+        self.file.seek(self.OFFSET + i * INDEX_RECORD.size)
+        return INDEX_RECORD.unpack(self.file.read(INDEX_RECORD.size))
+
+    def bisect_right(self, ts: float) -> int:
+        '''
+        Returns the position of the first record whose timestamp is greater
+        than ts
+        '''
+        lo, hi = 0, self.len
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self[mid][0] <= ts:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def bisect_left(self, ts: float) -> int:
+        '''
+        Returns the position of the first record whose timestamp is greater
+        than or equal to ts
+        '''
+        lo, hi = 0, self.len
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self[mid][0] < ts:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+
+def query_rows(file_csv: BinaryIO, index: Index, dt_at: dt | None = None,
+               dt_from: dt | None = None,
+               dt_to: dt | None = None) -> Iterator[bytes]:
+    '''
+    Yields the header line of a CSV file produced by investats, followed by
+    the rows matching the query. If dt_at is specified, the only matching row
+    is the one at or before dt_at. Otherwise, the matching rows are the ones
+    between dt_from and dt_to (both inclusive, and both optional)
+    '''
+    if dt_at is not None:
+        start = index.bisect_right(dt_at.timestamp()) - 1
+        stop = start + 1 if start >= 0 else start
+    else:
+        start = 0 if dt_from is None \
+            else index.bisect_left(dt_from.timestamp())
+        stop = len(index) if dt_to is None \
+            else index.bisect_right(dt_to.timestamp())
+
+    file_csv.seek(0)
+    yield file_csv.readline()
+
+    if start >= stop:
+        return
+
+    file_csv.seek(index[start][1])
+    for _ in range(stop - start):
+        yield file_csv.readline()
+
+
+def main(argv: list[str] | None = None) -> int:
+    import argparse
+
+    import investats.timings as timings
+
+    if argv is None:
+        argv = sys.argv
+
+    parser = argparse.ArgumentParser(
+        description='Query the rows of a CSV file produced by investats at '
+        'a specific point in time, using an index'
+    )
+
+    parser.add_argument('file_in', metavar='FILE_IN', type=str,
+                        help='Input CSV file')
+
+    parser.add_argument('-i', '--index', type=str, default='',
+                        help='Index file (default: FILE_IN with the ".idx" '
+                        'extension appended)')
+    parser.add_argument('-b', '--build', action='store_true',
+                        help='If specified, (re)builds the index file before '
+                        'querying. Required if the input file has changed '
+                        'since it was indexed')
+
+    parser.add_argument('-a', '--at', type=parse_datetime, default=None,
+                        help='Outputs the row at or before this datetime')
+    parser.add_argument('-f', '--from', dest='dt_from', type=parse_datetime,
+                        default=None,
+                        help='Outputs the rows at or after this datetime')
+    parser.add_argument('-t', '--to', dest='dt_to', type=parse_datetime,
+                        default=None,
+                        help='Outputs the rows at or before this datetime')
+
+    timings.add_arguments(parser)
+
+    args = parser.parse_args(argv[1:])
+
+    ############################################################################
+
+    if args.at is not None and (args.dt_from is not None
+                                or args.dt_to is not None):
+        raise ValueError('The --at option cannot be used together with the '
+                         '--from and --to options')
+
+    file_idx = args.file_in + '.idx' if args.index == '' else args.index
+
+    with timings.instrument(args) as tmg, ExitStack() as stack:
+        file_csv = stack.enter_context(open(args.file_in, 'rb'))
+
+        if args.build:
+            with tmg.stage('build') as rec, open(file_idx, 'wb') as f:
+                rec['rows'] = build_index(file_csv, f)
+            file_csv.seek(0)
+
+        index = Index(stack.enter_context(open(file_idx, 'rb')),
+                      get_stamp(file_csv))
+
+        with tmg.stage('query') as rec:
+            for line in query_rows(file_csv, index, args.at, args.dt_from,
+                                   args.dt_to):
+                sys.stdout.buffer.write(line)
+
+    return 0
@@ -1,30 +1,39 @@
 #!/usr/bin/env python3
 
-import argparse
 import sys
 
 from collections.abc import Iterator
 from contextlib import ExitStack
 from datetime import datetime as dt
 from datetime import timedelta
-from dateutil import parser as dup
 from typing import Any, TextIO
 
 
 def is_txn_valid(txn: dict) -> bool:
     '''
-    Checks whether a transaction is valid or not
+    Checks whether a transaction is valid or not. A valid transaction is
+    either an investment (possibly with a fee) or a fee and/or a dividend
     '''
-    return all(k in txn for k in ('datetime', 'asset', 'rate')) \
-        and ('inv_src' in txn) != ('inv_dst' in txn)
+    if not all(k in txn for k in ('datetime', 'asset')):
+        return False
+
+    if 'rate' in txn:
+        return ('inv_src' in txn) != ('inv_dst' in txn)
+
+    return 'inv_src' not in txn and 'inv_dst' not in txn \
+        and ('fee' in txn or 'dividend' in txn)
 
 
 def load_data(file: TextIO, pfix_reset: str, pfix_datetime: str,
               pfix_asset: str, pfix_inv_src: str, pfix_inv_dst: str,
-              pfix_rate: str) -> Iterator[dict[str, Any]]:
+              pfix_rate: str, pfix_fee: str = '',
+              pfix_dividend: str = '') -> Iterator[dict[str, Any]]:
     '''
-    Scrapes transactions from a raw text file
+    Scrapes transactions from a raw text file. The fee and dividend lines are
+    scraped only if their prefixes are not empty
     '''
+    from dateutil import parser as dup
+
     txn = {}
 
     for line in file:
@@ -47,6 +56,10 @@ def load_data(file: TextIO, pfix_reset: str, pfix_datetime: str,
             txn['inv_dst'] = line.removeprefix(pfix_inv_dst).strip()
         elif line.startswith(pfix_rate):
             txn['rate'] = line.removeprefix(pfix_rate).strip()
+        elif pfix_fee != '' and line.startswith(pfix_fee):
+            txn['fee'] = line.removeprefix(pfix_fee).strip()
+        elif pfix_dividend != '' and line.startswith(pfix_dividend):
+            txn['dividend'] = line.removeprefix(pfix_dividend).strip()
 
     if txn == {}:
         return
@@ -67,6 +80,17 @@ def save_data(data: list[dict], file: TextIO) -> None:
         ) + ' }', file=file)
 
 
+def parse_entry_values(entry: dict) -> dict:
+    '''
+    Parses the string values of an entry in the same way as they would be
+    parsed from the YAML file written by save_data
+    '''
+    import yaml
+
+    return {k: yaml.safe_load(v) if isinstance(v, str) and k != 'type'
+            else v for k, v in entry.items()}
+
+
 def txns_to_entries(txns: list[dict], asset: str,
                     cgt: str = '') -> Iterator[dict[str, Any]]:
     '''
@@ -76,11 +100,24 @@ def txns_to_entries(txns: list[dict], asset: str,
     txns = [txn for txn in txns if txn['asset'] == asset]
     len_txns = len(txns)
 
+    # The ledger must start with an investment
+    if len_txns > 0 and 'rate' not in txns[0]:
+        raise ValueError('The first transaction must be an investment: ' +
+                         str(txns[0]))
+
     is_first_chkpt = True
 
     for i, txn in enumerate(txns):
-        yield {'datetime': txn['datetime'], 'type': 'invest'} | \
-            {k: txn[k] for k in ('inv_src', 'inv_dst', 'rate') if k in txn}
+        if 'rate' in txn:
+            yield {'datetime': txn['datetime'], 'type': 'invest'} | \
+                {k: txn[k] for k in ('inv_src', 'inv_dst', 'rate')
+                 if k in txn}
+        if 'fee' in txn:
+            yield {'datetime': txn['datetime'], 'type': 'fee',
+                   'amount_src': txn['fee']}
+        if 'dividend' in txn:
+            yield {'datetime': txn['datetime'], 'type': 'dividend',
+                   'amount_src': txn['dividend']}
 
         next_txn = txns[i + 1] if i < len_txns - 1 else None
 
@@ -103,6 +140,11 @@ def txns_to_entries(txns: list[dict], asset: str,
 
 
 def main(argv: list[str] | None = None) -> int:
+    import argparse
+
+    import investats.compress as compress
+    import investats.timings as timings
+
     if argv is None:
         argv = sys.argv
 
@@ -115,12 +157,14 @@ def main(argv: list[str] | None = None) -> int:
 
     parser.add_argument('file_in', metavar='FILE_IN', type=str,
                         nargs='?', default='-',
-                        help='Input file. If set to "-" then stdin is used '
-                        '(default: %(default)s)')
+                        help='Input file. If set to "-" then stdin is used. '
+                        'Compressed files (gzip, xz or zstd) are detected '
+                        'automatically (default: %(default)s)')
     parser.add_argument('file_out', metavar='FILE_OUT', type=str,
                         nargs='?', default='-',
-                        help='Output file. If set to "-" then stdout is used '
-                        '(default: %(default)s)')
+                        help='Output file. If set to "-" then stdout is used. '
+                        'It is compressed if its name ends with ".gz", ".xz" '
+                        'or ".zst" (default: %(default)s)')
 
     parser.add_argument('--pfix-reset', type=str, default='#####',
                         help='Prefix of the lines that separate one '
@@ -141,23 +185,52 @@ def main(argv: list[str] | None = None) -> int:
                         help='Prefix of the lines that contain a rate value '
                         '(default: "%(default)s")')
 
+    parser.add_argument('--pfix-fee', type=str, default='',
+                        help='If specified, prefix of the lines that contain '
+                        'a fee value (e.g. "Fee:")')
+    parser.add_argument('--pfix-dividend', type=str, default='',
+                        help='If specified, prefix of the lines that contain '
+                        'a dividend value (e.g. "Dividend:")')
+
     parser.add_argument('-t', '--cgt', type=str, default='',
                         help='Capital Gains Tax (default: empty)')
 
+    parser.add_argument('--db', type=str, default='',
+                        help='If specified, inserts the entries into this '
+                        'SQLite database instead of writing them to FILE_OUT. '
+                        'The entries identical to existing ones are ignored')
+
+    timings.add_arguments(parser)
+
     args = parser.parse_args(argv[1:])
 
     ############################################################################
 
-    with ExitStack() as stack:
+    with timings.instrument(args) as tmg, ExitStack() as stack:
         file_in = (sys.stdin if args.file_in == '-'
-                   else stack.enter_context(open(args.file_in, 'r')))
+                   else stack.enter_context(
+                       compress.open_file(args.file_in, 'r')))
         file_out = (sys.stdout if args.file_out == '-'
-                    else stack.enter_context(open(args.file_out, 'w')))
-
-        txns = load_data(file_in, args.pfix_reset, args.pfix_datetime,
-                         args.pfix_asset, args.pfix_inv_src, args.pfix_inv_dst,
-                         args.pfix_rate)
-        entries = txns_to_entries(txns, args.asset, args.cgt)
-        save_data(entries, file_out)
+                    else stack.enter_context(
+                        compress.open_file(args.file_out, 'w')))
+
+        with tmg.stage('load') as rec:
+            txns = tmg.collect(load_data(
+                file_in, args.pfix_reset, args.pfix_datetime, args.pfix_asset,
+                args.pfix_inv_src, args.pfix_inv_dst, args.pfix_rate,
+                args.pfix_fee, args.pfix_dividend), rec)
+        with tmg.stage('convert') as rec:
+            entries = tmg.collect(txns_to_entries(txns, args.asset, args.cgt),
+                                  rec)
+        with tmg.stage('save') as rec:
+            if args.db == '':
+                save_data(entries, file_out)
+            else:
+                from investats import db
+
+                conn = db.connect(args.db)
+                stack.callback(conn.close)
+                rec['rows'] = db.insert_entries(
+                    conn, args.asset, map(parse_entry_values, entries))
 
     return 0
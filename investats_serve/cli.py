@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+
+import asyncio
+import io
+import os
+import sys
+
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import investats
+import investats_aggr
+
+
+class Ledger:
+    '''
+    Keeps the entries of a ledger file and the related statistics in memory,
+    and updates them when the file changes
+    '''
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+        # Modification time and size of the file when it was last loaded
+        self.stamp = None
+
+        self.entries = []
+        self.stats = []
+        # Number of entries consumed to compute self.stats (i.e. index of the
+        # entry right after the last checkpoint)
+        self.consumed = 0
+
+    def refresh(self) -> bool:
+        '''
+        Reloads the ledger if the file has changed since the last time, and
+        returns true if it has. If the new entries are an extension of the old
+        ones, only the checkpoints after the last known one are recomputed
+        '''
+        st = os.stat(self.path)
+        stamp = (st.st_mtime_ns, st.st_size)
+        if stamp == self.stamp:
+            return False
+
+        with open(self.path, 'r') as f:
+            entries = investats.load_data(f)
+
+        stats = None
+        if self.stats and len(entries) >= self.consumed \
+                and entries[:self.consumed] == self.entries[:self.consumed]:
+            try:
+                stats = self.stats + list(investats.compute_stats(
+                    entries[self.consumed:], self.stats[-1]))
+            except ValueError:
+                # Some computations (e.g. the FIFO lots for entries of type
+                # "sell") cannot be resumed
+                pass
+        if stats is None:
+            stats = list(investats.compute_stats(entries))
+
+        self.stamp = stamp
+        self.entries = entries
+        self.stats = stats
+        self.consumed = next((i + 1 for i in range(len(entries) - 1, -1, -1)
+                              if entries[i]['type'] == 'chkpt'), 0)
+
+        return True
+
+
+class Server:
+    '''
+    Answers queries about the statistics of some ledgers, which are kept in
+    memory and watched for changes
+    '''
+
+    def __init__(self, named_paths: dict[str, str],
+                 fmts: dict[str, str] | None = None) -> None:
+        self.ledgers = {name: Ledger(path)
+                        for name, path in named_paths.items()}
+        # Format strings (fmt_days, fmt_src, etc.) used for the output data
+        self.fmts = {} if fmts is None else fmts
+
+        # Last error of each ledger whose refresh has failed
+        self.errors = {}
+
+        self.watcher = None
+
+    def refresh(self, strict: bool = False) -> list[str]:
+        '''
+        Refreshes all the ledgers, and returns the names of the changed ones.
+        Unless strict is true, the errors (e.g. of a ledger file that is
+        being written) are printed to stderr, once for each ledger until it
+        changes again, and the ledger keeps its previous state
+        '''
+        changed = []
+
+        for name, ledger in self.ledgers.items():
+            try:
+                if ledger.refresh():
+                    changed.append(name)
+                self.errors.pop(name, None)
+            except Exception as e:
+                if strict:
+                    raise
+                msg = f'{type(e).__name__}: {e}'
+                if self.errors.get(name) != msg:
+                    print(f'Error refreshing ledger {name}: {msg}',
+                          file=sys.stderr)
+                    self.errors[name] = msg
+
+        return changed
+
+    def handle(self, method: str, target: str) -> tuple[int, str, str]:
+        '''
+        Handles a request, and returns the response status code, content type
+        and body. Supported requests:
+        - GET /assets: list of asset names, one per line
+        - GET /stats/NAME: statistics of an asset, as CSV
+        - GET /aggr?assets=NAME,NAME,...: aggregated statistics of some
+          assets (default: all), as CSV
+        '''
+        if method != 'GET':
+            return 405, 'text/plain', 'Method not allowed\n'
+
+        url = urlsplit(target)
+        path = unquote(url.path)
+        query = parse_qs(url.query)
+
+        if path == '/assets':
+            return 200, 'text/plain', \
+                ''.join(f'{name}\n' for name in self.ledgers.keys())
+
+        if path.startswith('/stats/'):
+            name = path.removeprefix('/stats/')
+            if name not in self.ledgers:
+                return 404, 'text/plain', f'Unknown asset: {name}\n'
+
+            buf = io.StringIO()
+            investats.save_data(self.ledgers[name].stats, buf, **self.fmts)
+            return 200, 'text/csv', buf.getvalue()
+
+        if path == '/aggr':
+            names = query['assets'][0].split(',') if 'assets' in query \
+                else list(self.ledgers.keys())
+
+            for name in names:
+                if name not in self.ledgers:
+                    return 404, 'text/plain', f'Unknown asset: {name}\n'
+            if len(names) < 2:
+                return 400, 'text/plain', \
+                    'The number of assets must be >= 2\n'
+
+            buf = io.StringIO()
+            investats_aggr.save_data(list(investats_aggr.aggregate_series(
+                {name: self.ledgers[name].stats for name in names})),
+                buf, **self.fmts)
+            return 200, 'text/csv', buf.getvalue()
+
+        return 404, 'text/plain', 'Not found\n'
+
+    async def handle_conn(self, reader: asyncio.StreamReader,
+                          writer: asyncio.StreamWriter) -> None:
+        '''
+        Handles a single HTTP connection
+        '''
+        try:
+            request_line = (await reader.readline()).decode('latin-1')
+            # Headers are read and discarded
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+
+            try:
+                method, target, _ = request_line.split()
+            except ValueError:
+                status, ctype, body = 400, 'text/plain', 'Bad request\n'
+            else:
+                try:
+                    status, ctype, body = self.handle(method, target)
+                except Exception as e:
+                    # Any error (e.g. of a computation over a ledger without
+                    # checkpoints) must not prevent the response
+                    status, ctype, body = \
+                        500, 'text/plain', f'{type(e).__name__}: {e}\n'
+
+            body_bytes = body.encode('utf-8')
+            writer.write((f'HTTP/1.0 {status} \r\n'
+                          f'Content-Type: {ctype}; charset=utf-8\r\n'
+                          f'Content-Length: {len(body_bytes)}\r\n'
+                          'Connection: close\r\n\r\n').encode('latin-1'))
+            writer.write(body_bytes)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def watch(self, interval: float) -> None:
+        '''
+        Periodically refreshes the ledgers
+        '''
+        while True:
+            await asyncio.sleep(interval)
+            self.refresh()
+
+    async def start(self, host: str = '127.0.0.1', port: int = 8080,
+                    socket_path: str = '',
+                    interval: float = 1) -> asyncio.Server:
+        '''
+        Loads the ledgers and starts serving the requests over HTTP, either on
+        a TCP port or on a Unix socket (if socket_path is specified). The
+        ledger files are watched for changes by the self.watcher task
+        '''
+        self.refresh(strict=True)
+
+        if socket_path == '':
+            server = await asyncio.start_server(self.handle_conn, host, port)
+        else:
+            server = await asyncio.start_unix_server(self.handle_conn,
+                                                     socket_path)
+
+        self.watcher = asyncio.create_task(self.watch(interval))
+
+        return server
+
+    async def serve(self, host: str = '127.0.0.1', port: int = 8080,
+                    socket_path: str = '', interval: float = 1) -> None:
+        '''
+        Like start, but serves the requests until cancelled
+        '''
+        server = await self.start(host, port, socket_path, interval)
+
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.watcher.cancel()
+
+
+def main(argv: list[str] | None = None) -> int:
+    import argparse
+
+    import investats.timings as timings
+
+    if argv is None:
+        argv = sys.argv
+
+    parser = argparse.ArgumentParser(
+        description='Serve investats statistics of some ledgers over HTTP, '
+        'keeping them in memory and watching the ledger files for changes'
+    )
+
+    parser.add_argument('pairs', metavar='PAIRS', type=str, nargs='+',
+                        help='List of (asset name, input file) pairs, as '
+                        'array of items (e.g. AAA data-aaa.yml '
+                        'BBB data-bbb.yml)')
+
+    parser.add_argument('-b', '--bind', type=str, default='127.0.0.1',
+                        help='Address to listen on (default: %(default)s)')
+    parser.add_argument('-p', '--port', type=int, default=8080,
+                        help='TCP port to listen on (default: %(default)s)')
+    parser.add_argument('-u', '--socket', type=str, default='',
+                        help='If specified, listens on this Unix socket path '
+                        'instead of a TCP port')
+    parser.add_argument('-i', '--interval', type=float, default=1,
+                        help='Interval, in seconds, between checks for changes '
+                        'of the ledger files (default: %(default)s)')
+
+    parser.add_argument('--fmt-days', type=str, default='',
+                        help='If specified, formats the days values with this '
+                        'format string (e.g. "{:.2f}")')
+    parser.add_argument('--fmt-src', type=str, default='',
+                        help='If specified, formats the SRC values with this '
+                        'format string (e.g. "{:.2f}")')
+    parser.add_argument('--fmt-dst', type=str, default='',
+                        help='If specified, formats the DST values with this '
+                        'format string (e.g. "{:.4f}")')
+    parser.add_argument('--fmt-rate', type=str, default='',
+                        help='If specified, formats the rate values with this '
+                        'format string (e.g. "{:.6f}")')
+    parser.add_argument('--fmt-yield', type=str, default='',
+                        help='If specified, formats the yield values with this '
+                        'format string (e.g. "{:.4f}")')
+
+    timings.add_arguments(parser)
+
+    args = parser.parse_args(argv[1:])
+
+    ############################################################################
+
+    server = Server(
+        investats_aggr.pair_items_to_dict(args.pairs, 1),
+        {k: getattr(args, k) for k in ('fmt_days', 'fmt_src', 'fmt_dst',
+                                       'fmt_rate', 'fmt_yield')})
+
+    with timings.instrument(args):
+        try:
+            asyncio.run(server.serve(args.bind, args.port, args.socket,
+                                     args.interval))
+        except KeyboardInterrupt:
+            pass
+
+    return 0
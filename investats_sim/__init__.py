@@ -0,0 +1,26 @@
+#!/usr/bin/env python3
+
+import importlib
+
+
+# To make all the functions defined in the cli module accessible by importing
+# the root module. The cli module is imported lazily, on first attribute
+# access, so that importing the root module is cheap. The submodules (e.g.
+# cli itself) are imported lazily too
+def __getattr__(name: str):
+    if name == '__all__':
+        cli = importlib.import_module('.cli', __name__)
+        return [k for k in vars(cli) if not k.startswith('_')]
+
+    if not name.startswith('__'):
+        try:
+            return importlib.import_module('.' + name, __name__)
+        except ModuleNotFoundError as e:
+            if e.name != f'{__name__}.{name}':
+                raise
+
+        cli = importlib.import_module('.cli', __name__)
+        if hasattr(cli, name):
+            return getattr(cli, name)
+
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
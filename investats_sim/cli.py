@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+
+import sys
+
+from array import array
+from collections.abc import Callable, Iterator
+from contextlib import ExitStack
+from datetime import date
+from datetime import datetime as dt
+from datetime import time
+from datetime import timedelta
+from typing import TYPE_CHECKING, Any, TextIO
+
+import investats
+
+from investats_gen import Freq, generate_dates
+
+if TYPE_CHECKING:
+    from concurrent.futures import Executor
+
+# Number of paths simulated by each task. Each chunk has its own random
+# generator, seeded from the chunk index, so the results don't depend on how
+# the chunks are distributed across the processes
+CHUNK_PATHS = 1000
+
+# Output fields whose distribution across the paths is computed
+KEYS_DIST = ('tot_gain_net_src', 'global_apy')
+
+
+def get_plan_days(date_start: date, freq: Freq, count: int) -> list[float]:
+    '''
+    Returns the days passed since date_start at each investment of a plan,
+    with the same dates as investats_gen.generate_entries
+    '''
+    return [(d - date_start).total_seconds() / 60 / 60 / 24
+            for d in generate_dates(date_start, freq, count)]
+
+
+def simulate_paths(n_paths: int, seed: str, init_rate: float, apy: float,
+                   volatility: float, days: list[float]) -> list[array]:
+    '''
+    Simulates the DST/SRC rate at each investment of a plan, for n_paths
+    paths (as a paths x periods 2D array), using a geometric Brownian motion
+    with the given APY (over 365 days) and annualized volatility
+    '''
+    import math
+    import random
+
+    rng = random.Random(seed)
+
+    # Drift and standard deviation of the log-return of each period
+    mu = math.log(1 + apy)
+    steps = [((mu - volatility ** 2 / 2) * (b - a) / 365,
+              volatility * math.sqrt((b - a) / 365))
+             for a, b in zip(days, days[1:])]
+
+    paths = []
+    for _ in range(n_paths):
+        log_rate = math.log(init_rate)
+        path = array('d', [init_rate])
+        for drift, sigma in steps:
+            log_rate += drift + sigma * rng.gauss()
+            path.append(math.exp(log_rate))
+        paths.append(path)
+
+    return paths
+
+
+def evaluate_paths(paths: list[array], days: list[float], inv_src: float,
+                   cgt: float = 0) -> dict[str, list[array]]:
+    '''
+    Evaluates the investats.compute_stats formulas for a plan that invests
+    inv_src at each period, across all the paths at once. Returns, for each
+    field in KEYS_DIST, the values of all the paths at each checkpoint (as a
+    periods x paths 2D array)
+    '''
+    n_paths = len(paths)
+
+    tot_dst = array('d', bytes(8 * n_paths))
+    out = {k: [] for k in KEYS_DIST}
+
+    for t, tot_days in enumerate(days):
+        rates = [path[t] for path in paths]
+        tot_src = inv_src * (t + 1)
+
+        tot_dst = array('d', (x + inv_src / r for x, r in zip(tot_dst, rates)))
+
+        # We compute these fields using the same formulas as compute_stats
+        tot_gain_src = [x * r - tot_src for x, r in zip(tot_dst, rates)]
+        global_yield = [0 if x == 0 else r / (tot_src / x) - 1
+                        for x, r in zip(tot_dst, rates)]
+
+        out['tot_gain_net_src'].append(array('d', (
+            x * (1 - cgt) for x in tot_gain_src)))
+        out['global_apy'].append(array('d', (
+            0 if y == 0 or tot_days == 0
+            else (1 + y) ** (365 / tot_days) - 1 for y in global_yield)))
+
+    return out
+
+
+def run_chunk(index: int, n_paths: int, seed: int, init_rate: float,
+              apy: float, volatility: float, days: list[float],
+              inv_src: float, cgt: float) -> dict[str, list[array]]:
+    '''
+    Simulates and evaluates a chunk of paths. Meant to be run in a process
+    pool
+    '''
+    paths = simulate_paths(n_paths, f'{seed}:{index}', init_rate, apy,
+                           volatility, days)
+    return evaluate_paths(paths, days, inv_src, cgt)
+
+
+def percentile(values: list[float], p: float) -> float:
+    '''
+    Returns the p-th percentile of some sorted values, interpolating linearly
+    between the closest ranks
+    '''
+    pos = (len(values) - 1) * p / 100
+    i = int(pos)
+    if i + 1 >= len(values):
+        return values[-1]
+    return values[i] + (values[i + 1] - values[i]) * (pos - i)
+
+
+def simulate(date_start: date, inv_src: float, init_rate: float, apy: float,
+             volatility: float, freq: Freq, count: int, n_paths: int,
+             seed: int = 0, cgt: float = 0,
+             percentiles: tuple[float, ...] = (5, 25, 50, 75, 95),
+             executor: 'Executor | None' = None) -> Iterator[dict[str, Any]]:
+    '''
+    Runs a Monte Carlo simulation of an investment plan, with the same
+    parameters as investats_gen.generate_entries plus the volatility of the
+    rate, the number of paths and the random seed. Yields one entry for each
+    checkpoint, with the percentiles of the KEYS_DIST fields across the
+    paths. If executor is specified, the chunks of paths are evaluated in it
+    '''
+    for p in percentiles:
+        if not 0 <= p <= 100:
+            raise ValueError('Invalid percentile: ' + str(p))
+    if n_paths < 1:
+        raise ValueError('The number of paths must be >= 1')
+
+    days = get_plan_days(date_start, freq, count)
+
+    chunks = [(i, min(CHUNK_PATHS, n_paths - start), seed, init_rate, apy,
+               volatility, days, inv_src, cgt)
+              for i, start in enumerate(range(0, n_paths, CHUNK_PATHS))]
+
+    results = [run_chunk(*x) for x in chunks] if executor is None \
+        else list(executor.map(run_chunk, *zip(*chunks)))
+
+    for t, tot_days in enumerate(days):
+        entry_out = {
+            'datetime': dt.combine(date_start + timedelta(days=tot_days),
+                                   time()).astimezone(),
+            'tot_days': tot_days,
+            'tot_src': inv_src * (t + 1),
+        }
+
+        for k in KEYS_DIST:
+            values = sorted(x for r in results for x in r[k][t])
+            for p in percentiles:
+                entry_out[f'{k}:p{p:g}'] = percentile(values, p)
+
+        yield entry_out
+
+
+def save_data(data: list[dict], file: TextIO, fmt_days: str = '',
+              fmt_src: str = '', fmt_yield: str = '') -> None:
+    '''
+    Saves data into a CSV file
+    '''
+    func_days = str if fmt_days == '' else lambda x: fmt_days.format(x)
+    func_src = str if fmt_src == '' else lambda x: fmt_src.format(x)
+    func_yield = str if fmt_yield == '' else lambda x: fmt_yield.format(x)
+
+    def get_fmt(key: str) -> Callable[[Any], str]:
+        '''
+        Determines the format function for a specific field key
+        '''
+        if key == 'datetime':
+            return str
+        if key == 'tot_days':
+            return func_days
+        if key.split(':')[0].endswith('_src'):
+            return func_src
+        return func_yield
+
+    fields = {k: get_fmt(k) for k in data[0].keys()}
+
+    print(','.join(fields.keys()), file=file)
+    for x in data:
+        print(','.join(f(investats.normlz_num(x[k]))
+                       for k, f in fields.items()), file=file)
+
+
+def main(argv: list[str] | None = None) -> int:
+    import argparse
+
+    import investats.compress as compress
+    import investats.timings as timings
+
+    if argv is None:
+        argv = sys.argv
+
+    parser = argparse.ArgumentParser(
+        description='Monte Carlo simulation of an investment plan'
+    )
+
+    parser.add_argument('file_out', metavar='FILE_OUT', type=str,
+                        nargs='?', default='-',
+                        help='Output file. If set to "-" then stdout is used '
+                        '(default: %(default)s)')
+
+    parser.add_argument('-d', '--date-start',
+                        type=lambda x: dt.strptime(x, '%Y-%m-%d').date(),
+                        default=dt.now().date(),
+                        help='Start date, in YYYY-MM-DD format '
+                        '(default: today)')
+    parser.add_argument('-s', '--inv-src', type=float, default=1000,
+                        help='How much SRC to invest each time '
+                        '(default: %(default)s)')
+    parser.add_argument('-r', '--init-rate', type=float, default=100,
+                        help='Initial DST/SRC rate value (default: '
+                        '%(default)s)')
+
+    parser.add_argument('-a', '--apy', type=float, default=0,
+                        help='Expected APY (over 365 days) of the DST/SRC '
+                        'rate (default: %(default)s)')
+    parser.add_argument('-v', '--volatility', type=float, default=0.2,
+                        help='Annualized volatility of the DST/SRC rate '
+                        '(default: %(default)s)')
+    parser.add_argument('-f', '--freq', type=lambda x: Freq(x),
+                        default=Freq.MONTHLY,
+                        help='How often the investment is made '
+                        '(default: %(default)s)')
+    parser.add_argument('-c', '--count', type=int, default=12,
+                        help='Number of periods (default: %(default)s)')
+
+    parser.add_argument('-t', '--cgt', type=float, default=0,
+                        help='Capital Gains Tax (default: %(default)s)')
+
+    parser.add_argument('-n', '--paths', type=int, default=1000,
+                        help='Number of simulated paths (default: '
+                        '%(default)s)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the random generator (default: '
+                        '%(default)s)')
+    parser.add_argument('-p', '--percentiles', type=str,
+                        default='5,25,50,75,95',
+                        help='Comma-separated percentiles to output for each '
+                        'checkpoint (default: %(default)s)')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of processes used to evaluate the chunks '
+                        'of paths (default: %(default)s)')
+
+    parser.add_argument('--fmt-days', type=str, default='',
+                        help='If specified, formats the days values with this '
+                        'format string (e.g. "{:.2f}")')
+    parser.add_argument('--fmt-src', type=str, default='',
+                        help='If specified, formats the SRC values with this '
+                        'format string (e.g. "{:.2f}")')
+    parser.add_argument('--fmt-yield', type=str, default='',
+                        help='If specified, formats the yield values with this '
+                        'format string (e.g. "{:.4f}")')
+
+    timings.add_arguments(parser)
+
+    args = parser.parse_args(argv[1:])
+
+    if args.jobs < 1:
+        raise ValueError('Invalid number of jobs: ' + str(args.jobs))
+
+    percentiles = tuple(float(x) for x in args.percentiles.split(','))
+
+    ############################################################################
+
+    with timings.instrument(args) as tmg, ExitStack() as stack:
+        executor = None
+        if args.jobs > 1:
+            from concurrent.futures import ProcessPoolExecutor
+
+            executor = stack.enter_context(ProcessPoolExecutor(args.jobs))
+
+        with tmg.stage('simulate') as rec:
+            data_out = list(simulate(
+                args.date_start, args.inv_src, args.init_rate, args.apy,
+                args.volatility, args.freq, args.count, args.paths,
+                args.seed, args.cgt, percentiles, executor))
+            rec['rows'] = args.paths * args.count
+
+        file_out = (sys.stdout if args.file_out == '-'
+                    else stack.enter_context(
+                        compress.open_file(args.file_out, 'w')))
+
+        with tmg.stage('save') as rec:
+            save_data(data_out, file_out, args.fmt_days, args.fmt_src,
+                      args.fmt_yield)
+            rec['rows'] = len(data_out)
+
+    return 0
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+import io
+import json
+import os
+import tracemalloc
+
+import pytest
+
+from collections.abc import Callable
+from datetime import date
+from typing import Any
+
+import investats
+import investats_aggr
+import investats_gen
+import investats_scrape
+
+# These benchmarks require the pytest-benchmark plugin. Time baselines are
+# handled by the plugin itself (see --benchmark-autosave, --benchmark-compare
+# and --benchmark-compare-fail), while peak memory baselines are handled by
+# this module (see _check_mem_baseline)
+pytest.importorskip('pytest_benchmark')
+
+# Dataset sizes can be customized with comma-separated lists of integers in
+# the following environment variables (e.g. INVESTATS_BENCH_ENTRIES=1000,
+# 100000,10000000)
+SIZES_ENTRIES = [int(x) for x in os.environ.get(
+    'INVESTATS_BENCH_ENTRIES', '1000').split(',')]
+SIZES_ASSETS = [int(x) for x in os.environ.get(
+    'INVESTATS_BENCH_ASSETS', '2').split(',')]
+
+# If set, path of the JSON file containing the peak memory baselines. Missing
+# baselines are added to the file; existing ones are checked
+MEM_BASELINE_FILE = os.environ.get('INVESTATS_BENCH_MEM_BASELINE', '')
+# Max allowed relative increase of the peak memory w.r.t. the baseline
+MEM_THRESHOLD = float(os.environ.get('INVESTATS_BENCH_MEM_THRESHOLD', '0.1'))
+
+
+def _gen_yml(count_entries: int, apy: float = 0.08) -> str:
+    '''
+    Generates a YAML ledger with roughly the specified number of entries
+    '''
+    buf = io.StringIO()
+    # Each period produces two entries: one "invest" and one "chkpt"
+    investats_gen.generate_entries(
+        buf, date(2000, 1, 1), '500', 100, apy, investats_gen.Freq.DAILY,
+        max(2, count_entries // 2), fmt_rate='{:.4f}')
+    return buf.getvalue()
+
+
+def _gen_txt(count_entries: int) -> str:
+    '''
+    Generates raw text with the specified number of transactions, in the
+    format expected by investats_scrape with the default prefixes
+    '''
+    data = investats.load_data(io.StringIO(_gen_yml(count_entries * 2)))
+    return ''.join(
+        '#####\n'
+        f'Datetime: {e["datetime"].isoformat()}\n'
+        'Asset: AAA\n'
+        f'InvSrc: {e["inv_src"]}\n'
+        f'Rate: {e["rate"]}\n'
+        for e in data if e['type'] == 'invest'
+    )
+
+
+def _measure_peak_mem(func: Callable[[], Any]) -> int:
+    '''
+    Runs a function once and returns its peak memory allocation, in bytes
+    '''
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def _check_mem_baseline(name: str, peak_mem: int) -> None:
+    '''
+    Compares the peak memory of a benchmark with its baseline (if any), and
+    fails if it has regressed past MEM_THRESHOLD
+    '''
+    if MEM_BASELINE_FILE == '':
+        return
+
+    try:
+        with open(MEM_BASELINE_FILE, 'r') as f:
+            baselines = json.load(f)
+    except FileNotFoundError:
+        baselines = {}
+
+    if name not in baselines:
+        baselines[name] = peak_mem
+        with open(MEM_BASELINE_FILE, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        return
+
+    limit = baselines[name] * (1 + MEM_THRESHOLD)
+    assert peak_mem <= limit, f'Peak memory of {name} regressed: ' \
+        f'{peak_mem} > {limit:.0f} (baseline: {baselines[name]})'
+
+
+def _run(benchmark, name: str, func: Callable[[], Any]) -> Any:
+    '''
+    Benchmarks a function for both time and peak memory
+    '''
+    peak_mem = _measure_peak_mem(func)
+    benchmark.extra_info['peak_mem'] = peak_mem
+
+    result = benchmark(func)
+
+    _check_mem_baseline(name, peak_mem)
+
+    return result
+
+
+@pytest.mark.parametrize('entries', SIZES_ENTRIES)
+def test_bench_investats_load_data(benchmark, entries: int) -> None:
+    yml = _gen_yml(entries)
+
+    data = _run(benchmark, f'investats_load_data[{entries}]',
+                lambda: investats.load_data(io.StringIO(yml)))
+
+    assert len(data) == len(yml.splitlines()) - 1
+
+
+@pytest.mark.parametrize('entries', SIZES_ENTRIES)
+def test_bench_investats_compute_stats(benchmark, entries: int) -> None:
+    data = investats.load_data(io.StringIO(_gen_yml(entries)))
+
+    data_out = _run(benchmark, f'investats_compute_stats[{entries}]',
+                    lambda: list(investats.compute_stats(data)))
+
+    assert len(data_out) == len(data) // 2
+
+
+@pytest.mark.parametrize('entries', SIZES_ENTRIES)
+def test_bench_investats_compute_stats_xirr(benchmark, entries: int) -> None:
+    # Worst case for the XIRR, which is computed over all the cash flows at
+    # every checkpoint: one checkpoint per investment
+    data = investats.load_data(io.StringIO(_gen_yml(entries)))
+
+    data_out = _run(benchmark, f'investats_compute_stats_xirr[{entries}]',
+                    lambda: list(investats.compute_stats(data, xirr=True)))
+
+    assert len(data_out) == len(data) // 2
+    assert data_out[-1]['xirr'] == pytest.approx(0.08, abs=1e-3)
+
+
+@pytest.mark.parametrize('entries', SIZES_ENTRIES)
+def test_bench_investats_save_data(benchmark, entries: int) -> None:
+    data = list(investats.compute_stats(
+        investats.load_data(io.StringIO(_gen_yml(entries)))))
+
+    def func() -> str:
+        buf = io.StringIO()
+        investats.save_data(data, buf, '{:.2f}', '{:.2f}', '{:.4f}',
+                            '{:.6f}', '{:.4f}')
+        return buf.getvalue()
+
+    csv = _run(benchmark, f'investats_save_data[{entries}]', func)
+
+    assert len(csv.splitlines()) == len(data) + 1
+
+
+@pytest.mark.parametrize('assets', SIZES_ASSETS)
+@pytest.mark.parametrize('entries', SIZES_ENTRIES)
+def test_bench_investats_aggr_aggregate_series(benchmark, entries: int,
+                                               assets: int) -> None:
+    # The total number of entries is split among the assets
+    series = [list(investats.compute_stats(investats.load_data(
+        io.StringIO(_gen_yml(max(4, entries // assets), 0.01 * i)))))
+        for i in range(assets)]
+    named_series = {f'A{i:04d}': s for i, s in enumerate(series)}
+
+    data_out = _run(
+        benchmark, f'investats_aggr_aggregate_series[{entries}-{assets}]',
+        lambda: list(investats_aggr.aggregate_series(named_series)))
+
+    assert len(data_out) == max(len(s) for s in series)
+
+
+@pytest.mark.parametrize('entries', SIZES_ENTRIES)
+def test_bench_investats_scrape_load_data(benchmark, entries: int) -> None:
+    txt = _gen_txt(entries)
+
+    txns = _run(benchmark, f'investats_scrape_load_data[{entries}]',
+                lambda: list(investats_scrape.load_data(
+                    io.StringIO(txt), '#####', 'Datetime:', 'Asset:',
+                    'InvSrc:', 'InvDst:', 'Rate:')))
+
+    assert len(txns) == txt.count('#####')
+
+
+@pytest.mark.parametrize('entries', SIZES_ENTRIES)
+def test_bench_investats_gen_generate_entries(benchmark, entries: int) -> None:
+    def func() -> str:
+        buf = io.StringIO()
+        investats_gen.generate_entries(
+            buf, date(2000, 1, 1), '500', 100, 0.08,
+            investats_gen.Freq.DAILY, max(2, entries // 2),
+            fmt_rate='{:.4f}')
+        return buf.getvalue()
+
+    yml = _run(benchmark, f'investats_gen_generate_entries[{entries}]', func)
+
+    assert len(yml.splitlines()) == max(2, entries // 2) * 2 + 1
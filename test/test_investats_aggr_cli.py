@@ -5,12 +5,15 @@ import textwrap
 
 import pytest
 
+import investats_aggr
+
 from copy import deepcopy
 from datetime import datetime as dt
 from datetime import timezone as tz
+from typing import Any
 
-from investats_aggr import pair_items_to_dict, load_data, save_data, \
-    aggregate_series
+from investats_aggr import pair_items_to_dict, FxSeries, load_fx, \
+    load_data, save_data, aggregate_series
 
 from util import pfmt
 
@@ -30,6 +33,8 @@ def test_pair_items_to_dict() -> None:
         pair_items_to_dict(['A', 'aaa'])
     assert exc_info.value.args == ('The number of pairs must be >= 2',)
 
+    assert pair_items_to_dict(['A', 'aaa'], 1) == {'A': 'aaa'}
+
 
 def test_load_data() -> None:
     csv = textwrap.dedent('''\
@@ -171,6 +176,50 @@ def test_save_data(get_data_invsttsaggr) -> None:
     assert exc_info.value.args == ('Unsupported key: asdfghjkl',)
 
 
+def test_fx_series() -> None:
+    fx = FxSeries([dt(2020, 1, d, tzinfo=tz.utc) for d in (1, 5, 10)],
+                  [1.1, 1.2, 1.3])
+
+    assert [fx.rate_at(dt(2020, 1, d, tzinfo=tz.utc))
+            for d in (1, 2, 5, 9, 10, 31, 31, 4, 5)] == \
+        [1.1, 1.1, 1.2, 1.2, 1.3, 1.3, 1.3, 1.1, 1.2]
+
+    with pytest.raises(ValueError) as exc_info:
+        fx.rate_at(dt(2019, 12, 31, tzinfo=tz.utc))
+    assert exc_info.value.args == (
+        'No FX rate available at 2019-12-31 00:00:00+00:00',)
+
+    with pytest.raises(ValueError) as exc_info:
+        FxSeries([dt(2020, 1, 2, tzinfo=tz.utc),
+                  dt(2020, 1, 1, tzinfo=tz.utc)], [1, 1])
+    assert exc_info.value.args == (
+        'Invalid FX rate order: 2020-01-02 00:00:00+00:00 >= '
+        '2020-01-01 00:00:00+00:00',)
+
+
+def test_load_fx() -> None:
+    csv = textwrap.dedent('''\
+        datetime,USD,JPY
+        2020-01-01 00:00:00+00:00,0.9,0.008
+        2020-01-02 00:00:00+00:00,,0.009
+        2020-01-03 00:00:00+00:00,0.8,
+    ''')
+
+    fx = load_fx(io.StringIO(csv))
+
+    assert list(fx.keys()) == ['USD', 'JPY']
+    assert fx['USD'].datetimes == [dt(2020, 1, 1, tzinfo=tz.utc),
+                                   dt(2020, 1, 3, tzinfo=tz.utc)]
+    assert fx['USD'].rates == [0.9, 0.8]
+    assert fx['JPY'].datetimes == [dt(2020, 1, 1, tzinfo=tz.utc),
+                                   dt(2020, 1, 2, tzinfo=tz.utc)]
+    assert fx['JPY'].rates == [0.008, 0.009]
+
+    with pytest.raises(ValueError) as exc_info:
+        load_fx(io.StringIO('foo,USD\n'))
+    assert exc_info.value.args == ('The first field is not "datetime"',)
+
+
 def test_aggregate_series(get_data_invsttsaggr) -> None:
     for pair in get_data_invsttsaggr():
         data_in = pair['in']
@@ -180,6 +229,40 @@ def test_aggregate_series(get_data_invsttsaggr) -> None:
         assert pfmt(data_in) == pfmt(data_in_copy)
         assert pfmt(data_out_actual) == pfmt(data_out_expected)
 
+    for pair in get_data_invsttsaggr():
+        data_out_expected = pair['out']
+        data_out_actual = list(aggregate_series(pair['in'], twr=True))
+        assert pfmt([{k: v for k, v in x.items() if k in data_out_expected[0]}
+                     for x in data_out_actual]) == pfmt(data_out_expected)
+
+        twr = 0
+        for x in data_out_actual:
+            twr = (1 + twr) * (1 + x['chkpt_yield']) - 1
+            assert x['twr'] == pytest.approx(twr)
+            assert x['max_drawdown'] <= x['drawdown'] <= 0
+
+    # Converting the SRC values of a series with a constant exchange rate is
+    # equivalent to multiplying them before aggregating
+    for pair in get_data_invsttsaggr():
+        data_in = pair['in']
+        name = list(data_in.keys())[-1]
+        fx = {name: FxSeries([dt(2000, 1, 1, tzinfo=tz.utc)], [2])}
+
+        data_in_scaled = deepcopy(data_in)
+        for x in data_in_scaled[name]:
+            for k in ('diff_src', 'tot_src', 'tot_dst_as_src',
+                      'chkpt_gain_src', 'chkpt_gain_net_src',
+                      'tot_gain_src', 'tot_gain_net_src'):
+                x[k] *= 2
+
+        def strip(data: list[dict]) -> list[dict]:
+            return [{k: v for k, v in x.items()
+                     if not k.startswith(name + ':')} for x in data]
+
+        data_out_actual = list(aggregate_series(data_in, fx=fx))
+        data_out_expected = list(aggregate_series(data_in_scaled))
+        assert pfmt(strip(data_out_actual)) == pfmt(strip(data_out_expected))
+
     with pytest.raises(ValueError) as exc_info:
         list(aggregate_series({}))
     assert exc_info.value.args == ('The number of series must be >= 2',)
@@ -203,3 +286,276 @@ def test_aggregate_series(get_data_invsttsaggr) -> None:
         'Invalid entry order: 2020-01-12 00:00:00+00:00 >= '
         '2020-01-12 00:00:00+00:00',)
     assert pfmt(data_in) == pfmt(data_in_copy)
+
+
+def test_prefetch_series(get_data_invsttsaggr, monkeypatch, tmp_path) -> None:
+    import csv
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    import investats_aggr.cli
+
+    from investats.cache import Cache
+
+    monkeypatch.setattr(investats_aggr.cli, 'PARSE_CHUNK_LINES', 2)
+
+    for i, pair in enumerate(get_data_invsttsaggr()):
+        files = {}
+        for name, series in pair['in'].items():
+            files[name] = str(tmp_path / f'{i}-{name}.csv')
+            with open(files[name], 'w') as f:
+                writer = csv.DictWriter(f, series[0].keys())
+                writer.writeheader()
+                writer.writerows(series)
+
+        data_expected = list(aggregate_series(
+            {name: investats_aggr.load_series(file)
+             for name, file in files.items()}))
+
+        cache = Cache(str(tmp_path / 'cache'), 1024 * 1024)
+
+        # The second time, the series are taken from the cache
+        for _ in range(2):
+            with ThreadPoolExecutor(2) as pool_io, \
+                    ThreadPoolExecutor(2) as pool_cpu:
+                named_series = investats_aggr.prefetch_series(
+                    files, pool_io, pool_cpu, cache)
+                data_out = list(aggregate_series(named_series))
+
+            assert pfmt(data_out) == pfmt(data_expected)
+
+
+def test_main_jobs(capsys, tmp_path) -> None:
+    import investats
+
+    file_in = str(tmp_path / 'data.yml')
+    with open(file_in, 'w') as f:
+        f.write(textwrap.dedent('''\
+            ---
+            - { datetime: 2020-01-12, type: invest, inv_src: 500, rate: 100 }
+            - { datetime: 2020-01-12, type: chkpt }
+            - { datetime: 2020-02-12, type: invest, inv_src: 500, rate: 70 }
+            - { datetime: 2020-02-12, type: chkpt }
+        '''))
+    file_stats = str(tmp_path / 'stats.csv')
+    investats.main(['investats', file_in, file_stats])
+
+    argv = ['investats_aggr', 'AAA', file_stats, 'BBB', file_stats]
+
+    investats_aggr.main(argv)
+    data_expected = capsys.readouterr().out
+
+    investats_aggr.main(argv + ['--jobs', '2'])
+    assert capsys.readouterr().out == data_expected
+
+    with pytest.raises(ValueError) as exc_info:
+        investats_aggr.main(argv + ['--jobs', '0'])
+    assert exc_info.value.args == ('Invalid number of jobs: 0',)
+
+
+def test_resume_aggregation(get_data_invsttsaggr) -> None:
+    from investats_aggr import get_series_digests, make_state, \
+        resume_aggregation
+
+    for pair in get_data_invsttsaggr():
+        data_in = pair['in']
+        data_expected = list(aggregate_series(data_in, twr=True))
+        named_digests = {name: get_series_digests(series)
+                         for name, series in data_in.items()}
+        state = make_state('', data_in, named_digests, data_expected, '-', [], [])
+
+        n_kept, tails, prev_out, prev_entries = \
+            resume_aggregation(data_in, named_digests, state)
+        assert n_kept == len(data_expected)
+        assert all(len(s) == 0 for s in tails.values())
+
+        # Changes the last entry of the first series
+        data_new = deepcopy(data_in)
+        name = next(iter(data_new))
+        data_new[name][-1]['tot_src'] += 1
+        named_digests = {name: get_series_digests(series)
+                         for name, series in data_new.items()}
+
+        n_kept, tails, prev_out, prev_entries = \
+            resume_aggregation(data_new, named_digests, state)
+        assert data_expected[n_kept]['datetime'] == \
+            data_new[name][-1]['datetime']
+
+        data_out = data_expected[:n_kept] + list(aggregate_series(
+            tails, True, None, prev_out, prev_entries))
+        assert pfmt(data_out) == pfmt(list(aggregate_series(data_new,
+                                                            twr=True)))
+
+
+def test_main_state(capsys, tmp_path) -> None:
+    import investats
+
+    files_stats = {}
+    for name, rate in (('AAA', 100), ('BBB', 70)):
+        file_in = str(tmp_path / f'data-{name}.yml')
+        with open(file_in, 'w') as f:
+            f.write(textwrap.dedent(f'''\
+                ---
+                - {{ datetime: 2020-01-12, type: invest, inv_src: 500, rate: {rate} }}
+                - {{ datetime: 2020-01-12, type: chkpt }}
+                - {{ datetime: 2020-02-12, type: invest, inv_src: 500, rate: 70 }}
+                - {{ datetime: 2020-02-12, type: chkpt }}
+            '''))  # noqa: E501
+        files_stats[name] = str(tmp_path / f'stats-{name}.csv')
+        investats.main(['investats', file_in, files_stats[name]])
+
+    file_out = str(tmp_path / 'aggr.csv')
+    file_state = str(tmp_path / 'aggr.state')
+    argv = ['investats_aggr', 'AAA', files_stats['AAA'], 'BBB',
+            files_stats['BBB'], '--twr', '--rolling', '2c']
+
+    def check() -> None:
+        for i, opts in enumerate([[], ['--bucket', 'monthly']]):
+            investats_aggr.main(argv + opts)
+            data_expected = capsys.readouterr().out
+
+            investats_aggr.main(argv + opts + ['--state', f'{file_state}{i}',
+                                               '-o', f'{file_out}{i}'])
+            with open(f'{file_out}{i}', 'r') as f:
+                assert f.read() == data_expected
+
+    check()
+    check()
+
+    # New rows are appended to the output file
+    with open(tmp_path / 'data-BBB.yml', 'a') as f:
+        f.write(textwrap.dedent('''\
+            - { datetime: 2020-03-12, type: invest, inv_src: 200, rate: 50 }
+            - { datetime: 2020-03-12, type: chkpt }
+        '''))
+    investats.main(['investats', str(tmp_path / 'data-BBB.yml'),
+                    files_stats['BBB']])
+    check()
+
+    # Rows in the middle change
+    with open(tmp_path / 'data-AAA.yml', 'a') as f:
+        f.write(textwrap.dedent('''\
+            - { datetime: 2020-02-20, type: invest, inv_src: 100, rate: 80 }
+            - { datetime: 2020-02-20, type: chkpt }
+        '''))
+    investats.main(['investats', str(tmp_path / 'data-AAA.yml'),
+                    files_stats['AAA']])
+    check()
+
+    # The output file is rewritten entirely if its columns change
+    for name in ('AAA', 'BBB'):
+        investats.main(['investats', str(tmp_path / f'data-{name}.yml'),
+                        files_stats[name], '--realized'])
+    check()
+
+    # The output file is rewritten entirely if it was modified
+    with open(file_out + '0', 'a') as f:
+        f.write('foo\n')
+    check()
+
+    # A corrupt state file is ignored, and the aggregation is redone
+    for content in (b'\x80\x04foo', b'{"key": ', b'[]', b'{"key": 1}'):
+        with open(file_state + '0', 'wb') as f:
+            f.write(content)
+        with open(file_state + '1', 'wb') as f:
+            f.write(content)
+        check()
+        # Only the error of the last run of check has not been read yet
+        assert capsys.readouterr().err.count('Invalid state file ') == \
+            (0 if content == b'{"key": 1}' else 1)
+    check()
+
+    with pytest.raises(ValueError) as exc_info:
+        investats_aggr.main(argv + ['--state', file_state, '-o',
+                                    file_out + '.gz'])
+    assert exc_info.value.args == ('The --state option cannot be used '
+                                   'together with a compressed output file',)
+
+
+def test_parse_bucket() -> None:
+    from investats_aggr import parse_bucket
+
+    d = dt(2020, 3, 12, 23, 30, tzinfo=tz.utc)
+
+    assert parse_bucket('1d')(d) == parse_bucket('1d')(
+        dt(2020, 3, 12, tzinfo=tz.utc))
+    assert parse_bucket('1d')(d) != parse_bucket('1d')(
+        dt(2020, 3, 13, tzinfo=tz.utc))
+    assert parse_bucket('6h')(d) == parse_bucket('6h')(
+        dt(2020, 3, 12, 18, tzinfo=tz.utc))
+    assert parse_bucket('monthly')(d) == dt(2020, 3, 1).date()
+    # The calendar periods are computed in UTC
+    assert parse_bucket('daily')(dt.fromisoformat(
+        '2020-03-13T01:00:00+02:00')) == dt(2020, 3, 12).date()
+
+    for spec in ('', 'd', '0d', '1w', 'foo'):
+        with pytest.raises(ValueError) as exc_info:
+            parse_bucket(spec)
+        assert exc_info.value.args == ('Invalid bucket: ' + spec,)
+
+
+def test_aggregate_series_bucket() -> None:
+    from investats_aggr import parse_bucket
+
+    def series(*items: tuple[str, float, float, float]) -> list[dict]:
+        '''
+        Builds a series from (datetime, diff_src, tot_src, latest_rate) items
+        '''
+        data, prev = [], None
+        for d, diff_src, tot_src, rate in items:
+            d = dt.fromisoformat(d)
+            diff_days = 0 if prev is None \
+                else (d - prev['datetime']).total_seconds() / 60 / 60 / 24
+            chkpt_yield = 0 if prev is None \
+                else rate / prev['latest_rate'] - 1
+            data.append({
+                'datetime': d, 'diff_days': diff_days, 'diff_src': diff_src,
+                'latest_rate': rate, 'tot_src': tot_src,
+                'tot_dst_as_src': tot_src * 1.001,
+                'chkpt_yield': chkpt_yield,
+                'chkpt_apy': 0 if chkpt_yield == 0 or diff_days == 0
+                else (1 + chkpt_yield) ** (365 / diff_days) - 1,
+                'chkpt_gain_src': diff_src * 0.001,
+                'chkpt_gain_net_src': diff_src * 0.0008,
+                'tot_gain_src': tot_src * 0.001,
+                'tot_gain_net_src': tot_src * 0.0008,
+            })
+            prev = data[-1]
+        return data
+
+    data_in = {
+        'AAA': series(('2020-01-01T22:00:00+00:00', 100, 100, 10),
+                      ('2020-01-02T22:00:00+00:00', 100, 200, 10.1),
+                      ('2020-01-03T22:00:00+00:00', 100, 300, 10.2)),
+        'BBB': series(('2020-01-01T16:00:00-05:00', 50, 50, 20),
+                      ('2020-01-02T10:00:00-05:00', 20, 70, 22),
+                      ('2020-01-02T16:00:00-05:00', 30, 100, 20.5),
+                      ('2020-01-03T16:00:00-05:00', 50, 150, 20.6)),
+    }
+
+    # The same series, with the entries of each day merged and moved to the
+    # same datetime
+    data_in_aligned = {
+        'AAA': data_in['AAA'],
+        'BBB': series(('2020-01-01T22:00:00+00:00', 50, 50, 20),
+                      ('2020-01-02T22:00:00+00:00', 50, 100, 20.5),
+                      ('2020-01-03T22:00:00+00:00', 50, 150, 20.6)),
+    }
+
+    assert len(list(aggregate_series(data_in))) == 7
+
+    data_out = list(aggregate_series(data_in, twr=True,
+                                     bucket=parse_bucket('1d')))
+    data_expected = list(aggregate_series(data_in_aligned, twr=True))
+    assert len(data_out) == 3
+
+    # The per-series fields of the merged entries (e.g. the compounded
+    # chkpt_yield) must be consistent with the other ones too
+    for x, y in zip(data_out, data_expected):
+        assert list(x.keys()) == list(y.keys())
+        for k, v in x.items():
+            assert v == (y[k] if k == 'datetime' else pytest.approx(y[k]))
+    assert data_out[1]['BBB:diff_days'] == 1
+    assert data_out[1]['BBB:diff_src'] == 50
+    assert data_out[1]['BBB:tot_src'] == 100
+    assert data_out[1]['BBB:chkpt_yield'] == pytest.approx(20.5 / 20 - 1)
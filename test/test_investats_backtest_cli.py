@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+import io
+
+import pytest
+
+from datetime import date
+from datetime import datetime as dt
+from datetime import timezone as tz
+
+import investats
+import investats_backtest
+
+from investats_backtest import RateHistory, load_history, make_grid, \
+    run_backtest
+from investats_gen import Freq
+
+
+def test_rate_history() -> None:
+    ts = [dt(2020, 1, d, tzinfo=tz.utc).timestamp() for d in (1, 3, 5)]
+    history = RateHistory.from_lists(ts, [100, 110, 120])
+
+    assert history.rate_at(dt(2020, 1, 1, tzinfo=tz.utc)) == 100
+    assert history.rate_at(dt(2020, 1, 2, tzinfo=tz.utc)) == 100
+    assert history.rate_at(dt(2020, 1, 3, tzinfo=tz.utc)) == 110
+    assert history.rate_at(dt(2020, 2, 1, tzinfo=tz.utc)) == 120
+
+    with pytest.raises(ValueError) as exc_info:
+        history.rate_at(dt(2019, 12, 31, tzinfo=tz.utc))
+    assert exc_info.value.args == ('No rate available at '
+                                   '2019-12-31 00:00:00+00:00',)
+
+    shared = history.to_shared()
+    try:
+        attached = RateHistory.attach(shared.shm.name, 3)
+        assert list(attached.timestamps) == ts
+        assert list(attached.rates) == [100, 110, 120]
+        assert attached.rate_at(dt(2020, 1, 4, tzinfo=tz.utc)) == 110
+        attached.timestamps.release()
+        attached.rates.release()
+        attached.shm.close()
+    finally:
+        shared.unlink()
+
+    with pytest.raises(ValueError) as exc_info:
+        RateHistory.from_lists(ts[::-1], [100, 110, 120])
+    assert exc_info.value.args[0].startswith('Invalid rate order: ')
+
+
+def test_load_history() -> None:
+    history = load_history(io.StringIO(
+        'datetime,rate\n'
+        '2020-01-01T00:00:00Z,100\n'
+        '2020-01-02T00:00:00Z,101.5\n'
+    ))
+    assert list(history.rates) == [100, 101.5]
+
+    with pytest.raises(ValueError) as exc_info:
+        load_history(io.StringIO('datetime,price\n2020-01-01,100\n'))
+    assert exc_info.value.args == ('The input file must have the "datetime" '
+                                   'and "rate" fields',)
+
+
+def test_run_backtest() -> None:
+    days = [dt(2020, 1, 1).astimezone().timestamp() + i * 86400
+            for i in range(400)]
+    history = RateHistory.from_lists(days, [100 + i / 10 for i in range(400)])
+
+    grid = make_grid(date(2020, 1, 1), [Freq.MONTHLY], [500], [3, 12],
+                     ['dca', 'lump'], 0.15)
+    assert len(grid) == 4
+
+    data = [run_backtest(x, history) for x in grid]
+    assert [(x['count'], x['strategy'], x['tot_src']) for x in data] == [
+        (3, 'dca', 1500), (3, 'lump', 1500),
+        (12, 'dca', 6000), (12, 'lump', 6000),
+    ]
+
+    # With a rising rate, investing everything at the start is better
+    assert data[0]['tot_gain_src'] < data[1]['tot_gain_src']
+
+    # The results must be the same as compute_stats'
+    data_in = []
+    for d in (date(2020, 1, 1), date(2020, 2, 1), date(2020, 3, 1)):
+        d = dt.combine(d, dt.min.time()).astimezone()
+        data_in.append({'datetime': d, 'type': 'invest', 'inv_src': 500,
+                        'rate': history.rate_at(d)})
+        data_in.append({'datetime': d, 'type': 'chkpt'})
+    data_in[1]['cgt'] = 0.15
+
+    last = list(investats.compute_stats(data_in, xirr=True))[-1]
+    for k in investats_backtest.KEYS_STATS:
+        assert data[0][k] == pytest.approx(last[k], rel=1e-9)
+
+    with pytest.raises(ValueError) as exc_info:
+        run_backtest(grid[0] | {'strategy': 'foo'}, history)
+    assert exc_info.value.args == ('Invalid strategy: foo',)
+
+
+def test_main(tmp_path) -> None:
+    with open(tmp_path / 'hist.csv', 'w') as f:
+        print('datetime,rate', file=f)
+        for i in range(800):
+            d = date.fromordinal(date(2020, 1, 1).toordinal() + i)
+            print(f'{d},{100 + (i % 90) / 3}', file=f)
+
+    argv = ['investats_backtest', '-d2020-01-01', '-fmonthly,weekly',
+            '-s100,500', '-c6,24', '--strategy=dca,lump', '--fmt-src={:.2f}',
+            '--fmt-yield={:.6f}', str(tmp_path / 'hist.csv')]
+
+    investats_backtest.main(argv + [str(tmp_path / 'out-1.csv')])
+    investats_backtest.main(argv[:1] + ['-j2'] + argv[1:] +
+                            [str(tmp_path / 'out-2.csv')])
+
+    with open(tmp_path / 'out-1.csv', 'r') as f:
+        data = f.read()
+    with open(tmp_path / 'out-2.csv', 'r') as f:
+        assert f.read() == data
+
+    lines = data.splitlines()
+    assert len(lines) == 17
+    assert lines[0] == 'date_start,freq,inv_src,count,strategy,cgt,' \
+        'datetime,tot_src,tot_dst_as_src,tot_gain_src,tot_gain_net_src,' \
+        'global_yield,global_apy,xirr'
+    assert lines[1].startswith('2020-01-01,monthly,100.00,6,dca,0,')
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import textwrap
+import time
+
+import investats
+import investats_aggr
+
+from investats.cache import Cache, add_arguments, args_key, from_args, \
+    get_version, make_key
+
+from util import pfmt
+
+
+def test_make_key() -> None:
+    assert make_key('foo', b'bar') == make_key(b'foo', 'bar')
+    assert make_key('foo', 'bar') != make_key('foob', 'ar')
+    assert make_key('foo', 'bar') != make_key('foo', 'baz')
+    assert len(make_key()) == 64
+
+    assert get_version() == get_version()
+
+
+def test_cache(tmp_path) -> None:
+    cache = Cache(str(tmp_path / 'cache'), 25)
+
+    assert cache.get('aaa') is None
+
+    cache.put('aaa', b'A' * 10)
+    cache.put('bbb', b'B' * 10)
+    assert cache.get('aaa') == b'A' * 10
+    assert cache.get('bbb') == b'B' * 10
+
+    # Makes "aaa" the most recently used entry
+    os.utime(cache.get_file('bbb'), ns=(0, 1_000_000_000))
+    os.utime(cache.get_file('aaa'), ns=(0, 2_000_000_000))
+
+    cache.put('ccc', b'C' * 10)
+    assert cache.get('aaa') == b'A' * 10
+    assert cache.get('bbb') is None
+    assert cache.get('ccc') == b'C' * 10
+
+    cache.put('aaa', b'X' * 5)
+    assert cache.get('aaa') == b'X' * 5
+
+    # Stale temporary files are deleted, recent ones are kept
+    for name in ('.tmp-old', '.tmp-new'):
+        with open(tmp_path / 'cache' / name, 'wb') as f:
+            f.write(b'foo')
+    os.utime(tmp_path / 'cache' / '.tmp-old', ns=(0, 0))
+
+    cache.evict()
+    assert sorted(os.listdir(tmp_path / 'cache')) == sorted([
+        '.tmp-new', os.path.basename(cache.get_file('aaa')),
+        os.path.basename(cache.get_file('ccc'))])
+
+
+def test_args() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--foo', type=str, default='')
+    parser.add_argument('--bar', type=int, default=0)
+    add_arguments(parser)
+
+    args = parser.parse_args([])
+    assert from_args(args) is None
+    assert args_key(args, ('bar',)) == "[('foo', '')]"
+
+    args = parser.parse_args(['--foo=x', '--cache-dir=y', '--cache-size=2'])
+    assert args_key(args, ()) == "[('bar', 0), ('foo', 'x')]"
+
+    args.cache_dir = ''
+    assert from_args(args) is None
+
+
+def test_main(tmp_path) -> None:
+    file_in = str(tmp_path / 'data.yml')
+    with open(file_in, 'w') as f:
+        f.write(textwrap.dedent('''\
+            ---
+            - { datetime: 2020-01-12, type: invest, inv_src: 500, rate: 100 }
+            - { datetime: 2020-01-12, type: chkpt }
+            - { datetime: 2020-02-12, type: invest, inv_src: 500, rate: 70 }
+            - { datetime: 2020-02-12, type: chkpt }
+        '''))
+
+    dir_cache = str(tmp_path / 'cache')
+    files_out = [str(tmp_path / f'stats-{i}.csv') for i in range(3)]
+
+    investats.main(['investats', file_in, files_out[0]])
+    investats.main(['investats', '--cache-dir', dir_cache, file_in,
+                    files_out[1]])
+    assert len(os.listdir(dir_cache)) == 1
+
+    # The cached output is tampered with, to check that it is used
+    file_cache = os.path.join(dir_cache, os.listdir(dir_cache)[0])
+    with open(file_cache, 'ab') as f:
+        f.write(b'foo\n')
+
+    investats.main(['investats', '--cache-dir', dir_cache, file_in,
+                    files_out[2]])
+
+    with open(files_out[0], 'r') as f:
+        data_expected = f.read()
+    with open(files_out[1], 'r') as f:
+        assert f.read() == data_expected
+    with open(files_out[2], 'r') as f:
+        assert f.read() == data_expected + 'foo\n'
+
+    # Different options must not hit the same cache entry
+    investats.main(['investats', '--cache-dir', dir_cache, '--fmt-src',
+                    '{:.2f}', file_in, files_out[2]])
+    assert len(os.listdir(dir_cache)) == 2
+
+    # The parsed series of investats_aggr are cached too
+    cache = Cache(dir_cache, 1024 * 1024)
+    series = investats_aggr.load_series(files_out[0], cache)
+    assert len(os.listdir(dir_cache)) == 3
+    assert pfmt(investats_aggr.load_series(files_out[0], cache)) == \
+        pfmt(series)
+    assert pfmt(investats_aggr.load_series(files_out[0])) == pfmt(series)
+
+    # The cached series are plain JSON
+    file_cache = max((os.path.join(dir_cache, x) for x in os.listdir(
+        dir_cache)), key=os.path.getmtime)
+    with open(file_cache, 'rb') as f:
+        assert json.loads(f.read())[0]['datetime'] == \
+            series[0]['datetime'].isoformat()
+
+
+def test_main_tz(monkeypatch, tmp_path) -> None:
+    file_in = str(tmp_path / 'data.yml')
+    with open(file_in, 'w') as f:
+        f.write(textwrap.dedent('''\
+            ---
+            - { datetime: 2020-01-12, type: invest, inv_src: 500, rate: 100 }
+            - { datetime: 2020-01-12, type: chkpt }
+        '''))
+
+    dir_cache = str(tmp_path / 'cache')
+    file_out = str(tmp_path / 'stats.csv')
+
+    # The naive datetimes depend on the local timezone, so it must be part
+    # of the cache key
+    try:
+        for tz_name, offset in (('UTC', '+00:00'), ('Asia/Tokyo', '+09:00')):
+            monkeypatch.setenv('TZ', tz_name)
+            time.tzset()
+
+            investats.main(['investats', '--cache-dir', dir_cache, file_in,
+                            file_out])
+            with open(file_out, 'r') as f:
+                assert f.read().splitlines()[1].startswith(
+                    '2020-01-12 00:00:00' + offset + ',')
+    finally:
+        monkeypatch.undo()
+        time.tzset()
+
+    assert len(os.listdir(dir_cache)) == 2
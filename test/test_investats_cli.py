@@ -5,10 +5,15 @@ import textwrap
 
 import pytest
 
+from copy import deepcopy
 from datetime import datetime as dt
 from datetime import timezone as tz
 
-from investats import load_data, save_data, complete_invest_entry, compute_stats
+from investats import load_data, save_data, complete_invest_values, \
+    complete_invest_entry, LotQueue, solve_xirr, compute_twr_fields, \
+    compute_stats, resample_stats, rolling_stats, merge_checkpoints, \
+    load_prices
+from investats_gen import Freq
 
 from util import pfmt
 
@@ -79,7 +84,8 @@ def test_load_data() -> None:
 
     with pytest.raises(ValueError, match=r'Invalid entry {.+}: exactly two '
                        r'values among "inv_src", "inv_dst" and "rate" must be '
-                       r'provided for each entry of type "invest"'):
+                       r'provided for each entry of type "invest" or '
+                       r'"sell"'):
         load_data(io.StringIO(yml))
 
     yml = textwrap.dedent('''\
@@ -92,7 +98,21 @@ def test_load_data() -> None:
 
     with pytest.raises(ValueError, match=r'Invalid entry {.+}: exactly two '
                        r'values among "inv_src", "inv_dst" and "rate" must be '
-                       r'provided for each entry of type "invest"'):
+                       r'provided for each entry of type "invest" or '
+                       r'"sell"'):
+        load_data(io.StringIO(yml))
+
+    yml = textwrap.dedent('''\
+        ---
+        - { datetime: 2020-01-12, type: invest, inv_src: &inv 500, rate: 100.0000 }
+        - { datetime: 2020-01-12, type: chkpt, cgt: 0.15 }
+        - { datetime: 2020-02-12, type: fee, inv_src: 5 }
+        - { datetime: 2020-02-12 01:23:45, type: chkpt }
+    ''')
+
+    with pytest.raises(ValueError, match=r'Invalid entry {.+}: the '
+                       r'"amount_src" value must be provided for each entry '
+                       r'of type "fee" or "dividend"'):
         load_data(io.StringIO(yml))
 
     yml = textwrap.dedent('''\
@@ -170,6 +190,33 @@ def test_save_data(get_data_invstts) -> None:
 
     assert buf.read() == csv
 
+    buf = io.StringIO()
+    save_data([x | {'xirr': None if i == 0 else 0.5}
+               for i, x in enumerate(data)], buf, fmt_yield='{:.2f}')
+    buf.seek(0)
+
+    lines = buf.read().splitlines()
+    assert lines[0] == headers_line + ',xirr'
+    assert lines[1].endswith(',')
+    assert all(x.endswith(',0.50') for x in lines[2:])
+
+
+def test_complete_invest_values() -> None:
+    entry = {'inv_dst': 100, 'rate': 3}
+    assert complete_invest_values(entry) == (300, 100, 3)
+    assert entry == {'inv_dst': 100, 'rate': 3}
+
+    assert complete_invest_values({'inv_src': 100, 'rate': 8}) == \
+        (100, 12.5, 8)
+    assert complete_invest_values({'inv_src': 100, 'inv_dst': 20}) == \
+        (100, 20, 5)
+    assert complete_invest_values({'inv_src': 1, 'inv_dst': 2, 'rate': 3}) == \
+        (1, 2, 3)
+
+    with pytest.raises(KeyError) as exc_info:
+        complete_invest_values({'inv_src': 0})
+    assert exc_info.value.args == ('rate',)
+
 
 def test_complete_invest_entry() -> None:
     assert complete_invest_entry({'inv_dst': 100, 'rate': 3}) == \
@@ -207,6 +254,76 @@ def test_complete_invest_entry() -> None:
     assert exc_info.value.args == ('inv_dst',)
 
 
+def test_lot_queue() -> None:
+    for method, costs in (('fifo', [1400, 1200, 800]),
+                          ('lifo', [2200, 600, 600]),
+                          ('avg', [1800, 800, 800])):
+        lots = LotQueue(method)
+        lots.buy(10, 1000)
+        lots.buy(10, 2000)
+        assert lots.sell(12) == pytest.approx(costs[0])
+        lots.buy(4, 400)
+        assert lots.sell(6) == pytest.approx(costs[1])
+        assert lots.sell(6) == pytest.approx(costs[2])
+        assert lots.tot_dst == 0
+        assert lots.tot_src == pytest.approx(0, abs=1e-9)
+
+        with pytest.raises(ValueError) as exc_info:
+            lots.sell(1)
+        assert exc_info.value.args == ('Cannot sell more DST than held: '
+                                       '1 > 0',)
+
+    with pytest.raises(ValueError) as exc_info:
+        LotQueue('foo')
+    assert exc_info.value.args == ('Invalid lot method: foo',)
+
+
+def test_solve_xirr() -> None:
+    assert solve_xirr([0, 1], [-1000, 1100]) == pytest.approx(0.1)
+    assert solve_xirr([0, 2], [-1000, 1210], 5) == pytest.approx(0.1)
+    assert solve_xirr([0, 1], [-1000, 500]) == pytest.approx(-0.5)
+    assert solve_xirr([0, 0.5, 1], [-1000, -1000, 2200]) == \
+        pytest.approx(0.13475241575014713)
+
+    rate = solve_xirr([0, 0.25, 0.5, 0.75, 1.3], [-100, -200, 50, -80, 300])
+    assert sum(a * (1 + rate) ** -t for t, a in zip(
+        [0, 0.25, 0.5, 0.75, 1.3], [-100, -200, 50, -80, 300])) == \
+        pytest.approx(0, abs=1e-9)
+
+    assert solve_xirr([0], [-1000]) is None
+    assert solve_xirr([0, 0], [-1000, 1100]) is None
+    assert solve_xirr([0, 1], [-1000, -1100]) is None
+
+
+def test_compute_twr_fields() -> None:
+    entries = [{'chkpt_yield': y, 'tot_dst_as_src': v, 'diff_days': d}
+               for y, v, d in ((0, 1000, 0), (-0.5, 500, 10), (0.6, 800, 10),
+                               (0.5, 1200, 10), (0, 1200, 10))]
+
+    prev_out = None
+    for entry_out in entries:
+        compute_twr_fields(entry_out, prev_out)
+        prev_out = entry_out
+
+    assert [{k: v for k, v in x.items()
+             if k not in ('chkpt_yield', 'tot_dst_as_src', 'diff_days')}
+            for x in entries] == [
+        {'twr': 0, 'max_tot_dst_as_src': 1000, 'drawdown_days': 0,
+         'drawdown': 0.0, 'max_drawdown': 0.0, 'max_drawdown_days': 0},
+        {'twr': -0.5, 'max_tot_dst_as_src': 1000, 'drawdown_days': 10,
+         'drawdown': -0.5, 'max_drawdown': -0.5, 'max_drawdown_days': 10},
+        {'twr': pytest.approx(-0.2), 'max_tot_dst_as_src': 1000,
+         'drawdown_days': 20, 'drawdown': pytest.approx(-0.2),
+         'max_drawdown': -0.5, 'max_drawdown_days': 20},
+        {'twr': pytest.approx(0.2), 'max_tot_dst_as_src': 1200,
+         'drawdown_days': 0, 'drawdown': 0.0, 'max_drawdown': -0.5,
+         'max_drawdown_days': 20},
+        {'twr': pytest.approx(0.2), 'max_tot_dst_as_src': 1200,
+         'drawdown_days': 0, 'drawdown': 0.0, 'max_drawdown': -0.5,
+         'max_drawdown_days': 20},
+    ]
+
+
 def test_compute_stats(get_data_invstts) -> None:
     for pair in get_data_invstts():
         data_in = pair['in']
@@ -223,3 +340,314 @@ def test_compute_stats(get_data_invstts) -> None:
     data_out_actual = list(compute_stats(data_in))
     assert pfmt(data_in) == pfmt(data_in_copy)
     assert pfmt(data_out_actual) == pfmt(data_out_expected)
+
+    for pair in get_data_invstts():
+        data_in = pair['in']
+        data_out_expected = pair['out']
+        # Index of the entry right after the first checkpoint
+        i = next(i for i, x in enumerate(data_in) if x['type'] == 'chkpt') + 1
+        data_out_actual = list(compute_stats(data_in[i:],
+                                             data_out_expected[0]))
+        assert pfmt(data_out_actual) == pfmt(data_out_expected[1:])
+
+    data_in = get_data_invstts(0, 'in')
+    data_out_expected = get_data_invstts(0, 'out')
+    data_out_actual = list(compute_stats(data_in, xirr=True))
+    assert pfmt([{k: v for k, v in x.items() if k != 'xirr'}
+                 for x in data_out_actual]) == pfmt(data_out_expected)
+    assert [x['xirr'] for x in data_out_actual] == \
+        [None, pytest.approx(-0.9849978210304741),
+         pytest.approx(7501.87697033752)]
+
+    data_out_actual = list(compute_stats(data_in, twr=True))
+    assert pfmt([{k: v for k, v in x.items() if k in data_out_expected[0]}
+                 for x in data_out_actual]) == pfmt(data_out_expected)
+    assert [x['twr'] for x in data_out_actual] == \
+        [0, -0.30000000000000004, pytest.approx(1)]
+    assert [x['max_drawdown'] for x in data_out_actual] == [0, 0, 0]
+
+    with pytest.raises(ValueError) as exc_info:
+        list(compute_stats(data_in, data_out_expected[0], xirr=True))
+    assert exc_info.value.args == (
+        'The computation of the XIRR cannot be resumed',)
+
+    data_in = load_data(io.StringIO(textwrap.dedent('''\
+        ---
+        - { datetime: 2020-01-01, type: invest, inv_dst: 10, rate: 100 }
+        - { datetime: 2020-01-01, type: chkpt }
+        - { datetime: 2020-02-01, type: invest, inv_dst: 10, rate: 200 }
+        - { datetime: 2020-02-01, type: sell, inv_dst: 15, rate: 300 }
+        - { datetime: 2020-02-01, type: chkpt, cgt: 0.2 }
+    ''')))
+
+    for method, tot_src, realized in (('fifo', 1000, 2500),
+                                      ('lifo', 500, 2000),
+                                      ('avg', 750, 2250)):
+        data_out = list(compute_stats(data_in, lot_method=method,
+                                      realized=True))
+        assert {k: v for k, v in data_out[1].items()
+                if k not in ('datetime', 'diff_days', 'tot_days')} == {
+            'diff_src': -2500, 'diff_dst': -5, 'latest_rate': 300,
+            'tot_src': tot_src, 'tot_dst': 5, 'avg_rate': tot_src / 5,
+            'tot_dst_as_src': 1500, 'chkpt_yield': 2,
+            'chkpt_apy': pytest.approx(3 ** (365 / 31) - 1),
+            'global_yield': 300 / (tot_src / 5) - 1,
+            'global_apy': pytest.approx((300 / (tot_src / 5)) **
+                                        (365 / 31) - 1),
+            'latest_cgt': 0.2, 'chkpt_gain_src': 3000,
+            'chkpt_gain_net_src': 2400, 'tot_gain_src': 3000,
+            'tot_gain_net_src': 2400, 'diff_realized_src': realized,
+            'tot_realized_src': realized,
+        }
+
+        # With the average cost method, the computation can be resumed
+        if method == 'avg':
+            assert pfmt(list(compute_stats(data_in[2:], data_out[0],
+                                           lot_method=method,
+                                           realized=True))) == \
+                pfmt(data_out[1:])
+
+    assert 'tot_realized_src' not in next(compute_stats(data_in))
+
+    with pytest.raises(ValueError) as exc_info:
+        list(compute_stats(data_in[2:], data_out[0]))
+    assert exc_info.value.args == (
+        'The computation of the fifo lots cannot be resumed',)
+
+    data_in[3]['inv_dst'] = 25
+    with pytest.raises(ValueError) as exc_info:
+        list(compute_stats(data_in))
+    assert exc_info.value.args == ('Cannot sell more DST than held: 25 > 20',)
+
+    data_in = load_data(io.StringIO(textwrap.dedent('''\
+        ---
+        - { datetime: 2020-01-01, type: invest, inv_src: 1000, rate: 100 }
+        - { datetime: 2020-01-01, type: fee, amount_src: 2 }
+        - { datetime: 2020-01-01, type: chkpt, cgt: 0.2 }
+        - { datetime: 2021-01-01, type: fee, amount_src: 5 }
+        - { datetime: 2021-01-01, type: dividend, amount_src: 30 }
+        - { datetime: 2021-01-01, type: chkpt }
+    ''')))
+
+    data_out = list(compute_stats(data_in, fees_dividends=True, xirr=True))
+    assert [{k: x[k] for k in ('tot_src', 'chkpt_gain_src',
+                               'chkpt_gain_net_src', 'tot_gain_src',
+                               'tot_gain_net_src', 'tot_fees_src',
+                               'tot_dividends_src')}
+            for x in data_out] == [
+        {'tot_src': 1000, 'chkpt_gain_src': 0, 'chkpt_gain_net_src': 0,
+         'tot_gain_src': -2, 'tot_gain_net_src': -1.6, 'tot_fees_src': 2,
+         'tot_dividends_src': 0},
+        {'tot_src': 1000, 'chkpt_gain_src': 25, 'chkpt_gain_net_src': 20,
+         'tot_gain_src': 23, 'tot_gain_net_src': 18.400000000000002,
+         'tot_fees_src': 7, 'tot_dividends_src': 30},
+    ]
+    assert data_out[1]['xirr'] == pytest.approx(0.023, abs=1e-3)
+
+    assert pfmt(list(compute_stats(data_in[3:], data_out[0],
+                                   fees_dividends=True))) == \
+        pfmt([{k: v for k, v in data_out[1].items() if k != 'xirr'}])
+    assert 'tot_fees_src' not in next(compute_stats(data_in))
+
+
+def test_compute_stats_prices() -> None:
+    data_in = load_data(io.StringIO(textwrap.dedent('''\
+        ---
+        - { datetime: 2020-01-01, type: invest, inv_src: 500, rate: 100 }
+        - { datetime: 2020-01-01, type: chkpt }
+        - { datetime: 2020-02-01, type: chkpt }
+        - { datetime: 2020-02-15, type: invest, inv_src: 500, rate: 125 }
+        - { datetime: 2020-03-01, type: chkpt }
+        - { datetime: 2020-04-01, type: chkpt }
+    ''')))
+
+    prices = list(load_prices(io.StringIO(
+        'datetime,rate\n'
+        '2019-12-01,90\n'
+        '2020-01-20,110\n'
+        '2020-01-31,120\n'
+        '2020-02-10,130\n'
+    )))
+    assert prices[1] == (dt(2020, 1, 20).astimezone(), 110)
+
+    data_out = list(compute_stats(deepcopy(data_in), prices=iter(prices)))
+
+    # The price of 2020-02-10 is older than the investment of 2020-02-15, so
+    # the rate of the latter is used until the end
+    assert [x['latest_rate'] for x in data_out] == [100, 120, 125, 125]
+    assert [x['tot_dst_as_src'] for x in data_out] == [500, 600, 1125, 1125]
+    assert data_out[1]['chkpt_yield'] == pytest.approx(0.2)
+    assert data_out[1]['tot_gain_src'] == pytest.approx(100)
+
+    # Without prices, the same as before
+    assert pfmt(list(compute_stats(deepcopy(data_in), prices=[]))) == \
+        pfmt(list(compute_stats(deepcopy(data_in))))
+
+    # The computation can be resumed
+    assert pfmt(list(compute_stats(deepcopy(data_in[2:]), data_out[0],
+                                   prices=prices))) == pfmt(data_out[1:])
+
+    with pytest.raises(ValueError) as exc_info:
+        list(load_prices(io.StringIO('datetime,rate\n2020-01-02,1\n'
+                                     '2020-01-01,2\n')))
+    assert exc_info.value.args[0].startswith('Invalid price order: ')
+
+    with pytest.raises(ValueError) as exc_info:
+        list(load_prices(io.StringIO('datetime,price\n2020-01-01,1\n')))
+    assert exc_info.value.args == ('The prices file must have the "datetime" '
+                                   'and "rate" fields',)
+
+
+def test_merge_checkpoints() -> None:
+    data_in = load_data(io.StringIO(textwrap.dedent('''\
+        ---
+        - { datetime: 2020-01-12, type: invest, inv_src: 500, rate: 100 }
+        - { datetime: 2020-02-01, type: invest, inv_src: 500, rate: 110 }
+        - { datetime: 2020-02-12, type: invest, inv_src: 500, rate: 90 }
+        - { datetime: 2020-03-01, type: chkpt }
+        - { datetime: 2020-03-12, type: invest, inv_src: 500, rate: 120 }
+    ''')))
+
+    data = list(merge_checkpoints(iter(data_in), 'monthly'))
+
+    # The checkpoint of 2020-02-01 is placed after the entry with the same
+    # datetime, the one of 2020-03-01 is already there and the one of
+    # 2020-04-01 is after the last entry
+    assert [(x['datetime'], x['type']) for x in data] == [
+        (dt(2020, 1, 12).astimezone(), 'invest'),
+        (dt(2020, 2, 1).astimezone(), 'invest'),
+        (dt(2020, 2, 1).astimezone(), 'chkpt'),
+        (dt(2020, 2, 12).astimezone(), 'invest'),
+        (dt(2020, 3, 1).astimezone(), 'chkpt'),
+        (dt(2020, 3, 12).astimezone(), 'invest'),
+    ]
+
+    data_out = list(compute_stats(data))
+    assert [x['tot_src'] for x in data_out] == [1000, 1500]
+    assert [x['latest_rate'] for x in data_out] == [110, 90]
+
+    data = list(merge_checkpoints(data_in, '2019-12-31,2020-01-20,2020-02-12'))
+    assert [x['datetime'] for x in data if x['type'] == 'chkpt'] == [
+        dt(2020, 1, 20).astimezone(), dt(2020, 2, 12).astimezone(),
+        dt(2020, 3, 1).astimezone(),
+    ]
+
+    assert list(merge_checkpoints([], 'monthly')) == []
+
+    with pytest.raises(ValueError) as exc_info:
+        list(merge_checkpoints(data_in, 'foo'))
+    assert exc_info.value.args == ('Invalid checkpoints: foo',)
+
+    with pytest.raises(ValueError) as exc_info:
+        list(merge_checkpoints(data_in, '2020-02-01,2020-01-20'))
+    assert exc_info.value.args[0].startswith('Invalid checkpoint order: ')
+
+
+def test_resample_stats(get_data_invstts) -> None:
+    data = get_data_invstts(0, 'out')
+
+    # Each entry is in a different month, so nothing changes
+    assert pfmt(list(resample_stats(data, Freq.MONTHLY))) == pfmt(data)
+
+    assert pfmt(list(resample_stats(data, Freq.YEARLY))) == pfmt([
+        {'datetime': dt(2020, 3, 12, tzinfo=tz.utc),
+         'diff_days': 60.0, 'tot_days': 60.0,
+         'diff_src': 1450, 'diff_dst': 19.25, 'latest_rate': 200,
+         'tot_src': 1450, 'tot_dst': 19.25, 'avg_rate': 75.32467532467533,
+         'tot_dst_as_src': 3850.0,
+         'chkpt_yield': 1.0, 'chkpt_apy': 66.80563803899489,
+         'global_yield': 1.6551724137931032, 'global_apy': 379.0996102191754,
+         'latest_cgt': 0.15,
+         'chkpt_gain_src': 2400.0, 'chkpt_gain_net_src': 2040.0,
+         'tot_gain_src': 2400.0, 'tot_gain_net_src': 2040.0},
+    ])
+
+    data_out = list(resample_stats(
+        [data[0] | {'datetime': dt(2020, 2, 1, tzinfo=tz.utc)}] + data[1:],
+        Freq.MONTHLY))
+
+    assert [x['datetime'] for x in data_out] == \
+        [dt(2020, 2, 12, tzinfo=tz.utc), dt(2020, 3, 12, tzinfo=tz.utc)]
+    assert data_out[0]['diff_days'] == 11
+    assert data_out[0]['diff_src'] == 1200
+    assert data_out[0]['chkpt_yield'] == data[1]['chkpt_yield']
+    assert data_out[1]['diff_days'] == 29
+    assert data_out[1]['chkpt_yield'] == data[2]['chkpt_yield']
+
+    assert list(resample_stats([], Freq.MONTHLY)) == []
+
+    # The realized gain is summed within each period too
+    data_in = load_data(io.StringIO(textwrap.dedent('''\
+        ---
+        - { datetime: 2020-01-01, type: invest, inv_src: 1000, rate: 100 }
+        - { datetime: 2020-01-01, type: chkpt }
+        - { datetime: 2020-01-10, type: sell, inv_dst: 5, rate: 120 }
+        - { datetime: 2020-01-10, type: chkpt }
+        - { datetime: 2020-01-20, type: invest, inv_src: 100, rate: 100 }
+        - { datetime: 2020-01-20, type: chkpt }
+        - { datetime: 2020-02-10, type: sell, inv_dst: 1, rate: 110 }
+        - { datetime: 2020-02-10, type: chkpt }
+    ''')))
+    data = list(compute_stats(data_in, realized=True))
+    data_out = list(resample_stats(data, Freq.MONTHLY))
+
+    assert [x['diff_realized_src'] for x in data_out] == [100, 10]
+    assert [x['tot_realized_src'] for x in data_out] == [100, 110]
+    assert [x['diff_src'] for x in data_out] == [500, -110]
+    assert data_out[0]['chkpt_gain_src'] == \
+        pytest.approx(sum(x['chkpt_gain_src'] for x in data[:3]))
+    assert 'diff_realized_src' not in next(resample_stats(
+        compute_stats(data_in), Freq.MONTHLY))
+
+
+def test_rolling_stats(get_data_invstts) -> None:
+    data = get_data_invstts(0, 'out')
+    data_copy = deepcopy(data)
+
+    data_out = list(rolling_stats(data, ['1c', '30d', '61d']))
+
+    assert pfmt(data) == pfmt(data_copy)
+    assert pfmt([{k: v for k, v in x.items() if k in data[0]}
+                 for x in data_out]) == pfmt(data)
+
+    assert [{k: v for k, v in x.items() if k.startswith('roll_')}
+            for x in data_out] == [
+        {'roll_1c_yield': None, 'roll_1c_apy': None,
+         'roll_1c_gain_src': None, 'roll_1c_gain_net_src': None,
+         'roll_30d_yield': None, 'roll_30d_apy': None,
+         'roll_30d_gain_src': None, 'roll_30d_gain_net_src': None,
+         'roll_61d_yield': None, 'roll_61d_apy': None,
+         'roll_61d_gain_src': None, 'roll_61d_gain_net_src': None},
+        {'roll_1c_yield': pytest.approx(-0.3),
+         'roll_1c_apy': pytest.approx(data[1]['chkpt_apy']),
+         'roll_1c_gain_src': -150, 'roll_1c_gain_net_src': -127.5,
+         'roll_30d_yield': pytest.approx(-0.3),
+         'roll_30d_apy': pytest.approx(data[1]['chkpt_apy']),
+         'roll_30d_gain_src': -150, 'roll_30d_gain_net_src': -127.5,
+         'roll_61d_yield': None, 'roll_61d_apy': None,
+         'roll_61d_gain_src': None, 'roll_61d_gain_net_src': None},
+        {'roll_1c_yield': pytest.approx(data[2]['chkpt_yield']),
+         'roll_1c_apy': pytest.approx(data[2]['chkpt_apy']),
+         'roll_1c_gain_src': 2550, 'roll_1c_gain_net_src': 2167.5,
+         'roll_30d_yield': pytest.approx(1),
+         'roll_30d_apy': pytest.approx(2 ** (365 / 60) - 1),
+         'roll_30d_gain_src': 2400, 'roll_30d_gain_net_src': 2040,
+         'roll_61d_yield': None, 'roll_61d_apy': None,
+         'roll_61d_gain_src': None, 'roll_61d_gain_net_src': None},
+    ]
+
+    buf = io.StringIO()
+    save_data(list(rolling_stats(data, ['1c'])), buf, fmt_src='{:.1f}',
+              fmt_yield='{:.2f}')
+    buf.seek(0)
+
+    lines = buf.read().splitlines()
+    assert lines[0].endswith(',tot_gain_net_src,roll_1c_yield,roll_1c_apy,'
+                             'roll_1c_gain_src,roll_1c_gain_net_src')
+    assert lines[1].endswith(',0.0,0.0,,,,')
+    assert lines[2].endswith(',-127.5,-0.30,-0.98,-150.0,-127.5')
+
+    for spec in ('30', '0d', 'xd', '30w', ''):
+        with pytest.raises(ValueError) as exc_info:
+            list(rolling_stats(data, [spec]))
+        assert exc_info.value.args == ('Invalid window: ' + spec,)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+import gzip
+import lzma
+import textwrap
+
+import pytest
+
+import investats
+
+from investats.compress import detect_codec, is_compressed, open_file
+
+
+def test_detect_codec() -> None:
+    assert detect_codec('foo.csv') is None
+    assert detect_codec('foo.csv.gz') == 'gzip'
+    assert detect_codec('foo.csv.xz') == 'xz'
+    assert detect_codec('foo.csv.zst') == 'zstd'
+
+    # The magic bytes take precedence over the extension
+    assert detect_codec('foo.csv', b'\x1f\x8b\x08\x00') == 'gzip'
+    assert detect_codec('foo.csv.gz', b'\xfd7zXZ\x00\x00') == 'xz'
+    assert detect_codec('foo.csv.gz', b'abc') is None
+
+    assert is_compressed('dir.gz/foo.xz')
+    assert not is_compressed('dir.gz/foo.csv')
+
+
+def test_open_file(tmp_path) -> None:
+    text = ''.join(f'line {i}\n' for i in range(100_000))
+
+    for name, opener in [('foo.csv.gz', gzip.open), ('foo.csv.xz', lzma.open),
+                         ('foo.csv', open)]:
+        path = str(tmp_path / name)
+
+        with open_file(path, 'w') as f:
+            f.write(text)
+        with opener(path, 'rt') as f:
+            assert f.read() == text
+
+        with open_file(path, 'r') as f:
+            assert f.read() == text
+        with open_file(path, 'rb') as f:
+            assert f.read() == text.encode()
+
+        # Closing the file before the end must not hang
+        with open_file(path, 'r') as f:
+            assert f.readline() == 'line 0\n'
+
+    # The codec is detected from the content when reading
+    with gzip.open(tmp_path / 'bar.csv', 'wt') as f:
+        f.write(text)
+    with open_file(str(tmp_path / 'bar.csv'), 'r') as f:
+        assert f.read() == text
+
+    # The errors of the background thread are raised by the main thread
+    with open(tmp_path / 'bad.gz', 'wb') as f:
+        f.write(gzip.compress(text.encode())[:1000])
+    with pytest.raises(EOFError), open_file(str(tmp_path / 'bad.gz'),
+                                            'r') as f:
+        f.read()
+
+    with pytest.raises(ValueError) as exc_info:
+        open_file(str(tmp_path / 'foo.csv'), 'a')
+    assert exc_info.value.args == ('Invalid mode: a',)
+
+
+def test_main(tmp_path) -> None:
+    file_in = str(tmp_path / 'data.yml.xz')
+    with lzma.open(file_in, 'wt') as f:
+        f.write(textwrap.dedent('''\
+            ---
+            - { datetime: 2020-01-12, type: invest, inv_src: 500, rate: 100 }
+            - { datetime: 2020-01-12, type: chkpt }
+            - { datetime: 2020-02-12, type: invest, inv_src: 500, rate: 70 }
+            - { datetime: 2020-02-12, type: chkpt }
+        '''))
+
+    investats.main(['investats', file_in, str(tmp_path / 'stats.csv')])
+    investats.main(['investats', file_in, str(tmp_path / 'stats.csv.gz')])
+
+    with open(tmp_path / 'stats.csv', 'r') as f:
+        data_expected = f.read()
+    with gzip.open(tmp_path / 'stats.csv.gz', 'rt') as f:
+        assert f.read() == data_expected
+
+    with pytest.raises(ValueError) as exc_info:
+        investats.main(['investats', '--index', str(tmp_path / 'idx'),
+                        file_in, str(tmp_path / 'stats.csv.gz')])
+    assert exc_info.value.args == ('The --index option cannot be used '
+                                   'together with a compressed output file',)
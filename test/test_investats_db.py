@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+import io
+import textwrap
+
+import pytest
+
+from investats import compute_stats, load_data
+from investats.db import connect, get_assets, insert_entries, load_entries, \
+    load_stats, update_stats
+
+from util import pfmt
+
+
+YML = textwrap.dedent('''\
+    ---
+    - { datetime: 2020-01-12 00:00:00+00:00, type: invest, inv_src: 500, rate: 100 }
+    - { datetime: 2020-01-12 00:00:00+00:00, type: chkpt, cgt: 0.15 }
+    - { datetime: 2020-02-12 00:00:00+00:00, type: invest, inv_src: 500, rate: 70 }
+    - { datetime: 2020-02-12 00:00:00+00:00, type: chkpt }
+    - { datetime: 2020-03-12 00:00:00+00:00, type: invest, inv_src: 200, rate: 50 }
+    - { datetime: 2020-03-12 00:00:00+00:00, type: chkpt }
+    - { datetime: 2020-04-12 00:00:00+00:00, type: invest, inv_src: 300, rate: 80 }
+    - { datetime: 2020-04-12 00:00:00+00:00, type: chkpt }
+''')  # noqa: E501
+
+
+def test_entries() -> None:
+    conn = connect(':memory:')
+    entries = load_data(io.StringIO(YML))
+
+    assert insert_entries(conn, 'AAA', entries[4:]) == 4
+    assert insert_entries(conn, 'AAA', entries[:6]) == 4
+    assert insert_entries(conn, 'BBB', entries[:2]) == 2
+
+    assert get_assets(conn) == ['AAA', 'BBB']
+
+    assert pfmt(load_entries(conn, 'AAA')) == pfmt(entries)
+    assert pfmt(load_entries(conn, 'AAA', entries[3]['datetime']
+                             .timestamp())) == pfmt(entries[4:])
+    assert load_entries(conn, 'CCC') == []
+
+
+def test_insert_entries_duplicates() -> None:
+    conn = connect(':memory:')
+    entries = load_data(io.StringIO(YML))
+
+    # Two identical investments on the same day are both kept, also when the
+    # same batch is inserted again
+    entries_dup = entries[:1] + entries
+    assert insert_entries(conn, 'AAA', entries_dup) == 9
+    assert insert_entries(conn, 'AAA', entries_dup) == 0
+    assert insert_entries(conn, 'AAA', entries[:2]) == 0
+
+    assert pfmt(load_entries(conn, 'AAA')) == pfmt(entries_dup)
+
+    update_stats(conn, 'AAA')
+    assert pfmt(list(load_stats(conn, 'AAA'))) == \
+        pfmt(list(compute_stats(entries_dup)))
+    assert next(load_stats(conn, 'AAA'))['tot_src'] == 1000
+
+
+def test_load_entries_order() -> None:
+    conn = connect(':memory:')
+    entries = load_data(io.StringIO(YML))
+
+    # The investment is inserted after the checkpoint with the same
+    # timestamp, but it's loaded before it
+    assert insert_entries(conn, 'AAA', entries[:4] + entries[5:6]) == 5
+    assert insert_entries(conn, 'AAA', entries[4:5]) == 1
+
+    assert pfmt(load_entries(conn, 'AAA')) == pfmt(entries[:6])
+    assert pfmt(load_entries(conn, 'AAA', entries[3]['datetime']
+                             .timestamp())) == pfmt(entries[4:6])
+
+    update_stats(conn, 'AAA')
+    assert pfmt(list(load_stats(conn, 'AAA'))) == \
+        pfmt(list(compute_stats(entries[:6])))
+
+
+def test_update_stats() -> None:
+    conn = connect(':memory:')
+    entries = load_data(io.StringIO(YML))
+    data_expected = list(compute_stats(entries))
+
+    with pytest.raises(ValueError) as exc_info:
+        update_stats(conn, 'AAA')
+    assert exc_info.value.args == ('Unknown asset: AAA',)
+
+    insert_entries(conn, 'AAA', entries[:4])
+    assert update_stats(conn, 'AAA') == 2
+    assert update_stats(conn, 'AAA') == 0
+    assert pfmt(list(load_stats(conn, 'AAA'))) == pfmt(data_expected[:2])
+
+    # Only the checkpoints after the appended entries are recomputed
+    insert_entries(conn, 'AAA', entries[4:])
+    assert update_stats(conn, 'AAA') == 2
+    assert pfmt(list(load_stats(conn, 'AAA'))) == pfmt(data_expected)
+
+    # Entries inserted before the existing checkpoints (backfill)
+    entries_new = load_data(io.StringIO(YML.replace(
+        '- { datetime: 2020-04-12 00:00:00+00:00, type: invest',
+        '- { datetime: 2020-03-20 00:00:00+00:00, type: invest, '
+        'inv_src: 100, rate: 60 }\n'
+        '- { datetime: 2020-04-12 00:00:00+00:00, type: invest')))
+    insert_entries(conn, 'AAA', entries_new[6:7])
+    assert update_stats(conn, 'AAA') == 1
+    assert pfmt(list(load_stats(conn, 'AAA'))) == \
+        pfmt(list(compute_stats(entries_new)))
+
+    # Different options require a full recomputation
+    assert update_stats(conn, 'AAA', twr=True) == 4
+    assert pfmt(list(load_stats(conn, 'AAA'))) == \
+        pfmt(list(compute_stats(entries_new, twr=True)))
+
+    # Computations that cannot be resumed are redone from scratch
+    assert update_stats(conn, 'AAA', xirr=True) == 4
+    insert_entries(conn, 'AAA', [entries[0] | {'datetime': entries[-1][
+        'datetime'].replace(month=5)}, entries[1] | {'datetime': entries[-1][
+            'datetime'].replace(month=5)}])
+    assert update_stats(conn, 'AAA', xirr=True) == 5
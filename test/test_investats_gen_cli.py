@@ -7,7 +7,8 @@ import pytest
 
 from datetime import date
 
-from investats_gen import Freq, generate_entries
+from investats_gen import Freq, build_entries, generate_dates, \
+    generate_entries
 
 
 def test_freq() -> None:
@@ -41,6 +42,15 @@ def test_freq() -> None:
     assert Freq.MONTHLY.next(d) == date(2021, 1, 7)
     assert Freq.YEARLY.next(d) == date(2021, 12, 7)
 
+    assert Freq.DAILY.floor(d) == date(2020, 12, 7)
+    assert Freq.WEEKLY.floor(d) == date(2020, 12, 7)
+    assert Freq.MONTHLY.floor(d) == date(2020, 12, 1)
+    assert Freq.YEARLY.floor(d) == date(2020, 1, 1)
+
+    d = date(2020, 12, 13)
+
+    assert Freq.WEEKLY.floor(d) == date(2020, 12, 7)
+
 
 def test_generate_entries() -> None:
     with pytest.raises(ValueError) as exc_info:
@@ -99,3 +109,30 @@ def test_generate_entries() -> None:
         buf.seek(0)
 
         assert buf.read() == yml
+
+
+def test_build_entries() -> None:
+    dates = list(generate_dates(date(2020, 1, 1), Freq.MONTHLY, 3))
+    assert dates == [date(2020, 1, 1), date(2020, 2, 1), date(2020, 3, 1)]
+
+    assert build_entries(dates, [100, 110, 90], 500, 0.15) == [
+        {'datetime': date(2020, 1, 1), 'type': 'invest', 'inv_src': 500,
+         'rate': 100},
+        {'datetime': date(2020, 1, 1), 'type': 'chkpt', 'cgt': 0.15},
+        {'datetime': date(2020, 2, 1), 'type': 'invest', 'inv_src': 500,
+         'rate': 110},
+        {'datetime': date(2020, 2, 1), 'type': 'chkpt'},
+        {'datetime': date(2020, 3, 1), 'type': 'invest', 'inv_src': 500,
+         'rate': 90},
+        {'datetime': date(2020, 3, 1), 'type': 'chkpt'},
+    ]
+
+    entries = build_entries(dates, [100, 110, 90], 500, lump_sum=True)
+    assert [x['inv_src'] for x in entries if x['type'] == 'invest'] == \
+        [1500, 0, 0]
+    assert entries[1] == {'datetime': date(2020, 1, 1), 'type': 'chkpt'}
+
+    with pytest.raises(ValueError) as exc_info:
+        build_entries(dates, [100, 110], 500)
+    assert exc_info.value.args == ('The number of dates and rates must be '
+                                   'equal',)
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import textwrap
+
+import pytest
+
+from datetime import datetime as dt
+from datetime import timezone as tz
+
+from investats_query import INDEX_HEADER, INDEX_MAGIC, INDEX_RECORD, Index, \
+    build_index, main, query_rows
+
+
+CSV = textwrap.dedent('''\
+    datetime,diff_days,tot_days
+    2020-01-12 00:00:00+00:00,0,0
+    2020-02-12 00:00:00+00:00,31,31
+    2020-03-12 00:00:00+00:00,29,60
+    2020-04-12 00:00:00+00:00,31,91
+''').encode()
+
+
+def _build(csv: bytes) -> Index:
+    buf_idx = io.BytesIO()
+    build_index(io.BytesIO(csv), buf_idx, (len(csv), 0))
+    buf_idx.seek(0)
+    return Index(buf_idx, (len(csv), 0))
+
+
+def test_build_index() -> None:
+    buf_idx = io.BytesIO()
+    assert build_index(io.BytesIO(CSV), buf_idx, (len(CSV), 123)) == 4
+
+    data = buf_idx.getvalue()
+    assert data.startswith(INDEX_MAGIC + INDEX_HEADER.pack(len(CSV), 123))
+    assert len(data) == len(INDEX_MAGIC) + INDEX_HEADER.size + \
+        4 * INDEX_RECORD.size
+
+    index = _build(CSV)
+    assert len(index) == 4
+    assert index[0] == (dt(2020, 1, 12, tzinfo=tz.utc).timestamp(), 28)
+    assert index[1] == (dt(2020, 2, 12, tzinfo=tz.utc).timestamp(), 58)
+    assert CSV[index[3][1]:].startswith(b'2020-04-12 ')
+
+    with pytest.raises(IndexError):
+        index[4]
+
+    with pytest.raises(ValueError) as exc_info:
+        build_index(io.BytesIO(b'foo,bar\n'), io.BytesIO(), (0, 0))
+    assert exc_info.value.args == ('The first field is not "datetime"',)
+
+    with pytest.raises(ValueError) as exc_info:
+        build_index(io.BytesIO(b'datetime,foo\n2020-02-01,0\n2020-01-01,0\n'),
+                    io.BytesIO(), (0, 0))
+    assert exc_info.value.args == ('Invalid row order at offset 26',)
+
+    with pytest.raises(ValueError) as exc_info:
+        Index(io.BytesIO(b'foo'))
+    assert exc_info.value.args == ('Invalid index file',)
+
+    buf_idx.seek(0)
+    with pytest.raises(ValueError) as exc_info:
+        Index(buf_idx, (len(CSV), 124))
+    assert exc_info.value.args == ('Stale index file: the CSV file has '
+                                   'changed since it was indexed',)
+
+
+def test_query_rows() -> None:
+    index = _build(CSV)
+    lines = CSV.splitlines(keepends=True)
+
+    def query(**kwargs) -> list[bytes]:
+        return list(query_rows(io.BytesIO(CSV), index, **kwargs))
+
+    assert query(dt_at=dt(2020, 2, 12, tzinfo=tz.utc)) == \
+        [lines[0], lines[2]]
+    assert query(dt_at=dt(2020, 3, 1, tzinfo=tz.utc)) == \
+        [lines[0], lines[2]]
+    assert query(dt_at=dt(2021, 1, 1, tzinfo=tz.utc)) == \
+        [lines[0], lines[4]]
+    assert query(dt_at=dt(2020, 1, 1, tzinfo=tz.utc)) == [lines[0]]
+
+    assert query(dt_from=dt(2020, 2, 1, tzinfo=tz.utc),
+                 dt_to=dt(2020, 3, 12, tzinfo=tz.utc)) == \
+        [lines[0], lines[2], lines[3]]
+    assert query(dt_from=dt(2020, 3, 12, tzinfo=tz.utc)) == \
+        [lines[0], lines[3], lines[4]]
+    assert query(dt_to=dt(2020, 1, 12, tzinfo=tz.utc)) == \
+        [lines[0], lines[1]]
+    assert query() == lines
+    assert query(dt_from=dt(2020, 5, 1, tzinfo=tz.utc)) == [lines[0]]
+
+
+def test_main_stale(capsysbinary, tmp_path) -> None:
+    file_csv = str(tmp_path / 'stats.csv')
+    with open(file_csv, 'wb') as f:
+        f.write(CSV)
+
+    argv = ['investats_query', file_csv, '--at', '2020-02-12T00:00:00Z']
+    lines = CSV.splitlines(keepends=True)
+
+    main(argv + ['--build'])
+    assert capsysbinary.readouterr().out == lines[0] + lines[2]
+    main(argv)
+    assert capsysbinary.readouterr().out == lines[0] + lines[2]
+
+    # The CSV file is rewritten after being indexed, with the same size
+    with open(file_csv, 'wb') as f:
+        f.write(CSV.replace(b' ', b'T'))
+    st = os.stat(file_csv)
+    os.utime(file_csv, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+
+    with pytest.raises(ValueError) as exc_info:
+        main(argv)
+    assert exc_info.value.args == ('Stale index file: the CSV file has '
+                                   'changed since it was indexed',)
+
+    main(argv + ['--build'])
+    assert capsysbinary.readouterr().out == lines[0] + \
+        lines[2].replace(b' ', b'T')
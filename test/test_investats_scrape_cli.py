@@ -8,7 +8,8 @@ import pytest
 from datetime import datetime as dt
 from datetime import timezone as tz
 
-from investats_scrape import is_txn_valid, load_data, save_data, txns_to_entries
+from investats_scrape import is_txn_valid, load_data, save_data, \
+    parse_entry_values, txns_to_entries
 
 from util import pfmt
 
@@ -32,6 +33,18 @@ def test_is_txn_valid() -> None:
     assert not is_txn_valid({'datetime': '', 'rate': '', 'inv_src': ''})
     assert not is_txn_valid({'datetime': '', 'rate': '', 'inv_dst': ''})
 
+    assert is_txn_valid({'datetime': '', 'asset': '', 'rate': '',
+                         'inv_src': '', 'fee': ''})
+    assert is_txn_valid({'datetime': '', 'asset': '', 'fee': ''})
+    assert is_txn_valid({'datetime': '', 'asset': '', 'dividend': ''})
+    assert is_txn_valid({'datetime': '', 'asset': '', 'fee': '',
+                         'dividend': ''})
+
+    assert not is_txn_valid({'datetime': '', 'asset': ''})
+    assert not is_txn_valid({'datetime': '', 'asset': '', 'inv_src': '',
+                             'dividend': ''})
+    assert not is_txn_valid({'datetime': '', 'dividend': ''})
+
 
 def test_load_data() -> None:
     txt = textwrap.dedent('''\
@@ -102,6 +115,41 @@ def test_load_data() -> None:
         list(load_data(io.StringIO(txt), '#####', 'Datetime:', 'Asset:',
                        'Amount:', 'Shares:', 'ThisIsAWrongPrefix:'))
 
+    txt = textwrap.dedent('''\
+        ########## TRANSACTION ##########
+
+        Datetime:  2020-09-12T11:30:00
+        Asset:     BBB
+        Price:     25.0000
+        Shares:    25
+        Commission: 1.50
+
+        ########## TRANSACTION ##########
+
+        Datetime:  2020-10-12T12:00:00
+        Asset:     BBB
+        Dividend:  3.20
+    ''')
+
+    data = list(load_data(io.StringIO(txt), '#####', 'Datetime:', 'Asset:',
+                          'Amount:', 'Shares:', 'Price:', 'Commission:',
+                          'Dividend:'))
+    assert pfmt(data) == pfmt([
+        {'datetime': dt(2020, 9, 12, 11, 30), 'asset': 'BBB',
+         'rate': '25.0000', 'inv_dst': '25', 'fee': '1.50'},
+        {'datetime': dt(2020, 10, 12, 12), 'asset': 'BBB',
+         'dividend': '3.20'},
+    ])
+
+    # The fee and dividend lines are ignored by default
+    with pytest.raises(ValueError, match=r'Invalid transaction: {.+}'):
+        list(load_data(io.StringIO(txt), '#####', 'Datetime:', 'Asset:',
+                       'Amount:', 'Shares:', 'Price:'))
+    txt = txt[:txt.rfind('########## TRANSACTION')]
+    data = list(load_data(io.StringIO(txt), '#####', 'Datetime:', 'Asset:',
+                          'Amount:', 'Shares:', 'Price:'))
+    assert 'fee' not in data[0]
+
 
 def test_save_data() -> None:
     data = [
@@ -127,6 +175,17 @@ def test_save_data() -> None:
     assert buf.read() == yml
 
 
+def test_parse_entry_values() -> None:
+    d = dt(2020, 1, 1, tzinfo=tz.utc)
+
+    assert parse_entry_values({'datetime': d, 'type': 'invest',
+                               'inv_src': '400.00', 'rate': '20'}) == \
+        {'datetime': d, 'type': 'invest', 'inv_src': 400.0, 'rate': 20}
+    assert parse_entry_values({'datetime': d, 'type': 'chkpt',
+                               'cgt': '0.15'}) == \
+        {'datetime': d, 'type': 'chkpt', 'cgt': 0.15}
+
+
 def test_txns_to_entries() -> None:
     data_in_orig = [
         {'datetime': dt(2020, 9, 12, 11, 30, tzinfo=tz.utc), 'asset': 'BBB',
@@ -195,3 +254,28 @@ def test_txns_to_entries() -> None:
     data_out_actual = list(txns_to_entries(data_in, 'BBB'))
     assert pfmt(data_in) == pfmt(data_in_copy)
     assert pfmt(data_out_actual) == pfmt(data_out_expected)
+
+    data_in = [
+        {'datetime': dt(2020, 9, 12, 11, 30, tzinfo=tz.utc), 'asset': 'BBB',
+         'rate': '25.0000', 'inv_dst': '25', 'fee': '1.50'},
+        {'datetime': dt(2020, 9, 12, 12, tzinfo=tz.utc), 'asset': 'BBB',
+         'dividend': '3.20'},
+    ]
+
+    data_out_expected = [
+        {'datetime': dt(2020, 9, 12, 11, 30, tzinfo=tz.utc), 'type': 'invest',
+         'inv_dst': '25', 'rate': '25.0000'},
+        {'datetime': dt(2020, 9, 12, 11, 30, tzinfo=tz.utc), 'type': 'fee',
+         'amount_src': '1.50'},
+        {'datetime': dt(2020, 9, 12, 12, tzinfo=tz.utc), 'type': 'dividend',
+         'amount_src': '3.20'},
+        {'datetime': dt(2020, 9, 13, tzinfo=tz.utc), 'type': 'chkpt'},
+    ]
+
+    data_out_actual = list(txns_to_entries(data_in, 'BBB'))
+    assert pfmt(data_out_actual) == pfmt(data_out_expected)
+
+    with pytest.raises(ValueError) as exc_info:
+        list(txns_to_entries(data_in[1:] + data_in[:1], 'BBB'))
+    assert exc_info.value.args[0].startswith('The first transaction must be '
+                                             'an investment: ')
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+import asyncio
+import io
+import os
+import textwrap
+
+import pytest
+
+from investats import compute_stats, load_data
+from investats_serve import Ledger, Server
+
+from util import pfmt
+
+
+YML_AAA = textwrap.dedent('''\
+    ---
+    - { datetime: 2020-01-12, type: invest, inv_src: &inv 500, rate: 100 }
+    - { datetime: 2020-01-12, type: chkpt, cgt: 0.15 }
+    - { datetime: 2020-02-12, type: invest, inv_src: *inv, rate: 70 }
+    - { datetime: 2020-02-12, type: chkpt }
+''')
+YML_AAA_APPEND = textwrap.dedent('''\
+    - { datetime: 2020-03-12, type: invest, inv_src: 200, rate: 50 }
+    - { datetime: 2020-03-12, type: chkpt }
+''')
+YML_BBB = textwrap.dedent('''\
+    ---
+    - { datetime: 2020-01-12, type: invest, inv_src: 500, rate: 50 }
+    - { datetime: 2020-01-12, type: chkpt }
+''')
+YML_EMPTY = textwrap.dedent('''\
+    ---
+    - { datetime: 2020-01-12, type: invest, inv_src: 500, rate: 50 }
+''')
+
+
+def _write(path: str, content: str, mode: str = 'w') -> None:
+    with open(path, mode) as f:
+        f.write(content)
+    # Makes sure the modification time changes, even on filesystems with a
+    # coarse timestamp resolution
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+
+
+def test_ledger(tmp_path) -> None:
+    path = str(tmp_path / 'data-AAA.yml')
+    _write(path, YML_AAA)
+
+    ledger = Ledger(path)
+
+    assert ledger.refresh()
+    assert not ledger.refresh()
+    assert ledger.consumed == 4
+    assert len(ledger.stats) == 2
+
+    _write(path, YML_AAA_APPEND, 'a')
+
+    stats_prev = ledger.stats
+    assert ledger.refresh()
+    assert ledger.consumed == 6
+    assert ledger.stats[:2] == stats_prev
+
+    data_expected = list(compute_stats(load_data(
+        io.StringIO(YML_AAA + YML_AAA_APPEND))))
+    assert pfmt(ledger.stats) == pfmt(data_expected)
+
+    # The ledger is rewritten (not just appended), so the stats are
+    # recomputed from scratch
+    _write(path, YML_BBB)
+
+    assert ledger.refresh()
+    data_expected = list(compute_stats(load_data(io.StringIO(YML_BBB))))
+    assert pfmt(ledger.stats) == pfmt(data_expected)
+
+
+def test_server_handle(tmp_path) -> None:
+    _write(str(tmp_path / 'data-AAA.yml'), YML_AAA)
+    _write(str(tmp_path / 'data-BBB.yml'), YML_BBB)
+
+    server = Server({'AAA': str(tmp_path / 'data-AAA.yml'),
+                     'BBB': str(tmp_path / 'data-BBB.yml')},
+                    {'fmt_src': '{:.2f}'})
+    assert server.refresh() == ['AAA', 'BBB']
+    assert server.refresh() == []
+
+    assert server.handle('GET', '/assets') == (200, 'text/plain',
+                                               'AAA\nBBB\n')
+
+    status, ctype, body = server.handle('GET', '/stats/AAA')
+    assert (status, ctype) == (200, 'text/csv')
+    assert body.splitlines()[0].startswith('datetime,diff_days,tot_days,')
+    assert len(body.splitlines()) == 3
+    assert ',1000.00,' in body.splitlines()[2]
+
+    status, ctype, body = server.handle('GET', '/aggr?assets=AAA,BBB')
+    assert (status, ctype) == (200, 'text/csv')
+    assert ',AAA:diff_days,' in body.splitlines()[0]
+    assert ',BBB:diff_days,' in body.splitlines()[0]
+    assert len(body.splitlines()) == 3
+
+    assert server.handle('GET', '/aggr')[1:] == \
+        server.handle('GET', '/aggr?assets=AAA,BBB')[1:]
+
+    assert server.handle('GET', '/stats/CCC')[0] == 404
+    assert server.handle('GET', '/aggr?assets=AAA,CCC')[0] == 404
+    assert server.handle('GET', '/aggr?assets=AAA')[0] == 400
+    assert server.handle('GET', '/foo')[0] == 404
+    assert server.handle('POST', '/assets')[0] == 405
+
+
+def test_server_refresh_errors(tmp_path, capsys) -> None:
+    _write(str(tmp_path / 'data-AAA.yml'), YML_AAA)
+    _write(str(tmp_path / 'data-BBB.yml'), YML_BBB)
+
+    server = Server({'AAA': str(tmp_path / 'data-AAA.yml'),
+                     'BBB': str(tmp_path / 'data-BBB.yml')})
+    assert server.refresh(strict=True) == ['AAA', 'BBB']
+    stats_prev = server.ledgers['AAA'].stats
+
+    # A half-written ledger doesn't prevent the other ones from being
+    # refreshed, and keeps its previous stats
+    _write(str(tmp_path / 'data-AAA.yml'), YML_AAA + '- { datetime: 2020-')
+    _write(str(tmp_path / 'data-BBB.yml'), YML_BBB + YML_AAA_APPEND)
+
+    assert server.refresh() == ['BBB']
+    assert server.refresh() == []
+    assert server.ledgers['AAA'].stats is stats_prev
+    assert capsys.readouterr().err.startswith(
+        'Error refreshing ledger AAA: ParserError: ')
+
+    # Entries with missing fields
+    _write(str(tmp_path / 'data-AAA.yml'), YML_AAA + '- { type: chkpt }\n')
+    assert server.refresh() == []
+    assert capsys.readouterr().err.startswith(
+        'Error refreshing ledger AAA: KeyError: ')
+
+    _write(str(tmp_path / 'data-AAA.yml'), YML_AAA + YML_AAA_APPEND)
+    assert server.refresh() == ['AAA']
+    assert len(server.ledgers['AAA'].stats) == 3
+    assert server.errors == {}
+
+    _write(str(tmp_path / 'data-AAA.yml'), '- foo')
+    with pytest.raises(TypeError):
+        server.refresh(strict=True)
+
+
+def test_server_http(tmp_path) -> None:
+    _write(str(tmp_path / 'data-AAA.yml'), YML_AAA)
+    _write(str(tmp_path / 'data-EEE.yml'), YML_EMPTY)
+    _write(str(tmp_path / 'data-FFF.yml'), YML_EMPTY)
+
+    server = Server({'AAA': str(tmp_path / 'data-AAA.yml'),
+                     'EEE': str(tmp_path / 'data-EEE.yml'),
+                     'FFF': str(tmp_path / 'data-FFF.yml')})
+
+    async def request(port: int, target: str) -> bytes:
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(f'GET {target} HTTP/1.0\r\nHost: x\r\n\r\n'.encode())
+        await writer.drain()
+        response = await reader.read()
+        writer.close()
+        return response
+
+    async def run() -> None:
+        srv = await server.start(port=0, interval=0.01)
+        port = srv.sockets[0].getsockname()[1]
+
+        try:
+            response = await request(port, '/assets')
+            assert response.startswith(b'HTTP/1.0 200 \r\n')
+            assert response.endswith(b'\r\n\r\nAAA\nEEE\nFFF\n')
+
+            # The aggregation of ledgers without checkpoints fails, but the
+            # error is still sent as a response
+            response = await request(port, '/aggr?assets=EEE,FFF')
+            assert response.startswith(b'HTTP/1.0 500 \r\n')
+            assert b'\r\n\r\nIndexError: ' in response
+
+            response = await request(port, '/stats/AAA')
+            assert response.count(b'\n2020-') == 2
+
+            _write(str(tmp_path / 'data-AAA.yml'), YML_AAA_APPEND, 'a')
+            await asyncio.sleep(0.1)
+
+            response = await request(port, '/stats/AAA')
+            assert response.count(b'\n2020-') == 3
+        finally:
+            srv.close()
+            server.watcher.cancel()
+
+    asyncio.run(run())
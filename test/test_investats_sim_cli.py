@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+import io
+
+import pytest
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from datetime import datetime as dt
+from datetime import timedelta
+
+import investats
+import investats_sim
+import investats_sim.cli
+
+from investats_gen import Freq, generate_entries
+from investats_sim import evaluate_paths, get_plan_days, percentile, \
+    save_data, simulate, simulate_paths
+
+
+def test_get_plan_days() -> None:
+    assert get_plan_days(date(2020, 1, 1), Freq.MONTHLY, 4) == \
+        [0, 31, 60, 91]
+
+    with pytest.raises(ValueError) as exc_info:
+        get_plan_days(date(2020, 1, 1), Freq.MONTHLY, 1)
+    assert exc_info.value.args == ('Count must be >= 2',)
+
+
+def test_percentile() -> None:
+    assert percentile([1, 2, 3, 4, 5], 0) == 1
+    assert percentile([1, 2, 3, 4, 5], 50) == 3
+    assert percentile([1, 2, 3, 4, 5], 100) == 5
+    assert percentile([1, 2, 3, 4], 50) == 2.5
+    assert percentile([1, 2, 3, 4], 25) == 1.75
+    assert percentile([7], 95) == 7
+
+
+def test_evaluate_paths() -> None:
+    days = get_plan_days(date(2020, 1, 1), Freq.MONTHLY, 12)
+    paths = simulate_paths(3, 'foo', 100, 0.1, 0.3, days)
+
+    assert len(paths) == 3 and all(len(p) == 12 for p in paths)
+    assert all(p[0] == 100 for p in paths)
+    assert simulate_paths(3, 'foo', 100, 0.1, 0.3, days) == paths
+    assert simulate_paths(3, 'bar', 100, 0.1, 0.3, days) != paths
+
+    out = evaluate_paths(paths, days, 500, 0.15)
+
+    # Each path must give the same results as compute_stats
+    for i, path in enumerate(paths):
+        data_in = []
+        for d, rate in zip(days, path):
+            d = dt(2020, 1, 1) + timedelta(days=d)
+            data_in.append({'datetime': d, 'type': 'invest', 'inv_src': 500,
+                            'rate': rate})
+            data_in.append({'datetime': d, 'type': 'chkpt', 'cgt': 0.15})
+
+        data_out = list(investats.compute_stats(data_in))
+
+        for t, x in enumerate(data_out):
+            for k in ('tot_gain_net_src', 'global_apy'):
+                assert out[k][t][i] == pytest.approx(x[k], rel=1e-9)
+
+
+def test_simulate(monkeypatch) -> None:
+    monkeypatch.setattr(investats_sim.cli, 'CHUNK_PATHS', 7)
+
+    args = (date(2020, 1, 1), 1000, 100, 0.08, 0.25, Freq.MONTHLY, 24, 50)
+
+    data = list(simulate(*args, seed=1))
+    assert len(data) == 24
+    assert list(data[0].keys()) == [
+        'datetime', 'tot_days', 'tot_src',
+        'tot_gain_net_src:p5', 'tot_gain_net_src:p25',
+        'tot_gain_net_src:p50', 'tot_gain_net_src:p75',
+        'tot_gain_net_src:p95',
+        'global_apy:p5', 'global_apy:p25', 'global_apy:p50',
+        'global_apy:p75', 'global_apy:p95',
+    ]
+    for x in data[1:]:
+        assert x['tot_gain_net_src:p5'] <= x['tot_gain_net_src:p50'] <= \
+            x['tot_gain_net_src:p95']
+        assert x['tot_gain_net_src:p5'] < x['tot_gain_net_src:p95']
+
+    # The results don't depend on how the chunks are distributed
+    with ThreadPoolExecutor(3) as executor:
+        assert list(simulate(*args, seed=1, executor=executor)) == data
+    assert list(simulate(*args, seed=2)) != data
+
+    # Without volatility, all the paths are the same as investats_gen's
+    buf = io.StringIO()
+    generate_entries(buf, date(2020, 1, 1), '1000', 100, 0.08, Freq.MONTHLY,
+                     24)
+    buf.seek(0)
+    data_expected = list(investats.compute_stats(investats.load_data(buf)))
+
+    data = list(simulate(*args[:4], 0, *args[5:], percentiles=(5, 95)))
+    for x, y in zip(data, data_expected):
+        assert x['tot_days'] == y['tot_days']
+        for p in (5, 95):
+            assert x[f'tot_gain_net_src:p{p}'] == \
+                pytest.approx(y['tot_gain_net_src'], rel=1e-9, abs=1e-9)
+            assert x[f'global_apy:p{p}'] == \
+                pytest.approx(y['global_apy'], rel=1e-9, abs=1e-9)
+
+    with pytest.raises(ValueError) as exc_info:
+        list(simulate(*args, percentiles=(101,)))
+    assert exc_info.value.args == ('Invalid percentile: 101',)
+
+
+def test_save_data() -> None:
+    data = list(simulate(date(2020, 1, 1), 1000, 100, 0.08, 0.25,
+                         Freq.YEARLY, 2, 10, percentiles=(50,)))
+
+    buf = io.StringIO()
+    save_data(data, buf, '{:.1f}', '{:.2f}', '{:.4f}')
+    lines = buf.getvalue().splitlines()
+
+    assert lines[0] == 'datetime,tot_days,tot_src,tot_gain_net_src:p50,' \
+        'global_apy:p50'
+    assert lines[1] == str(dt(2020, 1, 1).astimezone()) + \
+        ',0.0,1000.00,0.00,0.0000'
+    assert lines[2].startswith(str(dt(2021, 1, 1).astimezone()) +
+                               ',366.0,2000.00,')
+
+    # Without format strings, the integer values are written as such
+    buf = io.StringIO()
+    save_data(data, buf)
+    assert buf.getvalue().splitlines()[1] == \
+        str(dt(2020, 1, 1).astimezone()) + ',0,1000,0,0'
+
+
+def test_main(tmp_path) -> None:
+    argv = ['investats_sim', '-d2020-01-01', '-c6', '-n20', '--seed', '3']
+
+    investats_sim.main(argv + [str(tmp_path / 'out-1.csv')])
+    investats_sim.main(argv + ['-j2', str(tmp_path / 'out-2.csv')])
+
+    with open(tmp_path / 'out-1.csv', 'r') as f:
+        data = f.read()
+    with open(tmp_path / 'out-2.csv', 'r') as f:
+        assert f.read() == data
+    assert len(data.splitlines()) == 7
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+import argparse
+import io
+import json
+import pstats
+
+from investats.timings import NullTimings, Timings, add_arguments, instrument
+
+
+def test_null_timings() -> None:
+    timings = NullTimings()
+
+    assert not timings.enabled
+
+    with timings.stage('foo') as rec:
+        rec['rows'] = 5
+
+    gen = (x for x in range(3))
+    assert timings.collect(gen, rec) is gen
+
+
+def test_timings() -> None:
+    buf = io.StringIO()
+    timings = Timings(buf)
+
+    assert timings.enabled
+
+    with timings.stage('foo') as rec:
+        data = timings.collect((x for x in range(3)), rec)
+
+    assert data == [0, 1, 2]
+    assert rec['rows'] == 3
+
+    line = buf.getvalue()
+    assert line.startswith('timings: stage=foo wall=')
+    assert ' rows=3 ' in line
+    assert line.endswith('\n') and line.count('\n') == 1
+
+    buf = io.StringIO()
+    timings = Timings(buf, 'json')
+
+    with timings.stage('bar'):
+        pass
+
+    rec = json.loads(buf.getvalue())
+    assert list(rec.keys()) == ['stage', 'rows', 'wall_s', 'cpu_s',
+                                'rows_per_s', 'peak_rss']
+    assert rec['stage'] == 'bar'
+    assert rec['rows'] is None and rec['rows_per_s'] is None
+
+
+def test_instrument(tmp_path) -> None:
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
+
+    args = parser.parse_args([])
+    with instrument(args) as timings:
+        assert not timings.enabled
+
+    file_prof = tmp_path / 'run.prof'
+    args = parser.parse_args(['--profile', str(file_prof)])
+    with instrument(args) as timings:
+        sum(range(1000))
+
+    assert pstats.Stats(str(file_prof)).total_calls > 0
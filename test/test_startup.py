@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+import os
+import subprocess
+import sys
+
+import pytest
+
+import investats
+
+# Max cumulative import time (in microseconds) of all the CLI modules, as
+# measured with "python -X importtime". The budget is checked only if it is
+# specified, as wall-clock times are not reliable on shared machines
+STARTUP_BUDGET_US = int(os.environ.get('INVESTATS_STARTUP_BUDGET_US', '0'))
+
+MODULES_CLI = ('investats.cli', 'investats_aggr.cli', 'investats_gen.cli',
+               'investats_scrape.cli')
+
+# Modules that must be imported only when they are actually used
+MODULES_HEAVY = ('yaml', 'dateutil', 'argparse', 'csv', 'json')
+
+
+def _run_python(*args: str) -> subprocess.CompletedProcess:
+    '''
+    Runs a Python interpreter that can import the packages under test
+    '''
+    env = os.environ.copy()
+    env['PYTHONPATH'] = os.path.dirname(
+        os.path.dirname(os.path.abspath(investats.__file__)))
+
+    return subprocess.run([sys.executable, *args], env=env, check=True,
+                          capture_output=True, text=True)
+
+
+def test_lazy_imports() -> None:
+    proc = _run_python('-c', 'import sys; '
+                       'import investats, investats_aggr, investats_gen, '
+                       'investats_scrape, investats_serve, investats_query, '
+                       'investats_sim, investats_backtest; '
+                       'print(",".join(sys.modules))')
+    modules = proc.stdout.strip().split(',')
+
+    for name in MODULES_CLI + MODULES_HEAVY + ('investats_serve.cli',
+                                               'investats_sim.cli',
+                                               'investats_backtest.cli'):
+        assert name not in modules
+
+    proc = _run_python('-c', 'import sys; '
+                       f'import {", ".join(MODULES_CLI)}; '
+                       'print(",".join(sys.modules))')
+    modules = proc.stdout.strip().split(',')
+
+    for name in MODULES_HEAVY:
+        assert name not in modules
+
+
+def test_lazy_submodules() -> None:
+    proc = _run_python('-c', 'import investats, investats_query; '
+                       'print(investats.cli.__name__, '
+                       'investats.compress.__name__, '
+                       'investats_query.cli.__name__, '
+                       'investats.compute_stats.__name__, '
+                       'hasattr(investats, "foo"))')
+    assert proc.stdout.split() == ['investats.cli', 'investats.compress',
+                                   'investats_query.cli', 'compute_stats',
+                                   'False']
+
+
+@pytest.mark.skipif(STARTUP_BUDGET_US == 0,
+                    reason='INVESTATS_STARTUP_BUDGET_US is not set')
+def test_startup_budget() -> None:
+    proc = _run_python('-X', 'importtime', '-c',
+                       f'import {", ".join(MODULES_CLI)}')
+
+    # Each line has the following format:
+    # "import time: <self us> | <cumulative us> | <indented module name>"
+    total_us = 0
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative, name = line.removeprefix('import time:').split('|')
+        # Only the top-level imports of the CLI modules are counted, to avoid
+        # counting the same time more than once, and to exclude the
+        # interpreter startup
+        if not name.startswith('  ') and name.strip() in MODULES_CLI:
+            total_us += int(cumulative)
+
+    assert total_us <= STARTUP_BUDGET_US, \
+        f'Startup time budget exceeded: {total_us} > {STARTUP_BUDGET_US} us'